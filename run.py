@@ -1,9 +1,4 @@
 #!/usr/bin/env python3
-import pop.hub
+import virt.scripts
 
-def start():
-    hub = pop.hub.Hub()
-    hub.pop.sub.add('virt.virt')
-
-
-start()
+virt.scripts.start()
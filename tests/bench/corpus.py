@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+'''
+    tests.bench.corpus
+    ~~~~~~~~~~~~~~
+
+    Generate synthetic libvirt XML and qemu-img JSON documents for the parsers benchmarks.
+'''
+
+import json
+from xml.etree import ElementTree
+
+
+class FakeDomain:
+    '''
+    Minimal libvirt domain object only providing the XML description
+    '''
+
+    def __init__(self, xml):
+        self.xml = xml
+
+    def XMLDesc(self, flags):  # pylint: disable=invalid-name,unused-argument
+        return self.xml
+
+
+def domain_xml(disks=1, nics=1, graphics=True):
+    '''
+    Generate a domain XML definition with the given number of disks and network interfaces
+    '''
+    devices = []
+    for index in range(disks):
+        target = 'vd{}{}'.format(chr(ord('a') + index // 26), chr(ord('a') + index % 26))
+        devices.append('''
+    <disk type='file' device='disk'>
+      <driver name='qemu' type='raw' cache='none' io='native'/>
+      <source file='/var/lib/libvirt/images/vm-{index}.raw'/>
+      <target dev='{target}' bus='virtio'/>
+      <address type='pci' domain='0x0000' bus='0x{bus:02x}' slot='0x00' function='0x0'/>
+    </disk>'''.format(index=index, target=target, bus=index + 1))
+    for index in range(nics):
+        devices.append('''
+    <interface type='network'>
+      <mac address='52:54:00:{high:02x}:{low:02x}:01'/>
+      <source network='default' portid='2a8d7b1c-0c0e-4b0b-b2b3-{index:012d}' bridge='virbr0'/>
+      <target dev='vnet{index}'/>
+      <model type='virtio'/>
+      <driver name='vhost' queues='4'/>
+      <virtualport type='openvswitch'>
+        <parameters interfaceid='09b11c53-8b5c-4eeb-8f00-{index:012d}'/>
+      </virtualport>
+      <alias name='net{index}'/>
+      <address type='pci' domain='0x0000' bus='0x{bus:02x}' slot='0x00' function='0x0'/>
+    </interface>'''.format(index=index, high=index // 256, low=index % 256, bus=disks + index + 1))
+    if graphics:
+        devices.append('''
+    <graphics type='vnc' port='5900' autoport='yes' listen='0.0.0.0' keymap='en-us'>
+      <listen type='address' address='0.0.0.0'/>
+    </graphics>''')
+    return '''<domain type='kvm' id='1'>
+  <name>bench-vm</name>
+  <uuid>d2d8a1a4-8c5e-4e0e-9a5e-0b1f2c3d4e5f</uuid>
+  <memory unit='KiB'>1048576</memory>
+  <vcpu placement='static'>2</vcpu>
+  <os><type arch='x86_64' machine='pc-q35-4.2'>hvm</type></os>
+  <on_poweroff>destroy</on_poweroff>
+  <on_reboot>restart</on_reboot>
+  <on_crash>destroy</on_crash>
+  <devices>
+    <emulator>/usr/bin/qemu-system-x86_64</emulator>{devices}
+  </devices>
+</domain>'''.format(devices=''.join(devices))
+
+
+def qemu_img_json(chain=1, snapshots=0):
+    '''
+    Generate a ``qemu-img info --backing-chain --output json`` output
+
+    :param chain: number of images in the backing chain
+    :param snapshots: number of internal snapshots in each image
+    '''
+    images = []
+    for index in range(chain):
+        image = {
+            'virtual-size': 214748364800,
+            'filename': '/var/lib/libvirt/images/layer-{}.qcow2'.format(index),
+            'cluster-size': 65536,
+            'format': 'qcow2',
+            'actual-size': 340525056,
+            'format-specific': {
+                'type': 'qcow2',
+                'data': {'compat': '1.1', 'lazy-refcounts': False, 'refcount-bits': 16, 'corrupt': False}
+            },
+            'dirty-flag': False,
+        }
+        if index < chain - 1:
+            image['backing-filename'] = 'layer-{}.qcow2'.format(index + 1)
+            image['full-backing-filename'] = '/var/lib/libvirt/images/layer-{}.qcow2'.format(index + 1)
+        if snapshots:
+            image['snapshots'] = [{
+                'icount': 0,
+                'vm-clock-nsec': 290000000 + snap,
+                'name': 'snap-{}'.format(snap),
+                'date-sec': 1565000000 + snap * 3600,
+                'date-nsec': 434000000,
+                'vm-clock-sec': 12 + snap,
+                'id': str(snap + 1),
+                'vm-state-size': 1234 * snap,
+            } for snap in range(snapshots)]
+        images.append(image)
+    return json.dumps(images)
+
+
+def pools_caps(pools=16, values=8):
+    '''
+    Generate a storage pool capabilities XML document parsed as an ElementTree
+
+    :param pools: number of pool types
+    :param values: number of values in each format enum
+    '''
+    pool_nodes = []
+    for index in range(pools):
+        enum = ''.join("<value>format{}</value>".format(value) for value in range(values))
+        pool_nodes.append('''
+  <pool type='pool{index}' supported='{supported}'>
+    <poolOptions>
+      <defaultFormat type='format0'/>
+      <enum name='sourceFormatType'>{enum}</enum>
+    </poolOptions>
+    <volOptions>
+      <defaultFormat type='raw'/>
+      <enum name='targetFormatType'>{enum}</enum>
+    </volOptions>
+  </pool>'''.format(index=index, supported='yes' if index % 2 else 'no', enum=enum))
+    return ElementTree.fromstring('<storagepoolCapabilities>{}\n</storagepoolCapabilities>'.format(
+        ''.join(pool_nodes)))
+
+
+def capabilities_xml(cells=2, cpus=4):
+    '''
+    Generate a libvirt capabilities XML document
+
+    :param cells: number of NUMA cells
+    :param cpus: number of CPUs in each cell, hyperthreads siblings by pairs
+    '''
+    cell_nodes = []
+    for cell in range(cells):
+        cpu_nodes = ''.join(
+            "\n            <cpu id='{id}' socket_id='{cell}' die_id='0' core_id='{core}' siblings='{first}-{last}'/>"
+            .format(id=cell * cpus + cpu, cell=cell, core=cpu // 2,
+                    first=cell * cpus + cpu - cpu % 2, last=cell * cpus + cpu - cpu % 2 + 1)
+            for cpu in range(cpus))
+        distances = ''.join("<sibling id='{}' value='{}'/>".format(other, 10 if other == cell else 21)
+                            for other in range(cells))
+        cell_nodes.append('''
+        <cell id='{cell}'>
+          <memory unit='KiB'>16384000</memory>
+          <pages unit='KiB' size='4'>4000000</pages>
+          <pages unit='KiB' size='2048'>{cell}</pages>
+          <pages unit='KiB' size='1048576'>0</pages>
+          <distances>{distances}</distances>
+          <cpus num='{cpus}'>{cpu_nodes}
+          </cpus>
+        </cell>'''.format(cell=cell, cpus=cpus, distances=distances, cpu_nodes=cpu_nodes))
+    return '''<capabilities>
+  <host>
+    <uuid>4c4c4544-0043-3010-8058-b4c04f4b3232</uuid>
+    <cpu>
+      <arch>x86_64</arch>
+      <model>Skylake-Client-IBRS</model>
+      <vendor>Intel</vendor>
+      <topology sockets='{cells}' dies='1' cores='{cores}' threads='2'/>
+      <pages unit='KiB' size='4'/>
+      <pages unit='KiB' size='2048'/>
+      <pages unit='KiB' size='1048576'/>
+    </cpu>
+    <topology>
+      <cells num='{cells}'>{cell_nodes}
+      </cells>
+    </topology>
+  </host>
+  <guest>
+    <os_type>hvm</os_type>
+    <arch name='x86_64'>
+      <wordsize>64</wordsize>
+      <emulator>/usr/bin/qemu-system-x86_64</emulator>
+      <machine maxCpus='255'>pc-i440fx-4.2</machine>
+      <machine canonical='pc-i440fx-4.2' maxCpus='255'>pc</machine>
+      <machine maxCpus='288'>pc-q35-4.2</machine>
+      <domain type='qemu'/>
+      <domain type='kvm'>
+        <machine maxCpus='288'>pc-q35-5.0</machine>
+      </domain>
+    </arch>
+  </guest>
+  <guest>
+    <os_type>hvm</os_type>
+    <arch name='i686'>
+      <wordsize>32</wordsize>
+      <machine maxCpus='255'>pc-i440fx-4.2</machine>
+      <domain type='qemu'/>
+    </arch>
+  </guest>
+</capabilities>'''.format(cells=cells, cores=cpus // 2, cell_nodes=''.join(cell_nodes))
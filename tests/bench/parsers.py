@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+'''
+    tests.bench.parsers
+    ~~~~~~~~~~~~~~
+
+    Micro-benchmarks of the domain and node parsers.
+
+    Run from the repository root, no libvirt or hypervisor needed:
+
+    .. code-block:: bash
+
+        python -m tests.bench.parsers
+        python -m tests.bench.parsers --filter get_nics
+        python -m tests.bench.parsers --save
+
+    The results are compared to ``baseline.json`` and the command exits with an
+    error if a case is slower or allocates more memory than the baseline by more
+    than the tolerance. Since the figures depend on the machine, refresh the
+    baseline with ``--save`` before measuring a change on a new machine.
+'''
+
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+from xml.etree import ElementTree
+
+import virt.exec.virt.domain as domain
+import virt.exec.virt.node as node
+from tests.bench import corpus
+
+BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+
+def cases():
+    '''
+    Return the benchmark cases as a dict of name: callable
+    '''
+    ret = {}
+    for count in (1, 8, 64):
+        dom = corpus.FakeDomain(corpus.domain_xml(disks=count, nics=count))
+        ret['get_nics[{}]'.format(count)] = lambda dom=dom: domain._get_nics(dom)
+        ret['get_disks[{}]'.format(count)] = lambda dom=dom: domain._get_disks(dom)
+        ret['get_graphics[{}]'.format(count)] = lambda dom=dom: domain._get_graphics(dom)
+    for chain, snapshots in ((1, 0), (8, 0), (32, 0), (1, 128), (8, 16)):
+        data = corpus.qemu_img_json(chain=chain, snapshots=snapshots)
+        ret['parse_qemu_img_info[chain={},snapshots={}]'.format(chain, snapshots)] = \
+            lambda data=data: domain._parse_qemu_img_info(data)
+    for pools, values in ((16, 8), (256, 32)):
+        doc = corpus.pools_caps(pools=pools, values=values)
+        ret['parse_pools_caps[pools={},values={}]'.format(pools, values)] = \
+            lambda doc=doc: node._parse_pools_caps(doc)
+    for cells, cpus in ((1, 8), (4, 64)):
+        doc = ElementTree.fromstring(corpus.capabilities_xml(cells=cells, cpus=cpus))
+        ret['parse_capabilities[cells={},cpus={}]'.format(cells, cpus)] = \
+            lambda doc=doc: node._parse_capabilities(doc)
+    return ret
+
+
+def measure(func, min_time=0.2, repeat=5):
+    '''
+    Return the operations per second and the peak memory allocated by one call in bytes
+
+    The best rate of ``repeat`` rounds is kept to reduce the noise of the other processes.
+    '''
+    func()
+    best = 0.0
+    for _ in range(repeat):
+        iterations = 0
+        start = time.perf_counter()
+        elapsed = 0.0
+        while elapsed < min_time / repeat:
+            func()
+            iterations += 1
+            elapsed = time.perf_counter() - start
+        best = max(best, iterations / elapsed)
+
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak
+
+
+def compare(results, baseline, tolerance):
+    '''
+    Return the list of the cases regressing compared to the baseline
+    '''
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        if result['ops'] < baseline[name]['ops'] * (1 - tolerance):
+            regressions.append('{}: {:.0f} ops/s instead of {:.0f}'.format(name, result['ops'],
+                                                                          baseline[name]['ops']))
+        if result['peak'] > baseline[name]['peak'] * (1 + tolerance):
+            regressions.append('{}: {} bytes peak instead of {}'.format(name, result['peak'],
+                                                                        baseline[name]['peak']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the virt parsers')
+    parser.add_argument('--filter', default='', help='Only run the cases containing this string')
+    parser.add_argument('--save', action='store_true', help='Store the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.3,
+                        help='Accepted relative slow down before reporting a regression')
+    parser.add_argument('--min-time', type=float, default=0.2, help='Minimum duration of each case in seconds')
+    args = parser.parse_args()
+
+    baseline = {}
+    if os.path.exists(BASELINE):
+        with open(BASELINE) as fp_:
+            baseline = json.load(fp_)
+
+    results = {}
+    print('{:<45} {:>12} {:>12} {:>8} {:>12}'.format('case', 'ops/s', 'baseline', 'change', 'peak KiB'))
+    for name, func in cases().items():
+        if args.filter not in name:
+            continue
+        ops, peak = measure(func, args.min_time)
+        results[name] = {'ops': ops, 'peak': peak}
+        base = baseline.get(name, {}).get('ops')
+        print('{:<45} {:>12.0f} {:>12} {:>8} {:>12.1f}'.format(
+            name, ops,
+            '{:.0f}'.format(base) if base else '-',
+            '{:+.0%}'.format(ops / base - 1) if base else '-',
+            peak / 1024))
+
+    if args.save:
+        baseline.update(results)
+        with open(BASELINE, 'w') as fp_:
+            json.dump(baseline, fp_, indent=2, sort_keys=True)
+        return 0
+
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print('REGRESSION {}'.format(regression))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+'''
+    tests.bench.shards
+    ~~~~~~~~~~~~~~
+
+    Throughput of ``domain.info`` when sharding the domains across parallel
+    libvirt connections.
+
+    Needs the libvirt python bindings. The default ``test:///default`` driver
+    runs in process and shows the overhead of the sharding; point ``--uri`` to a
+    remote hypervisor, like ``qemu+ssh://host/system``, to see the effect of the
+    round trip time:
+
+    .. code-block:: bash
+
+        python -m tests.bench.shards
+        python -m tests.bench.shards --domains 500 --shards 1 2 4 8 16
+        python -m tests.bench.shards --uri test+tcp://host/default --no-define
+
+    With the test driver, the benchmark domains are defined before the runs and
+    undefined afterwards.
+'''
+
+import argparse
+import sys
+import time
+from unittest import mock
+
+import pop.hub
+from tests.bench import corpus
+
+DOMAIN_XML = '''<domain type='test'>
+  <name>bench-{index}</name>
+  <memory unit='KiB'>1048576</memory>
+  <vcpu>1</vcpu>
+  <os>
+    <type>hvm</type>
+  </os>
+  <devices>{devices}
+  </devices>
+</domain>'''
+
+
+def define_domains(conn, count):
+    '''
+    Define the benchmark domains and return them
+    '''
+    # The corpus domains have raw disks: no qemu-img call is measured
+    devices = corpus.domain_xml(disks=4, nics=2)
+    devices = devices[devices.index('<devices>') + len('<devices>'):devices.index('</devices>')]
+    return [conn.defineXML(DOMAIN_XML.format(index=index, devices=devices)) for index in range(count)]
+
+
+def measure(hub, uri, shards, rounds):
+    '''
+    Return the best number of domains per second and the number of domains over the rounds
+    '''
+    best = 0.0
+    domains = 0
+    for _ in range(rounds):
+        start = time.perf_counter()
+        info = hub.pop.loop.start(hub.exec.virt.domain.info(connection=uri, shards=shards))[0]
+        elapsed = time.perf_counter() - start
+        domains = len(info)
+        best = max(best, domains / elapsed)
+    return best, domains
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the domain.info sharding')
+    parser.add_argument('--uri', default='test:///default', help='libvirt URI to benchmark')
+    parser.add_argument('--domains', type=int, default=200, help='Number of domains to define')
+    parser.add_argument('--no-define', action='store_true', help='Use the existing domains')
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4, 8],
+                        help='Numbers of connections to measure, 0 to adapt to the latency')
+    parser.add_argument('--rounds', type=int, default=3, help='Number of rounds, the best one is kept')
+    args = parser.parse_args()
+
+    import libvirt  # pylint: disable=import-error
+
+    with mock.patch.object(sys, 'argv', sys.argv[:1]):
+        hub = pop.hub.Hub()
+        hub.pop.sub.add('virt.virt')
+
+    # The test driver state is shared by the connections of the process: keep this one open
+    conn = libvirt.open(args.uri)
+    defined = [] if args.no_define else define_domains(conn, args.domains)
+    try:
+        print('{:>8} {:>10} {:>12} {:>10}'.format('shards', 'domains', 'domains/s', 'speedup'))
+        reference = None
+        for shards in args.shards:
+            rate, domains = measure(hub, args.uri, shards, args.rounds)
+            reference = reference or rate
+            print('{:>8} {:>10} {:>12.1f} {:>9.2f}x'.format(shards, domains, rate, rate / reference))
+    finally:
+        for dom in defined:
+            dom.undefine()
+        conn.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
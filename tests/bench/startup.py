@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+'''
+    tests.bench.startup
+    ~~~~~~~~~~~~~~
+
+    Wall clock time of a ``virt`` command, with and without a ``virt --serve``
+    server answering it.
+
+    Needs the libvirt python bindings. The default ``test:///default`` driver
+    keeps the libvirt calls negligible:
+
+    .. code-block:: bash
+
+        python -m tests.bench.startup
+        python -m tests.bench.startup --rounds 20 --ref virt.domain.list_all
+'''
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+CODE = 'import sys; sys.argv = ["virt"] + sys.argv[1:]; import virt.scripts; virt.scripts.start()'
+
+
+def measure(env, args, rounds):
+    '''
+    Return the best wall clock time of the command over the rounds
+    '''
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', CODE] + args, env=env, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the virt command startup')
+    parser.add_argument('--uri', default='test:///default', help='libvirt URI to connect to')
+    parser.add_argument('--ref', default='virt.domain.list_all', help='exec function to run')
+    parser.add_argument('--rounds', type=int, default=10, help='Number of rounds, the best one is kept')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join([os.getcwd(), env.get('PYTHONPATH', '')])
+        env['VIRT_SOCKET'] = os.path.join(tmpdir, 'virt.sock')
+        command = ['--uri', args.uri, '--log-file', os.path.join(tmpdir, 'virt.log'), args.ref]
+
+        print('{:>10} {:>10}'.format('mode', 'seconds'))
+        print('{:>10} {:>10.3f}'.format('direct', measure(env, command, args.rounds)))
+
+        server = subprocess.Popen([sys.executable, '-c', CODE, '--serve', '--socket', env['VIRT_SOCKET'],
+                                   '--uri', args.uri, '--log-file', os.path.join(tmpdir, 'serve.log')],
+                                  env=env)
+        try:
+            for _ in range(100):
+                if os.path.exists(env['VIRT_SOCKET']):
+                    break
+                time.sleep(0.05)
+            print('{:>10} {:>10.3f}'.format('served', measure(env, [args.ref], args.rounds)))
+        finally:
+            server.terminate()
+            server.wait()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
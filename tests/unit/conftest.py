@@ -16,13 +16,15 @@ import pop.mods.pop.testing as testing
 
 
 @pytest.fixture('session')
-def _hub():
+def _hub(tmp_path_factory):
     # provides a full hub that is used as a reference by mock_hub
     hub = pop.hub.Hub()
     hub.pop.sub.add(dyne_name='grains')
     hub.grains.GRAINS = {}
 
-    with mock.patch.object(sys, 'argv', sys.argv[:1]):
+    # Keep the log file out of the source tree
+    log_file = str(tmp_path_factory.mktemp('log') / 'virt.log')
+    with mock.patch.object(sys, 'argv', sys.argv[:1] + ['--log-file', log_file]):
         hub.pop.sub.add('virt.virt')
 
     return hub
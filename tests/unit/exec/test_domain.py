@@ -0,0 +1,420 @@
+# Import python libs
+import asyncio
+import sys
+import threading
+from unittest.mock import patch, MagicMock
+import pytest
+
+# Import local libs
+import virt.exec.virt.domain
+from tests.bench import corpus
+
+# Import pop libs
+import pop.mods.pop.testing as testing
+
+
+def _mock_domains(mock_libvirt_conn, domains):
+    '''
+    Setup the connection mock to return the running domains
+    '''
+    by_id = {}
+    for id_, dom in enumerate(domains):
+        by_id[id_] = dom
+    mock_libvirt_conn.listDomainsID.return_value = list(by_id.keys())
+    mock_libvirt_conn.listDefinedDomains.return_value = []
+    mock_libvirt_conn.lookupByID.side_effect = lambda id_: by_id[id_]
+    mock_libvirt_conn.lookupByName.side_effect = lambda name: [dom for dom in domains if dom.name() == name][0]
+
+
+class LibvirtError(Exception):
+    def __init__(self, message, code):
+        super().__init__(message)
+        self.code = code
+
+    def get_error_code(self):
+        return self.code
+
+
+def _mock_domain(name):
+    dom = MagicMock()
+    dom.name.return_value = name
+    return dom
+
+
+class TestExecVirtDomain:
+    @pytest.mark.asyncio
+    async def test_agent_info(self, mock_hub: testing.MockHub, mock_libvirt_conn):
+        mock_libvirt = MagicMock()
+        mock_libvirt.libvirtError = LibvirtError
+        mock_libvirt.VIR_IP_ADDR_TYPE_IPV6 = 1
+
+        ok_dom = _mock_domain('vm01')
+        ok_dom.interfaceAddresses.return_value = {
+            'eth0': {
+                'hwaddr': '52:54:00:a1:b2:c3',
+                'addrs': [
+                    {'type': 0, 'addr': '192.168.122.10', 'prefix': 24},
+                    {'type': 1, 'addr': 'fe80::5054:ff:fea1:b2c3', 'prefix': 64},
+                ],
+            },
+        }
+        ok_dom.guestInfo.return_value = {
+            'fs.count': 1,
+            'fs.0.name': 'vda1',
+            'fs.0.mountpoint': '/',
+            'fs.0.fstype': 'xfs',
+            'fs.0.total-bytes': 1024,
+            'fs.0.used-bytes': 512,
+            'fs.0.disk.count': 1,
+            'fs.0.disk.0.alias': 'vda',
+        }
+
+        stuck = threading.Event()
+        stuck_dom = _mock_domain('vm02')
+        stuck_dom.interfaceAddresses.side_effect = lambda flags: stuck.wait() and {}
+
+        failed_dom = _mock_domain('vm03')
+        # VIR_ERR_AGENT_UNRESPONSIVE
+        failed_dom.interfaceAddresses.side_effect = LibvirtError('Guest agent is not responding', 86)
+
+        _mock_domains(mock_libvirt_conn, [ok_dom, stuck_dom, failed_dom])
+
+        try:
+            with patch.dict(sys.modules, {'libvirt': mock_libvirt}):
+                actual = await virt.exec.virt.domain.agent_info(mock_hub, timeout=0.1)
+            # Returned while the stuck agent query is still running
+            assert stuck_dom.interfaceAddresses.called
+        finally:
+            stuck.set()
+
+        assert actual['domains'] == {
+            'vm01': {
+                'interfaces': {
+                    'eth0': {
+                        'hwaddr': '52:54:00:a1:b2:c3',
+                        'addrs': [
+                            {'type': 'ipv4', 'addr': '192.168.122.10', 'prefix': 24},
+                            {'type': 'ipv6', 'addr': 'fe80::5054:ff:fea1:b2c3', 'prefix': 64},
+                        ],
+                    },
+                },
+                'filesystems': [
+                    {'name': 'vda1', 'mountpoint': '/', 'fstype': 'xfs', 'total-bytes': 1024, 'used-bytes': 512},
+                ],
+            },
+        }
+        assert actual['timeout'] == ['vm02']
+        assert actual['errors'] == {'vm03': 'Guest agent is not responding'}
+
+        # The other errors are not hidden
+        failed_dom.interfaceAddresses.side_effect = LibvirtError('Cannot recv data', 38)
+        _mock_domains(mock_libvirt_conn, [ok_dom, failed_dom])
+        with patch.dict(sys.modules, {'libvirt': mock_libvirt}):
+            with pytest.raises(LibvirtError):
+                await virt.exec.virt.domain.agent_info(mock_hub, timeout=0.1)
+
+    @pytest.mark.asyncio
+    async def test_agent_info_stuck(self, mock_hub: testing.MockHub, mock_libvirt_conn):
+        mock_libvirt = MagicMock()
+        mock_libvirt.libvirtError = LibvirtError
+        stuck = threading.Event()
+        stuck_doms = []
+        for name in ['vm01', 'vm02']:
+            dom = _mock_domain(name)
+            dom.interfaceAddresses.side_effect = lambda flags: stuck.wait() and {}
+            stuck_doms.append(dom)
+
+        # No agent data at all
+        empty_dom = _mock_domain('vm03')
+        empty_dom.interfaceAddresses.return_value = None
+        empty_dom.guestInfo.return_value = None
+
+        _mock_domains(mock_libvirt_conn, stuck_doms + [empty_dom])
+
+        try:
+            with patch.dict(sys.modules, {'libvirt': mock_libvirt}):
+                # The stuck agents hold the only slot: the other domains still get their turn
+                actual = await virt.exec.virt.domain.agent_info(mock_hub, timeout=0.1, workers=1)
+            assert all(dom.interfaceAddresses.called for dom in stuck_doms)
+        finally:
+            stuck.set()
+
+        assert actual['timeout'] == ['vm01', 'vm02']
+        assert actual['domains'] == {'vm03': {'interfaces': {}, 'filesystems': []}}
+        assert actual['errors'] == {}
+
+    def test_get_nics(self):
+        dom = corpus.FakeDomain(corpus.domain_xml(disks=0, nics=2, graphics=False))
+        actual = virt.exec.virt.domain._get_nics(dom)
+
+        assert sorted(actual.keys()) == ['52:54:00:00:00:01', '52:54:00:00:01:01']
+        nic = actual['52:54:00:00:01:01']
+        assert nic['type'] == 'network'
+        assert nic['model'] == 'virtio'
+        assert nic['target'] == 'vnet1'
+        assert nic['source'] == {'network': 'default',
+                                 'portid': '2a8d7b1c-0c0e-4b0b-b2b3-000000000001',
+                                 'bridge': 'virbr0'}
+        assert nic['driver'] == {'name': 'vhost', 'queues': '4'}
+        assert nic['address'] == {'type': 'pci', 'domain': '0x0000', 'bus': '0x02', 'slot': '0x00',
+                                  'function': '0x0'}
+        assert nic['virtualport'] == {'type': 'openvswitch'}
+
+    def test_get_disks(self):
+        dom = corpus.FakeDomain(corpus.domain_xml(disks=2, nics=0, graphics=False))
+        actual = virt.exec.virt.domain._get_disks(dom)
+
+        assert actual == {
+            'vdaa': {'file': '/var/lib/libvirt/images/vm-0.raw', 'type': 'disk'},
+            'vdab': {'file': '/var/lib/libvirt/images/vm-1.raw', 'type': 'disk'},
+        }
+
+    def test_get_graphics(self):
+        dom = corpus.FakeDomain(corpus.domain_xml(disks=0, nics=0))
+        assert virt.exec.virt.domain._get_graphics(dom) == {
+            'autoport': 'yes',
+            'keymap': 'en-us',
+            'listen': '0.0.0.0',
+            'port': '5900',
+            'type': 'vnc',
+        }
+
+        dom = corpus.FakeDomain(corpus.domain_xml(disks=0, nics=0, graphics=False))
+        assert virt.exec.virt.domain._get_graphics(dom)['type'] == 'None'
+
+    def test_parse_qemu_img_info(self):
+        actual = virt.exec.virt.domain._parse_qemu_img_info(corpus.qemu_img_json(chain=3, snapshots=2))
+
+        assert actual['file'] == '/var/lib/libvirt/images/layer-0.qcow2'
+        assert actual['file format'] == 'qcow2'
+        assert actual['disk size'] == 340525056
+        assert actual['virtual size'] == 214748364800
+        assert actual['cluster size'] == 65536
+        assert actual['backing file']['file'] == '/var/lib/libvirt/images/layer-1.qcow2'
+        assert actual['backing file']['backing file']['file'] == '/var/lib/libvirt/images/layer-2.qcow2'
+        assert 'backing file' not in actual['backing file']['backing file']
+        assert [snapshot['tag'] for snapshot in actual['snapshots']] == ['snap-0', 'snap-1']
+        assert actual['snapshots'][1]['id'] == '2'
+        assert actual['snapshots'][1]['vmsize'] == 1234
+        assert actual['snapshots'][1]['vmclock'] == '00:00:13.290000'
+
+    def test_template(self):
+        template = virt.exec.virt.domain._Template(
+            "<domain type='kvm'><name>{name}</name><memory unit='KiB'>{memory}</memory>"
+            "<devices><disk><source file='/srv/{name}.qcow2'/></disk></devices>"
+            "<description>{name}: web &amp; db {} {0} {\"tier\": 1}</description></domain>")
+        assert len(template.slots) == 4
+
+        actual = template.render({'name': 'web<1>"', 'memory': 1024})
+        assert actual == ('<domain type="kvm"><name>web&lt;1&gt;"</name><memory unit="KiB">1024</memory>'
+                          '<devices><disk><source file="/srv/web&lt;1&gt;&quot;.qcow2" /></disk></devices>'
+                          '<description>web&lt;1&gt;": web &amp; db {} {0} {"tier": 1}</description></domain>')
+
+        with pytest.raises(KeyError):
+            template.render({'name': 'web01'})
+
+    @pytest.mark.asyncio
+    async def test_provision(self, mock_hub: testing.MockHub, mock_libvirt_conn):
+        defined = {}
+
+        def _define(xml):
+            name = xml[xml.index('<name>') + 6:xml.index('</name>')]
+            if name == 'web03':
+                raise Exception('invalid definition')
+            defined[name] = xml
+            return _mock_domain(name)
+
+        mock_libvirt_conn.defineXML.side_effect = _define
+        try:
+            ret = await virt.exec.virt.domain.provision(
+                mock_hub,
+                "<domain type='kvm'><name>{name}</name><memory unit='KiB'>{memory}</memory></domain>",
+                dict({'web{:02d}'.format(index): {'memory': 1024 * index} for index in range(1, 6)}, web06={}),
+                workers=2)
+        finally:
+            mock_libvirt_conn.defineXML.side_effect = None
+
+        assert sorted(defined) == ['web01', 'web02', 'web04', 'web05']
+        assert '<memory unit="KiB">2048</memory>' in defined['web02']
+        assert ret['domains']['web01']['result']
+        assert set(ret['domains']['web01']['time']) == {'define', 'start', 'total'}
+        assert ret['domains']['web03'] == {
+            'result': False,
+            'error': 'invalid definition',
+            'time': {'define': ret['domains']['web03']['time']['define'],
+                     'total': ret['domains']['web03']['time']['total']},
+        }
+        # A missing value only fails its domain
+        assert ret['domains']['web06'] == {
+            'result': False,
+            'error': 'Missing template value: memory',
+            'time': {'total': 0},
+        }
+
+    @pytest.mark.asyncio
+    async def test_list(self, mock_hub: testing.MockHub, mock_libvirt_conn):
+        domains = []
+        for index, name in enumerate(['web03', 'db01', 'web01', 'web02', 'cache01']):
+            dom = _mock_domain(name)
+            dom.ID.return_value = -1 if name == 'web02' else 10 - index
+            dom.state.return_value = [{'web02': 5, 'db01': 3}.get(name, 1), 0]
+            dom.isActive.return_value = name != 'web02'
+            dom.isPersistent.return_value = name != 'cache01'
+            domains.append(dom)
+        mock_libvirt_conn.listAllDomains.side_effect = None
+        mock_libvirt_conn.listAllDomains.return_value = domains
+
+        actual = await virt.exec.virt.domain.list_(mock_hub, name='web*', state='running', persistent=True)
+        mock_libvirt_conn.listAllDomains.assert_called_with(16 | 4)
+        assert actual == ['web01', 'web02', 'web03']
+
+        actual = await virt.exec.virt.domain.list_(mock_hub, sort='id')
+        assert actual == ['cache01', 'web01', 'db01', 'web03', 'web02']
+
+        # The inactive domains stay last
+        actual = await virt.exec.virt.domain.list_(mock_hub, sort='id', reverse=True)
+        assert actual == ['web03', 'db01', 'web01', 'cache01', 'web02']
+
+        actual = await virt.exec.virt.domain.list_(mock_hub, reverse=True, limit=2, offset=1)
+        assert actual == ['web02', 'web01']
+
+        # Client side filtering for old drivers
+        def _list_all(flags):
+            if flags:
+                raise sys.modules['libvirt'].libvirtError('unsupported flags')
+            return domains
+        mock_libvirt_conn.listAllDomains.side_effect = _list_all
+        try:
+            actual = await virt.exec.virt.domain.list_(mock_hub, state='running', persistent=True, limit=1)
+            # Only the needed domains have been checked
+            assert not domains[3].state.called and not domains[0].state.called
+            # The paused domains are active too
+            active = await virt.exec.virt.domain.list_(mock_hub, state='active')
+            paused = await virt.exec.virt.domain.list_(mock_hub, state='paused')
+        finally:
+            mock_libvirt_conn.listAllDomains.side_effect = None
+        assert actual == ['web01']
+        assert active == ['cache01', 'db01', 'web01', 'web03']
+        assert paused == ['db01']
+
+        with pytest.raises(Exception):
+            await virt.exec.virt.domain.list_(mock_hub, state='sleeping')
+
+    def test_info_lean(self):
+        xml = corpus.domain_xml(disks=3, nics=2).replace('<devices>', '''<devices>
+    <disk type='file' device='cdrom'>
+      <target dev='hdc' bus='ide'/>
+    </disk>
+    <interface type='user'>
+      <model type='e1000'/>
+    </interface>''')
+        dom = _mock_domain('vm01')
+        dom.info.return_value = [1, 2048, 1024, 2, 123456789]
+        dom.XMLDesc.return_value = xml
+
+        actual = virt.exec.virt.domain._get_info_lean(dom)
+        assert actual == virt.exec.virt.domain._get_info(dom)
+        assert sorted(actual['disks']) == ['vdaa', 'vdab', 'vdac']
+        assert len(actual['nics']) == 2
+        assert actual['on_reboot'] == 'restart'
+
+    @pytest.mark.asyncio
+    async def test_info_spill(self, mock_hub: testing.MockHub):
+        import tracemalloc
+
+        xml = corpus.domain_xml(disks=4, nics=2)
+
+        class _Domain:
+            def __init__(self, name):
+                self._name = name
+
+            def name(self):
+                return self._name
+
+            def info(self):
+                return [1, 2048, 1024, 2, 123456789]
+
+            def XMLDesc(self, flags):
+                return xml
+
+        class _Conn:
+            def __init__(self, count):
+                self.count = count
+
+            def listDomainsID(self):
+                return range(self.count)
+
+            def listDefinedDomains(self):
+                return []
+
+            def lookupByID(self, id_):
+                return _Domain('vm{:05d}'.format(id_))
+
+            def lookupByName(self, name):
+                return _Domain(name)
+
+            def close(self):
+                pass
+
+        mock_hub.OPT = {'virt': {'uri': 'test:///default'}}
+        mock_hub.virt.shard.count.return_value = 1
+
+        async def _peak(count, spill):
+            mock_hub.exec.virt.util.get_conn.return_value = _Conn(count)
+            tracemalloc.start()
+            try:
+                ret = await virt.exec.virt.domain.info(mock_hub, shards=1, spill=spill)
+                return tracemalloc.get_traced_memory()[1], ret
+            finally:
+                tracemalloc.stop()
+
+        for spill in ('file', 'mmap'):
+            small, _ = await _peak(100, spill)
+            large, ret = await _peak(1000, spill)
+            try:
+                assert len(ret) == 1000
+                assert list(ret)[:2] == ['vm00000', 'vm00001']
+                assert ret['vm00042']['disks']['vdab']['file'] == '/var/lib/libvirt/images/vm-1.raw'
+                assert sorted(ret['vm00042']) == sorted(virt.exec.virt.domain._get_info(_Domain('vm')))
+                assert next(ret.lines()).startswith(b'{"name": "vm00000", "info": {')
+            finally:
+                ret.close()
+            dict_small, _ = await _peak(100, None)
+            dict_large, _ = await _peak(1000, None)
+            # Only the offsets of the spilled infos are kept in memory
+            assert large - small < (dict_large - dict_small) / 4
+
+    @pytest.mark.asyncio
+    async def test_info_empty(self, mock_hub: testing.MockHub, mock_libvirt_conn):
+        '''
+        Querying all the VMs fails the same way whether the domains are sharded or not
+        '''
+        _mock_domains(mock_libvirt_conn, [])
+        mock_libvirt_conn.listAllDomains.side_effect = None
+        mock_libvirt_conn.listAllDomains.return_value = []
+        mock_hub.OPT = {'virt': {'uri': 'test:///default'}}
+        for count in (1, 4):
+            mock_hub.virt.shard.count.return_value = count
+            with pytest.raises(Exception, match='No virtual machines found.'):
+                await virt.exec.virt.domain.info(mock_hub, shards=count)
+        mock_hub.virt.shard.apply.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_calls_off_loop(self, mock_hub: testing.MockHub, mock_libvirt_conn):
+        '''
+        The libvirt calls, possibly waiting for the governor, don't block the event loop
+        '''
+        _mock_domains(mock_libvirt_conn, [_mock_domain('vm01')])
+        # The call only returns once the event loop ran another task
+        loop_ran = threading.Event()
+        mock_libvirt_conn.listDomainsID.side_effect = lambda: loop_ran.wait(5) and [0]
+
+        async def _other_task():
+            loop_ran.set()
+
+        other = asyncio.ensure_future(_other_task())
+        try:
+            assert await virt.exec.virt.domain.list_all(mock_hub) == ['vm01']
+        finally:
+            mock_libvirt_conn.listDomainsID.side_effect = None
+        await other
@@ -1,9 +1,11 @@
 # Import python libs
+import sys
 from unittest.mock import patch, mock_open, MagicMock
 import pytest
 
 # Import local libs
 import virt.exec.virt.node
+from tests.bench import corpus
 
 # Import pop libs
 import pop.hub
@@ -44,3 +46,224 @@ class TestExecVirtNode:
             mock_hub.grains.GRAINS = {'ps': 'fakeps', 'virtual_subtype': 'Xen Dom0'}
             mock_hub.exec.cmd.run.return_value = {'stdout': ''}
             assert await virt.exec.virt.node.get_hypervisor(mock_hub) is None
+
+    def test_parse_pools_caps(self):
+        actual = virt.exec.virt.node._parse_pools_caps(corpus.pools_caps(pools=2, values=2))
+
+        assert actual == [
+            {
+                'name': 'pool0',
+                'supported': False,
+                'options': {
+                    'pool': {'default_format': 'format0', 'sourceFormatType': ['format0', 'format1']},
+                    'volume': {'default_format': 'raw', 'targetFormatType': ['format0', 'format1']},
+                },
+            },
+            {
+                'name': 'pool1',
+                'supported': True,
+                'options': {
+                    'pool': {'default_format': 'format0', 'sourceFormatType': ['format0', 'format1']},
+                    'volume': {'default_format': 'raw', 'targetFormatType': ['format0', 'format1']},
+                },
+            },
+        ]
+
+    @pytest.mark.asyncio
+    async def test_capacity(self, mock_hub: testing.MockHub, mock_libvirt_conn):
+        mock_hub.OPT = {'virt': {'uri': 'qemu:///system'}}
+        cache = {}
+        mock_hub.virt.cache.get.side_effect = lambda name, key: cache.get((name, key))
+        mock_hub.virt.cache.set.side_effect = lambda name, key, value, size: cache.__setitem__((name, key), value)
+        mock_libvirt_conn.getInfo.return_value = ['x86_64', 4096, 8, 2712, 2, 2, 4, 2]
+        def _dom(id_, numatune=''):
+            dom = MagicMock()
+            dom.ID.return_value = id_
+            dom.UUIDString.return_value = 'uuid-{}'.format(id_)
+            dom.XMLDesc.return_value = '<domain><numatune>{}</numatune></domain>'.format(numatune)
+            return dom
+
+        mock_libvirt_conn.getAllDomainStats.return_value = [
+            (_dom(1, "<memory mode='strict' nodeset='0'/>"),
+             {'state.state': 1, 'vcpu.current': 4, 'balloon.maximum': 2097152, 'balloon.current': 1048576}),
+            (_dom(2), {'state.state': 3, 'vcpu.current': 8, 'balloon.maximum': 1048576,
+                      'balloon.current': 1048576}),
+            (_dom(-1, "<memory nodeset='0-1,^0'/>"), {'state.state': 5, 'vcpu.maximum': 2, 'balloon.maximum': 4194304}),
+        ]
+        cells = [{'total': 2097152, 'free': 524288}, {'total': 2097152, 'free': 2097152}]
+        mock_libvirt_conn.getMemoryStats.side_effect = lambda cell: cells[cell]
+
+        with patch.dict(sys.modules, {'libvirt': MagicMock()}):
+            actual = await virt.exec.virt.node.capacity(mock_hub)
+            multi = await virt.exec.virt.node.capacity(mock_hub, connection=['qemu:///system', 'qemu+ssh://h2/system'])
+
+        assert actual == {
+            'cpus': 8,
+            'phymemory': 4096,
+            'domains': {'active': 2, 'inactive': 1},
+            'vcpus': {'active': 12, 'all': 14},
+            'vcpu_ratio': 1.5,
+            'memory': {'committed': 3145728, 'committed_all': 7340032, 'current': 2097152},
+            'memory_ratio': 0.75,
+            'numa': [
+                {'cell': 0, 'total': 2097152, 'free': 524288, 'committed': 2621440, 'pressure': 1.25},
+                {'cell': 1, 'total': 2097152, 'free': 2097152, 'committed': 524288, 'pressure': 0.25},
+            ],
+        }
+        assert multi == {'qemu:///system': actual, 'qemu+ssh://h2/system': actual}
+
+        # The definitions of the running domains are only read once per host, never for the stopped ones
+        doms = [dom for dom, _ in mock_libvirt_conn.getAllDomainStats.return_value]
+        assert [dom.XMLDesc.call_count for dom in doms] == [2, 2, 0]
+
+    @pytest.mark.asyncio
+    async def test_capabilities_topology(self, mock_hub: testing.MockHub, mock_libvirt_conn):
+        mock_hub.OPT = {'virt': {'uri': 'qemu:///system'}}
+        cache = {}
+        mock_hub.virt.cache.get.side_effect = lambda name, key: cache.get((name, key))
+        mock_hub.virt.cache.set.side_effect = lambda name, key, value: cache.__setitem__((name, key), value)
+        mock_libvirt_conn.getLibVersion.return_value = 6000000
+        mock_libvirt_conn.getCapabilities.reset_mock()
+        mock_libvirt_conn.getCapabilities.return_value = corpus.capabilities_xml(cells=2, cpus=4)
+        mock_libvirt_conn.getDomainCapabilities.return_value = '''<domainCapabilities>
+  <path>/usr/bin/qemu-system-x86_64</path>
+  <domain>kvm</domain>
+  <machine>pc-i440fx-4.2</machine>
+  <arch>x86_64</arch>
+  <vcpu max='255'/>
+  <cpu>
+    <mode name='host-passthrough' supported='yes'/>
+    <mode name='host-model' supported='yes'/>
+    <mode name='custom' supported='no'/>
+  </cpu>
+</domainCapabilities>'''
+
+        caps = await virt.exec.virt.node.capabilities(mock_hub)
+        assert caps['host'] == {
+            'arch': 'x86_64',
+            'model': 'Skylake-Client-IBRS',
+            'vendor': 'Intel',
+            'topology': {'sockets': 2, 'dies': 1, 'cores': 2, 'threads': 2},
+            'pages': [4, 2048, 1048576],
+        }
+        assert caps['guests']['x86_64'] == {
+            'os_types': ['hvm'],
+            'domain_types': ['qemu', 'kvm'],
+            'machines': ['pc-i440fx-4.2', 'pc', 'pc-q35-4.2', 'pc-q35-5.0'],
+        }
+        assert caps['guests']['i686']['machines'] == ['pc-i440fx-4.2']
+        assert caps['domain']['vcpu_max'] == 255
+        assert caps['domain']['cpu_modes'] == ['host-passthrough', 'host-model']
+
+        topology = await virt.exec.virt.node.topology(mock_hub)
+        assert topology['cpus'] == 8
+        assert topology['pages'] == {4: 8000000, 2048: 1, 1048576: 0}
+        assert topology['cells'][1]['distances'] == {0: 21, 1: 10}
+        assert topology['cells'][1]['cpus'][3] == {'id': 7, 'socket': 1, 'die': 0, 'core': 1, 'siblings': [6, 7]}
+
+        # Only parsed once
+        assert mock_libvirt_conn.getCapabilities.call_count == 1
+
+        # Changing a result doesn't alter the cached value
+        caps['host']['pages'].append(42)
+        topology['cells'][1]['distances'].clear()
+        assert (await virt.exec.virt.node.capabilities(mock_hub))['host']['pages'] == [4, 2048, 1048576]
+        assert (await virt.exec.virt.node.topology(mock_hub))['cells'][1]['distances'] == {0: 21, 1: 10}
+        assert mock_libvirt_conn.getCapabilities.call_count == 1
+
+        # A libvirt upgrade invalidates the cache
+        mock_libvirt_conn.getLibVersion.return_value = 6001000
+        await virt.exec.virt.node.topology(mock_hub)
+        assert mock_libvirt_conn.getCapabilities.call_count == 2
+
+    def test_parse_cpuset(self):
+        assert virt.exec.virt.node._parse_cpuset('0-3,8,10-11') == [0, 1, 2, 3, 8, 10, 11]
+        assert virt.exec.virt.node._parse_cpuset('') == []
+
+    @pytest.mark.asyncio
+    async def test_devices(self, mock_hub: testing.MockHub, mock_libvirt_conn):
+        mock_hub.OPT = {'virt': {'uri': 'qemu:///system'}}
+        cache = {}
+        mock_hub.virt.cache.get.side_effect = lambda name, key: cache.get((name, key))
+        mock_hub.virt.cache.set.side_effect = lambda name, key, value, size: cache.__setitem__((name, key), value)
+        mock_libvirt_conn.getLibVersion.return_value = 6000000
+
+        def _pci(bus, slot, function, extra=''):
+            return '''<device>
+  <name>pci_0000_{bus:02x}_{slot:02x}_{function}</name>
+  <parent>computer</parent>
+  <driver><name>ixgbe</name></driver>
+  <capability type='pci'>
+    <domain>0</domain><bus>{bus}</bus><slot>{slot}</slot><function>{function}</function>
+    <product id='0x10fb'>82599ES</product>
+    <vendor id='0x8086'>Intel Corporation</vendor>{extra}
+  </capability>
+</device>'''.format(bus=bus, slot=slot, function=function, extra=extra)
+
+        vf_addresses = ''.join("<address domain='0x0000' bus='0x3b' slot='0x10' function='0x{}'/>".format(vf)
+                               for vf in range(3))
+        xmls = [
+            _pci(0x3b, 0, 0, "<capability type='virt_functions' maxCount='64'>{}</capability>".format(vf_addresses)),
+            _pci(0x3b, 0x10, 0), _pci(0x3b, 0x10, 1), _pci(0x3b, 0x10, 2),
+            _pci(0x5e, 0, 0),
+            '''<device><name>net_ens1f0v2_52_54_00_00_00_02</name><parent>pci_0000_3b_10_2</parent>
+                 <capability type='net'><interface>ens1f0v2</interface></capability></device>''',
+            '''<device><name>mdev_4b20d080_1b54_4048_85b3_a6a62d165c01_0000_5e_00_0</name>
+                 <parent>pci_0000_5e_00_0</parent>
+                 <capability type='mdev'><type id='nvidia-63'/><uuid>4b20d080-1b54-4048-85b3-a6a62d165c01</uuid>
+                 </capability></device>''',
+            # Older libvirt: no uuid capability
+            '''<device><name>mdev_9c1e2a3b_0000_4000_8000_000000000001</name><parent>pci_0000_5e_00_0</parent>
+                 <capability type='mdev'><type id='nvidia-63'/></capability></device>''',
+        ]
+        node_devices = []
+        for xml in xmls:
+            device = MagicMock()
+            device.name.return_value = xml[xml.index('<name>') + 6:xml.index('</name>')]
+            device.XMLDesc.return_value = xml
+            node_devices.append(device)
+        mock_libvirt_conn.listAllDevices.return_value = node_devices
+
+        def _dom(name, devices):
+            dom = MagicMock()
+            dom.name.return_value = name
+            dom.XMLDesc.return_value = '<domain><name>{}</name><devices>{}</devices></domain>'.format(name, devices)
+            return dom
+        mock_libvirt_conn.listAllDomains.side_effect = None
+        mock_libvirt_conn.listAllDomains.return_value = [
+            _dom('vm01', "<hostdev mode='subsystem' type='pci'><source>"
+                         "<address domain='0x0000' bus='0x3b' slot='0x10' function='0x0'/></source></hostdev>"),
+            _dom('vm02', "<interface type='direct'><source dev='ens1f0v2' mode='passthrough'/></interface>"
+                         "<hostdev mode='subsystem' type='mdev'><source>"
+                         "<address uuid='4b20d080-1b54-4048-85b3-a6a62d165c01'/></source></hostdev>"),
+            _dom('vm03', "<interface type='network'><source network='default'/></interface>"
+                         "<hostdev mode='subsystem' type='mdev'><source>"
+                         "<address uuid='9C1E2A3B-0000-4000-8000-000000000001'/></source></hostdev>"),
+            _dom('vm04', "<interface type='direct'><source dev='ens1f0v2' mode='vepa'/></interface>"),
+        ]
+
+        actual = await virt.exec.virt.node.devices(mock_hub)
+        assert actual['physical_functions'] == {
+            'pci_0000_3b_00_0': {
+                'max': 64,
+                'assigned': {'pci_0000_3b_10_0': ['vm01'], 'pci_0000_3b_10_2': ['vm02', 'vm04']},
+                'free': ['pci_0000_3b_10_1'],
+            },
+        }
+        assert actual['devices']['pci_0000_3b_10_2']['interfaces'] == ['ens1f0v2']
+        assert actual['devices']['pci_0000_3b_00_0']['address'] == '0000:3b:00.0'
+        assert actual['devices']['pci_0000_5e_00_0']['domains'] == []
+        mdev = actual['devices']['mdev_4b20d080_1b54_4048_85b3_a6a62d165c01_0000_5e_00_0']
+        assert mdev['domains'] == ['vm02']
+        assert mdev['uuid'] == '4b20d080-1b54-4048-85b3-a6a62d165c01'
+        assert actual['devices']['mdev_9c1e2a3b_0000_4000_8000_000000000001']['domains'] == ['vm03']
+
+        assert actual['devices']['pci_0000_3b_10_0']['driver'] == 'ixgbe'
+
+        # The node devices descriptions are cached, but the PCI devices drivers are read again
+        node_devices[1].XMLDesc.return_value = xmls[1].replace('ixgbe', 'vfio-pci')
+        actual = await virt.exec.virt.node.devices(mock_hub)
+        assert actual['devices']['pci_0000_3b_10_0']['driver'] == 'vfio-pci'
+        assert actual['devices']['pci_0000_3b_10_1']['driver'] == 'ixgbe'
+        assert actual['physical_functions']['pci_0000_3b_00_0']['free'] == ['pci_0000_3b_10_1']
+        assert [device.XMLDesc.call_count for device in node_devices] == [2, 2, 2, 2, 2, 1, 1, 1]
@@ -0,0 +1,108 @@
+# Import python libs
+import time
+from unittest.mock import MagicMock
+import pytest
+
+# Import local libs
+import virt.exec.virt.snapshot
+
+# Import pop libs
+import pop.mods.pop.testing as testing
+
+SNAPSHOT_XML = '''<domainsnapshot>
+  <name>{name}</name>
+  <description>{name} snapshot</description>
+  <state>shutoff</state>
+  {parent}
+  <creationTime>{created}</creationTime>
+  <memory snapshot='{memory}'/>
+  <disks>
+    <disk name='vda' snapshot='{disk}' type='file'>
+      {source}
+    </disk>
+  </disks>
+  <domain type='kvm'><name>vm01</name></domain>
+</domainsnapshot>'''
+
+
+def _mock_snapshot(name, created, parent=None, external=False, current=False):
+    snap = MagicMock()
+    snap.getName.return_value = name
+    snap.isCurrent.return_value = current
+    snap.getXMLDesc.return_value = SNAPSHOT_XML.format(
+        name=name,
+        created=created,
+        parent='<parent><name>{}</name></parent>'.format(parent) if parent else '',
+        memory='no',
+        disk='external' if external else 'internal',
+        source="<source file='/srv/{}.qcow2'/>".format(name) if external else '',
+    )
+    return snap
+
+
+def _mock_domain(name, snapshots):
+    dom = MagicMock()
+    dom.name.return_value = name
+    dom.UUIDString.return_value = '{}-uuid'.format(name)
+    dom.listAllSnapshots.return_value = snapshots
+    return dom
+
+
+@pytest.fixture
+def snapshots(mock_hub: testing.MockHub, mock_libvirt_conn):
+    mock_hub.OPT = {'virt': {'uri': 'test:///default'}}
+    cache = {}
+    mock_hub.virt.cache.get.side_effect = lambda name, key: cache.get((name, key))
+    mock_hub.virt.cache.set.side_effect = lambda name, key, value, size: cache.__setitem__((name, key), value)
+    now = int(time.time())
+    vm01 = [
+        _mock_snapshot('base', now - 3 * 86400),
+        _mock_snapshot('upgrade', now - 86400, parent='base', current=True),
+        _mock_snapshot('test', now - 2 * 86400, parent='base'),
+        _mock_snapshot('backup', now - 3600, external=True),
+    ]
+    domains = [_mock_domain('vm01', vm01), _mock_domain('vm02', [])]
+    mock_libvirt_conn.listAllDomains.side_effect = None
+    mock_libvirt_conn.listAllDomains.return_value = domains
+    return domains
+
+
+class TestExecVirtSnapshot:
+    @pytest.mark.asyncio
+    async def test_tree(self, mock_hub: testing.MockHub, snapshots):
+        actual = await virt.exec.virt.snapshot.tree(mock_hub)
+        assert actual['vm02'] == []
+        roots = actual['vm01']
+        assert [root['name'] for root in roots] == ['base', 'backup']
+        assert [child['name'] for child in roots[0]['children']] == ['test', 'upgrade']
+        upgrade = roots[0]['children'][1]
+        assert upgrade['current']
+        assert upgrade['description'] == 'upgrade snapshot'
+        assert not upgrade['external']
+        assert roots[1]['external']
+        assert roots[1]['disks'] == {'vda': {'snapshot': 'external', 'source': '/srv/backup.qcow2'}}
+        assert 'parent' not in upgrade
+
+    @pytest.mark.asyncio
+    async def test_summary(self, mock_hub: testing.MockHub, snapshots):
+        actual = await virt.exec.virt.snapshot.summary(mock_hub, older_than=1.5 * 86400)
+        assert actual['count'] == 4
+        assert actual['domains']['vm02'] == {'count': 0, 'oldest': None, 'newest': None}
+        assert actual['domains']['vm01']['oldest'] == pytest.approx(3 * 86400, abs=5)
+        assert actual['domains']['vm01']['newest'] == pytest.approx(3600, abs=5)
+        assert actual['expired'] == {'vm01': ['base', 'test']}
+
+        # The creation times are cached
+        calls = snapshots[0].listAllSnapshots.return_value[0].getXMLDesc.call_count
+        await virt.exec.virt.snapshot.summary(mock_hub)
+        assert snapshots[0].listAllSnapshots.return_value[0].getXMLDesc.call_count == calls
+
+    @pytest.mark.asyncio
+    async def test_summary_recreated(self, mock_hub: testing.MockHub, snapshots):
+        await virt.exec.virt.snapshot.summary(mock_hub)
+
+        # The base snapshot is deleted and created again with the same name
+        snapshots[0].listAllSnapshots.return_value[0] = _mock_snapshot('base', int(time.time()) - 60)
+        actual = await virt.exec.virt.snapshot.summary(mock_hub, older_than=1.5 * 86400)
+        assert actual['expired'] == {'vm01': ['test']}
+        assert actual['domains']['vm01']['oldest'] == pytest.approx(2 * 86400, abs=5)
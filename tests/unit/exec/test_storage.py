@@ -0,0 +1,160 @@
+# Import python libs
+import asyncio
+import sys
+import threading
+import time
+from unittest.mock import patch, MagicMock
+import pytest
+
+# Import local libs
+import virt.exec.virt.storage
+
+# Import pop libs
+import pop.mods.pop.testing as testing
+
+BASE_XML = '''<volume type='file'>
+  <name>base.qcow2</name>
+  <target>
+    <path>/srv/images/base.qcow2</path>
+    <format type='qcow2'/>
+  </target>
+</volume>'''
+
+
+class LibvirtError(Exception):
+    def __init__(self, message, code):
+        super().__init__(message)
+        self.code = code
+
+    def get_error_code(self):
+        return self.code
+
+
+@pytest.fixture
+def storage_pool(mock_hub: testing.MockHub, mock_libvirt_conn):
+    mock_hub.OPT = {'virt': {'uri': 'test:///default', 'storage_pool_workers': 2}}
+    mock_hub.virt.STORAGE_SLOTS = {}
+    mock_hub.virt.STORAGE_WARM = {}
+    mock_hub.virt.STORAGE_WARM_PENDING = {}
+    mock_hub.virt.STORAGE_LOCK = threading.Lock()
+
+    base_vol = MagicMock()
+    base_vol.name.return_value = 'base.qcow2'
+    base_vol.path.return_value = '/srv/images/base.qcow2'
+    base_vol.XMLDesc.return_value = BASE_XML
+    base_vol.info.return_value = [0, 10737418240, 196608]
+
+    pool = MagicMock()
+    pool.created = []
+    pool.running = 0
+    pool.max_running = 0
+    lock = threading.Lock()
+
+    def _create(xml, flags):
+        with lock:
+            pool.running += 1
+            pool.max_running = max(pool.max_running, pool.running)
+        time.sleep(0.02)
+        with lock:
+            pool.running -= 1
+            pool.created.append(xml)
+        name = xml[xml.index('<name>') + 6:xml.index('</name>')]
+        if name == 'broken':
+            raise Exception('no space left')
+        vol = MagicMock()
+        vol.path.return_value = '/srv/images/{}'.format(name)
+        return vol
+
+    pool.createXML.side_effect = _create
+    pool.createXMLFrom.side_effect = lambda xml, base, flags: _create(xml, flags)
+    pool.storageVolLookupByName.return_value = base_vol
+    mock_libvirt_conn.storagePoolLookupByName.return_value = pool
+    mock_libvirt = MagicMock()
+    mock_libvirt.libvirtError = LibvirtError
+    with patch.dict(sys.modules, {'libvirt': mock_libvirt}):
+        yield pool
+    mock_libvirt_conn.storagePoolLookupByName.reset_mock()
+
+
+class TestExecVirtStorage:
+    @pytest.mark.asyncio
+    async def test_overlays(self, mock_hub: testing.MockHub, storage_pool):
+        names = ['web{:02d}'.format(index) for index in range(6)] + ['broken']
+        ret = await virt.exec.virt.storage.overlays(mock_hub, 'default', 'base.qcow2', names)
+
+        assert storage_pool.max_running == 2
+        assert sorted(ret) == sorted(names)
+        assert ret['web01']['result']
+        assert ret['web01']['path'] == '/srv/images/web01'
+        assert ret['broken']['result'] is False
+        assert ret['broken']['error'] == 'no space left'
+        xml = storage_pool.created[0]
+        assert "<capacity unit='bytes'>10737418240</capacity>" in xml
+        assert '<path>/srv/images/base.qcow2</path>' in xml
+        assert not storage_pool.createXMLFrom.called
+
+    @pytest.mark.asyncio
+    async def test_overlays_full(self, mock_hub: testing.MockHub, storage_pool):
+        ret = await virt.exec.virt.storage.overlays(mock_hub, 'default', 'base.qcow2', ['web01'],
+                                                    capacity=1024, full=True)
+        assert ret['web01']['result']
+        assert storage_pool.createXMLFrom.called
+        assert 'backingStore' not in storage_pool.created[0]
+        assert "<capacity unit='bytes'>1024</capacity>" in storage_pool.created[0]
+
+    @pytest.mark.asyncio
+    async def test_warm(self, mock_hub: testing.MockHub, storage_pool):
+        ret = await virt.exec.virt.storage.warm(mock_hub, 'default', 'base.qcow2', 3)
+        assert ret['available'] == 3
+        assert len(ret['created']) == 3
+        assert all(name.startswith('warm-base.qcow2-') for name in ret['created'])
+
+        ret = await virt.exec.virt.storage.overlays(mock_hub, 'default', 'base.qcow2', ['web01', 'web02'],
+                                                    warm=True)
+        assert ret['web01']['warm'] and ret['web02']['warm']
+        assert ret['web01']['name'].startswith('warm-base.qcow2-')
+        assert len(storage_pool.created) == 3
+
+        # Only the overlays prepared with the same capacity and full values are used
+        ret = await virt.exec.virt.storage.overlays(mock_hub, 'default', 'base.qcow2', ['web03'],
+                                                    capacity=1024, warm=True)
+        assert not ret['web03']['warm']
+        ret = await virt.exec.virt.storage.overlays(mock_hub, 'default', 'base.qcow2', ['web04'],
+                                                    full=True, warm=True)
+        assert not ret['web04']['warm']
+
+        ret = await virt.exec.virt.storage.warm(mock_hub, 'default', 'base.qcow2', 0)
+        assert ret['available'] == 0
+        assert len(ret['deleted']) == 1
+        assert ret['errors'] == {}
+
+    @pytest.mark.asyncio
+    async def test_warm_concurrent(self, mock_hub: testing.MockHub, storage_pool):
+        rets = await asyncio.gather(*[virt.exec.virt.storage.warm(mock_hub, 'default', 'base.qcow2', 3)
+                                      for _ in range(2)])
+        assert sum(len(ret['created']) for ret in rets) == 3
+        assert len(storage_pool.created) == 3
+        assert mock_hub.virt.STORAGE_WARM_PENDING == {}
+
+    @pytest.mark.asyncio
+    async def test_warm_delete_errors(self, mock_hub: testing.MockHub, storage_pool):
+        await virt.exec.virt.storage.warm(mock_hub, 'default', 'base.qcow2', 3)
+        base_vol = storage_pool.storageVolLookupByName.return_value
+        volumes = {}
+
+        def _lookup(name):
+            if name == 'base.qcow2':
+                return base_vol
+            vol = MagicMock()
+            if name in volumes:
+                vol.delete.side_effect = volumes[name]
+            return vol
+        storage_pool.storageVolLookupByName.side_effect = _lookup
+        names = [name for name, _ in next(iter(mock_hub.virt.STORAGE_WARM.values()))]
+        # VIR_ERR_NO_STORAGE_VOL and VIR_ERR_OPERATION_FAILED
+        volumes[names[0]] = LibvirtError('Storage volume not found', 50)
+        volumes[names[1]] = LibvirtError('Volume in use', 9)
+
+        ret = await virt.exec.virt.storage.warm(mock_hub, 'default', 'base.qcow2', 0)
+        assert ret['deleted'] == [names[2]]
+        assert ret['errors'] == {names[1]: 'Volume in use'}
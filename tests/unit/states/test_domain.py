@@ -0,0 +1,215 @@
+# Import python libs
+import sys
+import uuid
+from unittest.mock import patch, MagicMock
+from xml.etree import ElementTree
+import pytest
+
+# Import local libs
+import virt.states.virt.domain
+
+# Import pop libs
+import pop.mods.pop.testing as testing
+
+DOMAIN_XML = '''<domain type='kvm'>
+  <name>{}</name>
+  <memory unit='KiB'>{}</memory>
+  <vcpu>1</vcpu>
+</domain>'''
+
+
+class LibvirtError(Exception):
+    def get_error_code(self):
+        return 42
+
+
+class FakeDomain:
+    '''
+    Domain mimicking the libvirt definitions normalization and metadata
+    '''
+    def __init__(self, xml):
+        self.xml = ElementTree.fromstring(xml)
+        if self.xml.find('uuid') is None:
+            ElementTree.SubElement(self.xml, 'uuid').text = str(uuid.uuid4())
+        self.active = False
+        self.paused = False
+        self.calls = []
+
+    def XMLDesc(self, flags=0):
+        return ElementTree.tostring(self.xml, encoding='unicode')
+
+    def UUIDString(self):
+        return self.xml.find('uuid').text
+
+    def setMetadata(self, type_, metadata, key, uri, flags):
+        node = ElementTree.fromstring(metadata)
+        node.tag = '{{{}}}{}'.format(uri, node.tag)
+        container = self.xml.find('metadata')
+        if container is None:
+            container = ElementTree.SubElement(self.xml, 'metadata')
+        for old in container.findall(node.tag):
+            container.remove(old)
+        container.append(node)
+
+    def isActive(self):
+        return self.active
+
+    def state(self):
+        if not self.active:
+            return [5, 0]
+        return [3 if self.paused else 1, 0]
+
+    def create(self):
+        self.calls.append('create')
+        self.active = True
+
+    def resume(self):
+        self.calls.append('resume')
+        self.paused = False
+
+    def destroy(self):
+        self.calls.append('destroy')
+        self.active = False
+        self.paused = False
+
+    def undefineFlags(self, flags):
+        self.calls.append(('undefineFlags', flags))
+
+
+class FakeConnection:
+    def __init__(self):
+        self.domains = {}
+        self.defined = []
+
+    def lookupByName(self, name):
+        if name not in self.domains:
+            raise LibvirtError('no domain')
+        return self.domains[name]
+
+    def defineXML(self, xml):
+        dom = FakeDomain(xml)
+        name = dom.xml.find('name').text
+        if name in self.domains:
+            if self.domains[name].UUIDString() != dom.UUIDString():
+                raise LibvirtError("domain '{}' already exists with uuid {}".format(
+                    name, self.domains[name].UUIDString()))
+            dom.active = self.domains[name].active
+        self.domains[name] = dom
+        self.defined.append(name)
+        return dom
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def fake_conn(mock_hub: testing.MockHub):
+    conn = FakeConnection()
+    mock_hub.exec.virt.util.get_conn.return_value = conn
+    cache = {}
+    mock_hub.virt.cache.get.side_effect = lambda name, key: cache.get((name, key))
+    mock_hub.virt.cache.set.side_effect = lambda name, key, value: cache.__setitem__((name, key), value)
+
+    async def _run_lifecycle(func, *args):
+        return func(*args)
+    mock_hub.virt.governor.run_lifecycle.side_effect = _run_lifecycle
+    mock_libvirt = MagicMock()
+    mock_libvirt.libvirtError = LibvirtError
+    with patch.dict(sys.modules, {'libvirt': mock_libvirt}):
+        yield conn
+
+
+class TestStatesVirtDomain:
+    @pytest.mark.asyncio
+    async def test_present(self, mock_hub: testing.MockHub, fake_conn):
+        ctx = {'test': False}
+        ret = await virt.states.virt.domain.present(mock_hub, ctx, 'vm01', DOMAIN_XML.format('vm01', 1024))
+        assert ret['result'] is True
+        assert ret['changes']['definition']['old'] is None
+        assert fake_conn.defined == ['vm01']
+
+        # Unchanged despite the libvirt additions, only the XML is fetched
+        ret = await virt.states.virt.domain.present(mock_hub, ctx, 'vm01', DOMAIN_XML.format('vm01', 1024))
+        assert ret == {'name': 'vm01', 'changes': {}, 'result': True, 'comment': 'Domain vm01 is already defined'}
+        assert fake_conn.defined == ['vm01']
+
+        # Whitespace and attributes order are not changes
+        ret = await virt.states.virt.domain.present(
+            mock_hub, ctx, 'vm01', "<domain type='kvm'><name>vm01</name><memory unit='KiB'> 1024 </memory>"
+                                   "<vcpu>1</vcpu></domain>")
+        assert not ret['changes']
+
+        # Changes in test mode
+        ret = await virt.states.virt.domain.present(
+            mock_hub, {'test': True}, 'vm01', DOMAIN_XML.format('vm01', 2048))
+        assert ret['result'] is None
+        assert ret['changes']
+        assert fake_conn.defined == ['vm01']
+
+        domain_uuid = fake_conn.domains['vm01'].UUIDString()
+        ret = await virt.states.virt.domain.present(mock_hub, ctx, 'vm01', DOMAIN_XML.format('vm01', 2048))
+        assert ret['result'] is True
+        assert ret['comment'] == 'Domain vm01 updated'
+        assert fake_conn.defined == ['vm01', 'vm01']
+        # The domain is redefined with its UUID, not a new one
+        assert fake_conn.domains['vm01'].UUIDString() == domain_uuid
+
+        # Modified outside of the state
+        fake_conn.domains['vm01'].xml.find('vcpu').text = '4'
+        ret = await virt.states.virt.domain.present(mock_hub, ctx, 'vm01', DOMAIN_XML.format('vm01', 2048))
+        assert ret['changes']
+        assert fake_conn.defined == ['vm01', 'vm01', 'vm01']
+
+    @pytest.mark.asyncio
+    async def test_running_absent(self, mock_hub: testing.MockHub, fake_conn):
+        ctx = {'test': False}
+        ret = await virt.states.virt.domain.running(mock_hub, ctx, 'vm01')
+        assert ret['result'] is False
+        assert ret['comment'] == 'Domain vm01 is not defined'
+
+        ret = await virt.states.virt.domain.running(mock_hub, ctx, 'vm01', DOMAIN_XML.format('vm01', 1024))
+        assert ret['result'] is True
+        assert ret['changes']['state'] == {'old': 'shutdown', 'new': 'running'}
+        assert fake_conn.domains['vm01'].calls == ['create']
+
+        ret = await virt.states.virt.domain.running(mock_hub, ctx, 'vm01', DOMAIN_XML.format('vm01', 1024))
+        assert not ret['changes']
+
+        # A paused domain is resumed, not started again
+        fake_conn.domains['vm01'].paused = True
+        ret = await virt.states.virt.domain.running(mock_hub, {'test': True}, 'vm01')
+        assert ret['result'] is None
+        assert ret['changes']['state'] == {'old': 'paused', 'new': 'running'}
+        assert ret['comment'] == 'Domain vm01 would be resumed'
+        assert fake_conn.domains['vm01'].calls == ['create']
+
+        ret = await virt.states.virt.domain.running(mock_hub, ctx, 'vm01')
+        assert ret['result'] is True
+        assert ret['comment'] == 'Domain vm01 resumed'
+        assert fake_conn.domains['vm01'].calls == ['create', 'resume']
+
+        ret = await virt.states.virt.domain.absent(mock_hub, {'test': True}, 'vm01')
+        assert ret['result'] is None
+        assert fake_conn.domains['vm01'].calls == ['create', 'resume']
+
+        # The managed save, snapshots, NVRAM and checkpoints would make a plain undefine fail
+        ret = await virt.states.virt.domain.absent(mock_hub, ctx, 'vm01')
+        assert ret['result'] is True
+        assert fake_conn.domains['vm01'].calls == ['create', 'resume', 'destroy', ('undefineFlags', 1 | 2 | 4 | 16)]
+
+        ret = await virt.states.virt.domain.absent(mock_hub, ctx, 'vm02')
+        assert ret['comment'] == 'Domain vm02 is already absent'
+
+    @pytest.mark.asyncio
+    async def test_batch_present(self, mock_hub: testing.MockHub, fake_conn):
+        ctx = {'test': False}
+        domains = {'vm{:02d}'.format(index): DOMAIN_XML.format('ignored', 1024) for index in range(20)}
+        ret = await virt.states.virt.domain.batch_present(mock_hub, ctx, 'farm', domains, start=True, workers=4)
+        assert ret['result'] is True
+        assert ret['comment'] == '20 of 20 domains changed'
+        assert sorted(fake_conn.domains) == sorted(domains)
+        assert all(dom.active for dom in fake_conn.domains.values())
+
+        ret = await virt.states.virt.domain.batch_present(mock_hub, ctx, 'farm', domains, start=True)
+        assert ret == {'name': 'farm', 'changes': {}, 'result': True,
+                       'comment': 'All 20 domains are in the correct state'}
@@ -0,0 +1,120 @@
+# Import python libs
+import json
+import os
+import stat
+import subprocess
+import sys
+import time
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+LIBVIRT_STUB = '''
+VIR_CRED_AUTHNAME = 2
+VIR_CRED_ECHOPROMPT = 6
+VIR_CRED_NOECHOPROMPT = 7
+VIR_CRED_PASSPHRASE = 8
+VIR_CRED_EXTERNAL = 9
+
+
+class virDomain:
+    def __init__(self, name):
+        self._name = name
+
+    def name(self):
+        return self._name
+
+
+class virConnect:
+    def listDomainsID(self):
+        return [1, 2]
+
+    def lookupByID(self, id_):
+        return virDomain('vm{}'.format(id_))
+
+    def listDefinedDomains(self):
+        return ['vm3']
+
+    def lookupByName(self, name):
+        return virDomain(name)
+
+    def isAlive(self):
+        return 1
+
+    def close(self):
+        return 0
+
+
+def openAuth(uri, auth, flags):
+    return virConnect()
+'''
+
+
+@pytest.fixture
+def cli_env(tmpdir, monkeypatch):
+    # The commands write their virt.log file in the current directory
+    monkeypatch.chdir(tmpdir)
+    tmpdir.join('libvirt.py').write(LIBVIRT_STUB)
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([str(tmpdir), ROOT_DIR])
+    env['VIRT_SOCKET'] = str(tmpdir.join('virt.sock'))
+    return env
+
+
+CODE = 'import sys; sys.argv = ["virt"] + sys.argv[1:]; import virt.scripts; virt.scripts.start()'
+
+
+def _run(env, *args):
+    code = CODE
+    return subprocess.run([sys.executable, '-X', 'importtime', '-c', code] + list(args),
+                          env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          universal_newlines=True)
+
+
+def _imported(stderr):
+    return [line.split('|')[-1].strip() for line in stderr.splitlines() if line.startswith('import time:')]
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7), reason='-X importtime requires python 3.7')
+class TestScripts:
+    def test_lazy_imports(self, cli_env):
+        proc = _run(cli_env)
+        assert proc.returncode == 0, proc.stderr
+
+        imported = _imported(proc.stderr)
+        assert 'libvirt' not in imported
+
+    def test_list_all(self, cli_env):
+        proc = _run(cli_env, 'virt.domain.list_all')
+
+        assert proc.returncode == 0, proc.stderr
+        assert json.loads(proc.stdout) == ['vm1', 'vm2', 'vm3']
+        imported = _imported(proc.stderr)
+        assert 'libvirt' in imported
+        # The heavy optional modules are only imported by the functions using them
+        assert 'numpy' not in imported
+
+    def test_serve(self, cli_env):
+        server = subprocess.Popen([sys.executable, '-c', CODE, '--serve', '--socket', cli_env['VIRT_SOCKET']],
+                                  env=cli_env)
+        try:
+            for _ in range(100):
+                if os.path.exists(cli_env['VIRT_SOCKET']):
+                    break
+                time.sleep(0.05)
+
+            assert stat.S_IMODE(os.stat(cli_env['VIRT_SOCKET']).st_mode) == 0o600
+
+            proc = _run(cli_env, 'virt.domain.list_all')
+            assert proc.returncode == 0, proc.stderr
+            assert json.loads(proc.stdout) == ['vm1', 'vm2', 'vm3']
+            # The thin client doesn't need the hub nor libvirt
+            imported = _imported(proc.stderr)
+            assert 'pop.hub' not in imported
+            assert 'libvirt' not in imported
+
+            proc = _run(cli_env, 'virt.domain.missing')
+            assert proc.returncode == 1
+        finally:
+            server.terminate()
+            server.wait()
@@ -0,0 +1,24 @@
+# Import local libs
+import virt.virt.cache
+
+# Import pop libs
+import pop.mods.pop.testing as testing
+
+
+class TestVirtCache:
+    def test_lru(self, mock_hub: testing.MockHub):
+        mock_hub.virt.CACHES = {}
+        mock_hub.virt.CACHES_LOCK = virt.virt.cache.threading.Lock()
+
+        for key in range(3):
+            virt.virt.cache.set(mock_hub, 'test', key, key * 10, size=2)
+        assert virt.virt.cache.get(mock_hub, 'test', 0) is None
+        assert virt.virt.cache.get(mock_hub, 'test', 1) == 10
+
+        # 1 was used last: 2 is evicted
+        virt.virt.cache.set(mock_hub, 'test', 3, 30, size=2)
+        assert virt.virt.cache.get(mock_hub, 'test', 2, default='missing') == 'missing'
+        assert virt.virt.cache.get(mock_hub, 'test', 1) == 10
+
+        virt.virt.cache.clear(mock_hub, 'test')
+        assert virt.virt.cache.get(mock_hub, 'test', 1) is None
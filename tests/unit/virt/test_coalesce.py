@@ -0,0 +1,139 @@
+# Import python libs
+import asyncio
+import inspect
+from unittest.mock import MagicMock
+import pytest
+
+# Import local libs
+import virt.exec.virt.contracts.coalesce
+import virt.exec.virt.domain
+import virt.virt.coalesce
+
+# Import pop libs
+import pop.mods.pop.testing as testing
+
+
+@pytest.fixture
+def coalesce_hub(mock_hub: testing.MockHub):
+    cache = {}
+    mock_hub.OPT = {'virt': {'coalesce_ttl': 1.0, 'coalesce_exclude': ['virt.domain.state']}}
+    mock_hub.virt.COALESCE_INFLIGHT = {}
+    mock_hub.virt.COALESCE_STATS = {'executions': 0, 'shared': 0, 'reused': 0}
+    mock_hub.virt.cache.get.side_effect = lambda name, key: cache.get((name, key))
+    mock_hub.virt.cache.set.side_effect = lambda name, key, value, size: cache.__setitem__((name, key), value)
+    mock_hub.virt.cache.clear.side_effect = lambda name: cache.clear()
+    return mock_hub
+
+
+def _counting(calls, delay=0.05, error=None):
+    async def _func():
+        calls.append(None)
+        await asyncio.sleep(delay)
+        if error:
+            raise error
+        return {'vm01': {'state': 'running'}, 'calls': len(calls)}
+    return _func
+
+
+class TestVirtCoalesce:
+    @pytest.mark.asyncio
+    async def test_inflight(self, coalesce_hub):
+        calls = []
+        func = _counting(calls)
+        results = await asyncio.gather(
+            *[virt.virt.coalesce.run(coalesce_hub, 'virt.domain.info', {'vm_': None}, func) for _ in range(5)],
+            virt.virt.coalesce.run(coalesce_hub, 'virt.domain.info', {'vm_': 'vm01'}, func))
+        assert len(calls) == 2
+        assert all(result == results[0] for result in results[:5])
+        # Each caller gets its own copy
+        assert len({id(result) for result in results}) == 6
+        assert coalesce_hub.virt.COALESCE_INFLIGHT == {}
+        assert virt.virt.coalesce.stats(coalesce_hub) == {'executions': 2, 'shared': 4, 'reused': 0}
+
+    @pytest.mark.asyncio
+    async def test_ttl(self, coalesce_hub):
+        calls = []
+        func = _counting(calls, delay=0)
+        first = await virt.virt.coalesce.run(coalesce_hub, 'virt.node.info', {}, func)
+        first['vm01']['state'] = 'modified by the caller'
+        reused = await virt.virt.coalesce.run(coalesce_hub, 'virt.node.info', {}, func)
+        assert reused == {'vm01': {'state': 'running'}, 'calls': 1}
+        assert len(calls) == 1
+
+        virt.virt.coalesce.clear(coalesce_hub)
+        assert (await virt.virt.coalesce.run(coalesce_hub, 'virt.node.info', {}, func))['calls'] == 2
+        assert len(calls) == 2
+
+        coalesce_hub.OPT['virt']['coalesce_ttl'] = 0
+        virt.virt.coalesce.clear(coalesce_hub)
+        await virt.virt.coalesce.run(coalesce_hub, 'virt.node.info', {}, func)
+        await virt.virt.coalesce.run(coalesce_hub, 'virt.node.info', {}, func)
+        assert len(calls) == 4
+
+    @pytest.mark.asyncio
+    async def test_exclude(self, coalesce_hub):
+        calls = []
+        func = _counting(calls)
+        await asyncio.gather(*[virt.virt.coalesce.run(coalesce_hub, 'virt.domain.state', {}, func) for _ in range(3)])
+        assert len(calls) == 3
+
+    @pytest.mark.asyncio
+    async def test_error(self, coalesce_hub):
+        calls = []
+        func = _counting(calls, error=Exception('libvirt is down'))
+        results = await asyncio.gather(
+            *[virt.virt.coalesce.run(coalesce_hub, 'virt.domain.info', {}, func) for _ in range(3)],
+            return_exceptions=True)
+        assert len(calls) == 1
+        assert [str(result) for result in results] == ['libvirt is down'] * 3
+
+        # Errors are not reused
+        with pytest.raises(Exception):
+            await virt.virt.coalesce.run(coalesce_hub, 'virt.domain.info', {}, func)
+        assert len(calls) == 2
+
+    @pytest.mark.asyncio
+    async def test_contract_spill(self, coalesce_hub):
+        calls = []
+
+        async def info(hub, vm_=None, spill=None):
+            calls.append(spill)
+            return {}
+
+        def _ctx(**kwargs):
+            ctx = MagicMock()
+            ctx.func = info
+            ctx.args = [coalesce_hub]
+            ctx.kwargs = kwargs
+            ctx.get_arguments.return_value = inspect.signature(info).bind(coalesce_hub, **kwargs).arguments
+            return ctx
+
+        async def _run(*args):
+            return await virt.virt.coalesce.run(coalesce_hub, *args)
+
+        coalesce_hub.virt.coalesce.run.side_effect = _run
+        await asyncio.gather(*[virt.exec.virt.contracts.coalesce.call_info(coalesce_hub, _ctx()) for _ in range(2)])
+        assert len(calls) == 1
+
+        # The spilled infos own a temporary file: never shared
+        await asyncio.gather(*[virt.exec.virt.contracts.coalesce.call_info(coalesce_hub, _ctx(spill='file'))
+                               for _ in range(2)])
+        assert calls == [None, 'file', 'file']
+
+    @pytest.mark.asyncio
+    async def test_contract_alias(self, coalesce_hub):
+        refs = []
+
+        async def _run(ref, arguments, func):
+            refs.append(ref)
+            return await func()
+
+        coalesce_hub.virt.coalesce.run.side_effect = _run
+        ctx = MagicMock()
+        ctx.func = virt.exec.virt.domain.list_
+        ctx.args = [coalesce_hub]
+        ctx.kwargs = {}
+        ctx.get_arguments.return_value = {'hub': coalesce_hub}
+        coalesce_hub.exec.virt.util.get_conn.return_value.listAllDomains.return_value = []
+        await virt.exec.virt.contracts.coalesce.call(coalesce_hub, ctx)
+        assert refs == ['virt.domain.list']
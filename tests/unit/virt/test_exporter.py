@@ -0,0 +1,108 @@
+# Import python libs
+import asyncio
+import time
+from unittest.mock import MagicMock
+import pytest
+
+# Import local libs
+import virt.virt.exporter
+
+# Import pop libs
+import pop.mods.pop.testing as testing
+
+
+def _mock_domain(name, uuid):
+    dom = MagicMock()
+    dom.name.return_value = name
+    dom.UUIDString.return_value = uuid
+    return dom
+
+
+async def _get(port, headers=''):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write('GET /metrics HTTP/1.1\r\nHost: localhost\r\n{}\r\n'.format(headers).encode())
+    data = await reader.read()
+    writer.close()
+    head, _, body = data.partition(b'\r\n\r\n')
+    # Decode the chunked body
+    text = b''
+    while body:
+        size, _, body = body.partition(b'\r\n')
+        size = int(size, 16)
+        text += body[:size]
+        body = body[size + 2:]
+    return head.decode(), text.decode()
+
+
+@pytest.fixture
+def exporter_hub(mock_hub: testing.MockHub, mock_libvirt_conn):
+    mock_hub.OPT = {'virt': {'exporter_budget': 5.0}}
+    mock_hub.virt.EXPORTER = None
+    mock_libvirt_conn.getAllDomainStats.side_effect = None
+    mock_libvirt_conn.getAllDomainStats.return_value = [
+        (_mock_domain('vm"01', 'uuid-1'), {
+            'state.state': 1, 'cpu.time': 2500000000, 'balloon.current': 1024,
+            'net.count': 1, 'net.0.name': 'vnet0', 'net.0.rx.bytes': 100,
+            'block.count': 2, 'block.0.name': 'vda', 'block.0.rd.bytes': 10,
+            'block.1.name': 'vdb', 'block.1.rd.bytes': 20,
+        }),
+        (_mock_domain('vm02', 'uuid-2'), {'state.state': 5}),
+    ]
+    for method in (mock_libvirt_conn.getInfo, mock_libvirt_conn.getCPUStats, mock_libvirt_conn.getMemoryStats):
+        method.side_effect = None
+    mock_libvirt_conn.getInfo.return_value = ['x86_64', 4096, 8, 2712, 1, 2, 4, 2]
+    mock_libvirt_conn.getCPUStats.return_value = {'kernel': 1000000000, 'user': 2000000000}
+    mock_libvirt_conn.getMemoryStats.return_value = {'total': 4096, 'free': 1024}
+    return mock_hub
+
+
+class TestVirtExporter:
+    @pytest.mark.asyncio
+    async def test_scrape(self, exporter_hub, mock_libvirt_conn):
+        await virt.virt.exporter.start(exporter_hub, port=0)
+        try:
+            port = exporter_hub.virt.EXPORTER['server'].sockets[0].getsockname()[1]
+            head, body = await _get(port)
+        finally:
+            await virt.virt.exporter.stop(exporter_hub)
+
+        assert 'Content-Type: application/openmetrics-text; version=1.0.0; charset=utf-8' in head
+        assert 'Transfer-Encoding: chunked' in head
+        lines = body.splitlines()
+        assert '# TYPE libvirt_domain_cpu_time_seconds counter' in lines
+        assert 'libvirt_domain_cpu_time_seconds_total{domain="vm\\"01",uuid="uuid-1"} 2.5' in lines
+        assert 'libvirt_domain_state{domain="vm02",uuid="uuid-2"} 5' in lines
+        assert 'libvirt_domain_memory_bytes{domain="vm\\"01",uuid="uuid-1"} 1048576' in lines
+        assert 'libvirt_domain_block_read_bytes_total{domain="vm\\"01",uuid="uuid-1",device="vdb"} 20' in lines
+        assert 'libvirt_domain_interface_receive_bytes_total{domain="vm\\"01",uuid="uuid-1",device="vnet0"} 100' \
+            in lines
+        assert 'libvirt_node_cpu_time_seconds_total{mode="user"} 2.0' in lines
+        assert 'libvirt_node_memory_bytes{state="free"} 1048576' in lines
+        assert 'libvirt_exporter_up 1' in lines
+        assert lines[-1] == '# EOF'
+
+    @pytest.mark.asyncio
+    async def test_budget(self, exporter_hub, mock_libvirt_conn):
+        exporter = {'connection': (None, None, None), 'budget': 5.0, 'data': None, 'task': None}
+        data = await virt.virt.exporter.scrape(exporter_hub, exporter, 1.0)
+        assert len(data['domains']) == 2
+        labels = data['labels']
+
+        stats = mock_libvirt_conn.getAllDomainStats.return_value
+
+        def _slow():
+            time.sleep(0.3)
+            return stats
+        mock_libvirt_conn.getAllDomainStats.side_effect = _slow
+        try:
+            # Too slow: the previous data are served
+            assert await virt.virt.exporter.scrape(exporter_hub, exporter, 0.05) is data
+            await exporter['task']
+        finally:
+            mock_libvirt_conn.getAllDomainStats.side_effect = None
+        assert exporter['data'] is not data
+        # The encoded label sets are reused
+        assert exporter['data']['labels']['uuid-1'] is labels['uuid-1']
+
+        text = ''.join(virt.virt.exporter.render(None, time.time()))
+        assert text.splitlines()[-2:] == ['libvirt_exporter_up 0', '# EOF']
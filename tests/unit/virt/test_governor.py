@@ -0,0 +1,120 @@
+# Import python libs
+import asyncio
+import concurrent.futures
+import threading
+import time
+from unittest.mock import MagicMock
+import pytest
+
+# Import local libs
+import virt.virt.governor
+
+# Import pop libs
+import pop.mods.pop.testing as testing
+
+
+def _setup_hub(mock_hub, **opts):
+    mock_hub.OPT = {'virt': opts}
+    mock_hub.virt.GOVERNORS = {}
+    mock_hub.virt.GOVERNORS_LOCK = threading.Lock()
+    mock_hub.virt.LIFECYCLE_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+
+class TestVirtGovernor:
+    def test_wrap_disabled(self, mock_hub: testing.MockHub):
+        _setup_hub(mock_hub, governor_rate=0, governor_max_inflight=0)
+        conn = MagicMock()
+        assert virt.virt.governor.wrap(mock_hub, conn, 'qemu:///system') is conn
+        assert mock_hub.virt.GOVERNORS == {}
+
+    def test_wrap(self, mock_hub: testing.MockHub):
+        _setup_hub(mock_hub, governor_rate=1000, governor_burst=10, governor_max_inflight=2)
+        conn = MagicMock()
+        conn.getInfo.return_value = ['x86_64', 4096, 8, 2712, 1, 2, 4, 2]
+        governed = virt.virt.governor.wrap(mock_hub, conn, 'qemu:///system')
+
+        assert governed.getInfo() == ['x86_64', 4096, 8, 2712, 1, 2, 4, 2]
+        governed.close()
+        stats = virt.virt.governor.stats(mock_hub)
+        assert list(stats.keys()) == ['qemu:///system']
+        assert stats['qemu:///system']['calls'] == {'lifecycle': 0, 'inventory': 1}
+        assert stats['qemu:///system']['inflight'] == 0
+
+        # Same URI shares the same governor
+        virt.virt.governor.wrap(mock_hub, MagicMock(), 'qemu:///system')
+        assert len(mock_hub.virt.GOVERNORS) == 1
+
+    def test_rate(self):
+        governor = virt.virt.governor._Governor(rate=50, burst=1, max_inflight=0)
+        start = time.monotonic()
+        for _ in range(6):
+            governor.acquire(virt.virt.governor.INVENTORY)
+            governor.release()
+        # The first call uses the burst token, the 5 next ones wait 20ms each
+        assert time.monotonic() - start >= 0.09
+        assert governor.stats()['queued_calls']['inventory'] == 5
+
+    def test_priority(self):
+        governor = virt.virt.governor._Governor(rate=0, burst=1, max_inflight=1)
+        governor.acquire(virt.virt.governor.INVENTORY)
+
+        order = []
+
+        def _call(priority, name):
+            governor.acquire(priority)
+            order.append(name)
+            governor.release()
+
+        threads = [threading.Thread(target=_call, args=(virt.virt.governor.INVENTORY, 'inventory'))]
+        threads[0].start()
+        time.sleep(0.05)
+        threads.append(threading.Thread(target=_call, args=(virt.virt.governor.LIFECYCLE, 'lifecycle')))
+        threads[1].start()
+        time.sleep(0.05)
+        assert governor.stats()['waiting'] == 2
+
+        governor.release()
+        for thread in threads:
+            thread.join()
+        assert order == ['lifecycle', 'inventory']
+        assert governor.stats()['queued_calls'] == {'lifecycle': 1, 'inventory': 1}
+
+    def test_wrap_stats_tuples(self, mock_hub: testing.MockHub):
+        _setup_hub(mock_hub, governor_rate=0, governor_max_inflight=2)
+        conn = MagicMock()
+        libvirt_domain = type('virDomain', (), {'__module__': 'libvirt', 'XMLDesc': lambda self, flags: '<domain/>'})
+        conn.getAllDomainStats.return_value = [(libvirt_domain(), {'state.state': 1})]
+        governed = virt.virt.governor.wrap(mock_hub, conn, 'qemu:///system')
+
+        [(dom, stats)] = governed.getAllDomainStats()
+        assert stats == {'state.state': 1}
+        assert dom.XMLDesc(0) == '<domain/>'
+        assert virt.virt.governor.stats(mock_hub)['qemu:///system']['calls']['inventory'] == 2
+
+    @pytest.mark.asyncio
+    async def test_run_lifecycle(self, mock_hub: testing.MockHub):
+        _setup_hub(mock_hub, governor_rate=0, governor_max_inflight=1)
+        conn = MagicMock()
+        governed = virt.virt.governor.wrap(mock_hub, conn, 'qemu:///system')
+        governor = mock_hub.virt.GOVERNORS['qemu:///system']
+        governor.acquire(virt.virt.governor.INVENTORY)
+
+        # Inventory calls holding all the default executor threads
+        order = []
+        loop = asyncio.get_event_loop()
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        inventory = loop.run_in_executor(executor, lambda: order.append(governed.getInfo() and 'inventory'))
+        while governor.stats()['waiting'] < 1:
+            await asyncio.sleep(0.01)
+
+        # Reads made by a lifecycle function get the lifecycle priority
+        lifecycle = asyncio.ensure_future(virt.virt.governor.run_lifecycle(
+            mock_hub, lambda: order.append(governed.XMLDesc(0) and 'lifecycle')))
+        while governor.stats()['waiting'] < 2:
+            await asyncio.sleep(0.01)
+
+        governor.release()
+        await asyncio.gather(inventory, lifecycle)
+        executor.shutdown()
+        assert order == ['lifecycle', 'inventory']
+        assert governor.stats()['calls'] == {'lifecycle': 1, 'inventory': 2}
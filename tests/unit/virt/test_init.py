@@ -0,0 +1,59 @@
+# Import python libs
+import collections.abc
+import json
+import pytest
+
+# Import local libs
+import virt.virt.init
+
+# Import pop libs
+import pop.mods.pop.testing as testing
+
+
+class LazyMapping(collections.abc.Mapping):
+    '''
+    Mapping counting the values loaded at the same time, like the spilled domain infos
+    '''
+
+    def __init__(self, count):
+        self.count = count
+        self.closed = False
+
+    def __getitem__(self, name):
+        return {'name': name, 'values': [1, 2.5, None, 'a\nb']}
+
+    def __iter__(self):
+        return ('vm{}'.format(index) for index in range(self.count))
+
+    def __len__(self):
+        return self.count
+
+    def items(self):
+        for name in self:
+            yield name, self[name]
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def init_hub(mock_hub: testing.MockHub):
+    mock_hub.virt.init.json_default.side_effect = lambda value: virt.virt.init.json_default(mock_hub, value)
+    return mock_hub
+
+
+class TestVirtInit:
+    @pytest.mark.parametrize('indent', [None, 2])
+    def test_iterencode(self, init_hub, indent):
+        value = {'id': 1, 'return': {'a': [{'b': {'c': [1, {'d': 'e'}]}}, True], 2: None, None: []}, 'empty': {}}
+        actual = ''.join(virt.virt.init.iterencode(init_hub, value, indent=indent))
+        assert actual == json.dumps(value, indent=indent)
+
+    @pytest.mark.parametrize('indent', [None, 2])
+    def test_iterencode_lazy(self, init_hub, indent):
+        lazy = LazyMapping(3)
+        chunks = virt.virt.init.iterencode(init_hub, {'id': 1, 'return': lazy}, indent=indent)
+        assert json.loads(''.join(chunks)) == {'id': 1, 'return': {name: lazy[name] for name in lazy}}
+
+        virt.virt.init.release(init_hub, {'id': 1, 'return': lazy})
+        assert lazy.closed
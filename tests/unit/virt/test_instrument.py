@@ -0,0 +1,71 @@
+# Import python libs
+import threading
+import types
+from unittest.mock import MagicMock
+
+# Import local libs
+import virt.virt.instrument
+
+# Import pop libs
+import pop.mods.pop.testing as testing
+
+
+def _setup_hub(mock_hub, instrument=False):
+    mock_hub.OPT = {'virt': {'instrument': instrument}}
+    mock_hub.virt.METRICS = {}
+    mock_hub.virt.PROFILES = []
+    mock_hub.virt.INSTRUMENTED = []
+    mock_hub.virt.INSTRUMENT_LOCK = threading.Lock()
+
+
+def _helpers_module():
+    module = types.ModuleType('helpers')
+
+    def _helper(value):
+        return value * 2
+    module._helper = _helper
+    return module
+
+
+class TestVirtInstrument:
+    def test_disabled(self, mock_hub: testing.MockHub):
+        _setup_hub(mock_hub)
+        module = _helpers_module()
+        helper = module._helper
+        virt.virt.instrument.register(mock_hub, 'test', module, ['_helper'])
+
+        assert module._helper is helper
+        conn = MagicMock()
+        assert virt.virt.instrument.wrap_conn(mock_hub, conn) is conn
+
+    def test_enabled(self, mock_hub: testing.MockHub):
+        _setup_hub(mock_hub, instrument=True)
+        module = _helpers_module()
+        virt.virt.instrument.register(mock_hub, 'test', module, ['_helper'])
+
+        assert module._helper(2) == 4
+        assert module._helper(3) == 6
+        conn = virt.virt.instrument.wrap_conn(mock_hub, MagicMock())
+        conn.getInfo()
+
+        actual = virt.virt.instrument.stats(mock_hub, reset=True)
+        assert sorted(actual.keys()) == ['libvirt.MagicMock.getInfo', 'test._helper']
+        assert actual['test._helper']['count'] == 2
+        assert sum(actual['test._helper']['histogram'].values()) == 2
+        assert virt.virt.instrument.stats(mock_hub) == {}
+
+    def test_profile(self, mock_hub: testing.MockHub):
+        _setup_hub(mock_hub)
+        module = _helpers_module()
+        helper = module._helper
+        virt.virt.instrument.register(mock_hub, 'test', module, ['_helper'])
+
+        profile = virt.virt.instrument.start_profile(mock_hub)
+        assert module._helper is not helper
+        module._helper(1)
+        report = virt.virt.instrument.stop_profile(mock_hub, profile)
+
+        assert module._helper is helper
+        assert report['test._helper']['count'] == 1
+        # Only the profile recorded the call
+        assert virt.virt.instrument.stats(mock_hub) == {}
@@ -0,0 +1,68 @@
+# Import python libs
+import asyncio
+from unittest.mock import MagicMock
+import pytest
+
+# Import local libs
+import virt.virt.sampler
+
+# Import pop libs
+import pop.mods.pop.testing as testing
+
+
+class TestVirtSampler:
+    def test_ring(self):
+        ring = virt.virt.sampler._Ring(4)
+        for index in range(6):
+            ring.append(100.0 + index, index * 10)
+
+        assert ring.count == 4
+        assert ring.window(10, now=105.0) == [(102.0, 20.0), (103.0, 30.0), (104.0, 40.0), (105.0, 50.0)]
+        assert ring.window(1.5, now=105.0) == [(104.0, 40.0), (105.0, 50.0)]
+        assert ring.window(10, now=200.0) == []
+
+    def test_math(self, mock_hub: testing.MockHub):
+        points = [(100.0, 0.0), (101.0, 10.0), (103.0, 50.0)]
+        assert virt.virt.sampler.average(mock_hub, points) == 20.0
+        assert virt.virt.sampler.rate(mock_hub, points) == pytest.approx(50 / 3)
+        assert virt.virt.sampler.rates(mock_hub, points) == [(101.0, 10.0), (103.0, 20.0)]
+        assert virt.virt.sampler.percentile(mock_hub, [(t, float(t)) for t in range(1, 101)], 95) == 95.0
+        assert virt.virt.sampler.percentile(mock_hub, [], 95) is None
+        assert virt.virt.sampler.rate(mock_hub, points[:1]) is None
+
+    def test_domain_values(self):
+        actual = virt.virt.sampler._domain_values({
+            'state.state': 1,
+            'cpu.time': 1000,
+            'balloon.rss': 2048,
+            'net.count': 2,
+            'net.0.name': 'vnet0',
+            'net.0.rx.bytes': 10,
+            'net.1.rx.bytes': 20,
+            'block.0.wr.bytes': 5,
+        })
+        assert actual == {'cpu.time': 1000, 'balloon.rss': 2048, 'net.rx.bytes': 30, 'block.wr.bytes': 5}
+
+    @pytest.mark.asyncio
+    async def test_start(self, mock_hub: testing.MockHub, mock_libvirt_conn):
+        mock_hub.OPT = {'virt': {}}
+        mock_hub.virt.SAMPLER = None
+        dom = MagicMock()
+        dom.name.return_value = 'vm01'
+        mock_libvirt_conn.getAllDomainStats.return_value = [(dom, {'cpu.time': 1000, 'balloon.rss': 512})]
+        mock_libvirt_conn.getCPUStats.return_value = {'kernel': 1, 'user': 2, 'idle': 3, 'iowait': 4}
+
+        virt.virt.sampler.start(mock_hub, interval=0.01, size=8)
+        try:
+            await asyncio.sleep(0.1)
+            sampler = mock_hub.virt.SAMPLER
+            assert sampler['samples'] > 1
+            assert sampler['errors'] == 0
+
+            series = virt.virt.sampler.series(mock_hub, 'balloon.rss')
+            assert list(series.keys()) == ['vm01']
+            assert series['vm01'].count == min(sampler['samples'], 8)
+            assert virt.virt.sampler.series(mock_hub, 'node.cpu.idle')['node'].window(60)[-1][1] == 3.0
+        finally:
+            assert virt.virt.sampler.stop(mock_hub)
+        assert mock_hub.virt.SAMPLER is None
@@ -0,0 +1,68 @@
+# Import python libs
+import threading
+import time
+from unittest.mock import MagicMock
+import pytest
+
+# Import local libs
+import virt.virt.shard
+
+# Import pop libs
+import pop.mods.pop.testing as testing
+
+
+@pytest.fixture
+def shard_hub(mock_hub: testing.MockHub):
+    mock_hub.OPT = {'virt': {'uri': 'test:///default', 'shards': 1, 'shards_max': 8}}
+    mock_hub.virt.SHARD_LATENCY = {}
+    mock_hub.virt.SHARD_LOCK = threading.Lock()
+    mock_hub.virt.shard.count.side_effect = lambda *args: virt.virt.shard.count(mock_hub, *args)
+    return mock_hub
+
+
+class TestVirtShard:
+    def test_count(self, shard_hub):
+        assert virt.virt.shard.count(shard_hub, 'test:///default', 100) == 1
+        assert virt.virt.shard.count(shard_hub, 'test:///default', 100, 4) == 4
+        assert virt.virt.shard.count(shard_hub, 'test:///default', 3, 4) == 3
+
+        # Adaptive: half the maximum until the latency is known
+        assert virt.virt.shard.count(shard_hub, 'test:///default', 100, 0) == 4
+        shard_hub.virt.SHARD_LATENCY['test:///default'] = 0.01
+        assert virt.virt.shard.count(shard_hub, 'test:///default', 100, 0) == 2
+        assert virt.virt.shard.count(shard_hub, 'test:///default', 10, 0) == 1
+        assert virt.virt.shard.count(shard_hub, 'test:///default', 10000, 0) == 8
+
+    @pytest.mark.asyncio
+    async def test_apply(self, shard_hub):
+        conns = []
+
+        def _get_conn(connection, username, password, shard=0):
+            conn = MagicMock()
+            conn.shard = shard
+            conn.lock = threading.Lock()
+            conns.append(conn)
+            return conn
+        shard_hub.exec.virt.util.get_conn.side_effect = _get_conn
+
+        # All the connections have a call running at the same time
+        overlap = threading.Barrier(4, timeout=5)
+
+        def _call(conn, item):
+            # Calls on a connection are serialized
+            with conn.lock:
+                if item < 'vm04':
+                    overlap.wait()
+                time.sleep(0.01)
+            return (item, conn.shard)
+
+        items = ['vm{:02d}'.format(index) for index in range(20)]
+        results = await virt.virt.shard.apply(shard_hub, _call, items, 4)
+
+        assert [item for item, _ in results] == items
+        assert {shard for _, shard in results} == {0, 1, 2, 3}
+        assert all(conn.close.called for conn in conns)
+        assert shard_hub.virt.SHARD_LATENCY['test:///default'] >= 0.01
+
+        with pytest.raises(ValueError):
+            await virt.virt.shard.apply(shard_hub, lambda conn, item: int(item), items, 4)
@@ -2,11 +2,106 @@ CLI_CONFIG = {
     'uri': {
         'default': None,
         'help': 'libvirt URI to connect to',
-    }
+    },
+    'ref': {
+        'default': None,
+        'positional': True,
+        'display_priority': 1,
+        'nargs': '?',
+        'help': 'exec function to run and print the result of, like virt.domain.list_all',
+    },
+    'args': {
+        'default': [],
+        'positional': True,
+        'display_priority': 2,
+        'nargs': '*',
+        'help': 'arguments of the exec function to run, as value or key=value',
+    },
+    'serve': {
+        'default': False,
+        'action': 'store_true',
+        'help': 'Keep running and serve the exec calls of the virt command on a local unix socket',
+    },
+    'socket': {
+        'default': None,
+        'help': 'Path of the unix socket for --serve, defaults to /run/virt.sock for root',
+    },
+}
+CONFIG = {
+    'governor_rate': {
+        'default': 0,
+        'type': float,
+        'help': 'Maximum number of libvirt calls per second and per URI, 0 to disable the limit',
+    },
+    'governor_burst': {
+        'default': 10,
+        'type': int,
+        'help': 'Number of libvirt calls that can be made in a burst before the rate limit applies',
+    },
+    'governor_max_inflight': {
+        'default': 0,
+        'type': int,
+        'help': 'Maximum number of concurrent libvirt calls per URI, 0 to disable the limit',
+    },
+    'shards': {
+        'default': 1,
+        'type': int,
+        'help': 'Number of parallel libvirt connections used by the per domain calls of batch functions '
+                'like domain.info, 0 to adapt it to the observed latency',
+    },
+    'shards_max': {
+        'default': 8,
+        'type': int,
+        'help': 'Maximum number of parallel libvirt connections when adapting to the observed latency',
+    },
+    'exporter_port': {
+        'default': 0,
+        'type': int,
+        'help': 'Port of the OpenMetrics exporter started by --serve, 0 to disable it',
+    },
+    'exporter_address': {
+        'default': '127.0.0.1',
+        'help': 'Address the OpenMetrics exporter listens on',
+    },
+    'exporter_budget': {
+        'default': 5.0,
+        'type': float,
+        'help': 'Seconds a scrape can wait for fresh statistics before the previous ones are served',
+    },
+    'storage_pool_workers': {
+        'default': 4,
+        'type': int,
+        'help': 'Maximum number of volumes created at the same time in a storage pool',
+    },
+    'coalesce_ttl': {
+        'default': 0,
+        'type': float,
+        'help': 'Seconds the result of a domain, node or snapshot exec call is reused by the identical calls, '
+                '0 to only share the calls in progress',
+    },
+    'coalesce_exclude': {
+        'default': [],
+        'help': 'Patterns of the exec functions that are never shared, like virt.domain.state or virt.node.*',
+    },
+    'instrument': {
+        'default': False,
+        'action': 'store_true',
+        'help': 'Record the count and latency of the libvirt calls and internal helpers',
+    },
+    'sampler_interval': {
+        'default': 0,
+        'type': float,
+        'help': 'Seconds between two statistics samples, 0 to only start the sampler with virt.stats.start',
+    },
+    'sampler_size': {
+        'default': 360,
+        'type': int,
+        'help': 'Number of statistics samples kept for each domain and metric',
+    },
 }
-CONFIG = {}
 GLOBAL = {}
 SUBS = {}
 DYNE = {
     'exec': ['exec'],
+    'states': ['states'],
 }
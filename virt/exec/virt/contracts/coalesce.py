@@ -0,0 +1,29 @@
+'''
+Contract sharing the execution of identical calls, see ``hub.virt.coalesce``
+'''
+
+
+async def call(hub, ctx):
+    module = ctx.func.__module__.rsplit('.', 1)[-1]
+    # The public name of the functions like list_ aliased to list
+    name = ctx.func.__globals__.get('__func_alias__', {}).get(ctx.func.__name__, ctx.func.__name__)
+    arguments = dict(ctx.get_arguments())
+    arguments.pop('hub', None)
+    return await hub.virt.coalesce.run(
+        'virt.{}.{}'.format(module, name), arguments,
+        lambda: ctx.func(*ctx.args, **ctx.kwargs))
+
+
+async def call_info(hub, ctx):
+    # The spilled domain infos are backed by a temporary file closed by the caller
+    if ctx.get_arguments().get('spill'):
+        return await ctx.func(*ctx.args, **ctx.kwargs)
+    return await call(hub, ctx)
+
+
+async def call_provision(hub, ctx):
+    # Changes the domains: never shared and the recorded results are outdated
+    try:
+        return await ctx.func(*ctx.args, **ctx.kwargs)
+    finally:
+        hub.virt.coalesce.clear()
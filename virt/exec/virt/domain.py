@@ -1,16 +1,14 @@
 # -*- coding: utf-8 -*-
-import datetime
-import json
-import re
-import subprocess
+# The heavier modules, like libvirt, are imported where needed to keep the CLI startup fast
+import asyncio
+import collections.abc
+import fnmatch
+import functools
+import itertools
+import sys
+import time
 from xml.etree import ElementTree
-
-try:
-    import libvirt  # pylint: disable=import-error
-    from libvirt import libvirtError
-    HAS_LIBVIRT = True
-except ImportError:
-    HAS_LIBVIRT = False
+from xml.sax.saxutils import escape
 
 VIRT_STATE_NAME_MAP = {0: 'running',
                        1: 'running',
@@ -20,6 +18,61 @@ VIRT_STATE_NAME_MAP = {0: 'running',
                        5: 'shutdown',
                        6: 'crashed'}
 
+# virErrorNumber values of the guest agent queries meaning that the agent can't answer
+AGENT_UNAVAILABLE_ERRORS = frozenset([3,    # VIR_ERR_NO_SUPPORT
+                                      55,   # VIR_ERR_OPERATION_INVALID: agent not configured
+                                      84,   # VIR_ERR_OPERATION_UNSUPPORTED
+                                      86,   # VIR_ERR_AGENT_UNRESPONSIVE
+                                      97])  # VIR_ERR_AGENT_UNSYNCED
+# virErrorNumber of a domain removed while being looked up
+VIR_ERR_NO_DOMAIN = 42
+
+__func_alias__ = {'list_': 'list'}
+__contracts__ = ['coalesce']
+
+# virConnectListAllDomainsFlags values
+VIR_CONNECT_LIST_DOMAINS_ACTIVE = 1
+VIR_CONNECT_LIST_DOMAINS_INACTIVE = 2
+VIR_CONNECT_LIST_DOMAINS_PERSISTENT = 4
+VIR_CONNECT_LIST_DOMAINS_TRANSIENT = 8
+VIR_CONNECT_LIST_DOMAINS_RUNNING = 16
+VIR_CONNECT_LIST_DOMAINS_PAUSED = 32
+VIR_CONNECT_LIST_DOMAINS_SHUTOFF = 64
+VIR_CONNECT_LIST_DOMAINS_OTHER = 128
+VIR_CONNECT_LIST_DOMAINS_AUTOSTART = 1024
+VIR_CONNECT_LIST_DOMAINS_NO_AUTOSTART = 2048
+VIR_CONNECT_LIST_DOMAINS_HAS_SNAPSHOT = 4096
+VIR_CONNECT_LIST_DOMAINS_NO_SNAPSHOT = 8192
+
+# virDomainState values matching the state filters other than active and inactive
+VIR_DOMAIN_RUNNING = 1
+VIR_DOMAIN_PAUSED = 3
+VIR_DOMAIN_SHUTOFF = 5
+
+LIST_STATE_FLAGS = {'active': VIR_CONNECT_LIST_DOMAINS_ACTIVE,
+                    'inactive': VIR_CONNECT_LIST_DOMAINS_INACTIVE,
+                    'running': VIR_CONNECT_LIST_DOMAINS_RUNNING,
+                    'paused': VIR_CONNECT_LIST_DOMAINS_PAUSED,
+                    'shutoff': VIR_CONNECT_LIST_DOMAINS_SHUTOFF,
+                    'other': VIR_CONNECT_LIST_DOMAINS_OTHER}
+# (flag if True, flag if False)
+LIST_FLAGS = {'persistent': (VIR_CONNECT_LIST_DOMAINS_PERSISTENT, VIR_CONNECT_LIST_DOMAINS_TRANSIENT),
+              'autostart': (VIR_CONNECT_LIST_DOMAINS_AUTOSTART, VIR_CONNECT_LIST_DOMAINS_NO_AUTOSTART),
+              'snapshot': (VIR_CONNECT_LIST_DOMAINS_HAS_SNAPSHOT, VIR_CONNECT_LIST_DOMAINS_NO_SNAPSHOT)}
+# Client side filters when the driver doesn't support the flags: (value, domain) -> bool
+LIST_PREDICATES = {
+    'state': lambda value, dom: _state_matches(dom, value),
+    'persistent': lambda value, dom: bool(dom.isPersistent()) == value,
+    'autostart': lambda value, dom: bool(dom.autostart()) == value,
+    'snapshot': lambda value, dom: (dom.snapshotNum(0) > 0) == value,
+}
+
+
+def __init__(hub):
+    hub.virt.instrument.register('domain', sys.modules[__name__], [
+        '_get_domain', '_get_disks', '_get_nics', '_get_graphics', '_qemu_img_info', '_parse_qemu_img_info',
+    ])
+
 
 #def __virtual__():
 #    if not HAS_LIBVIRT:
@@ -46,14 +99,12 @@ async def list_all(hub, connection=None, username=None, password=None):
 
         salt '*' virt.list
     '''
-    vms = []
     conn = await hub.exec.virt.util.get_conn(connection, username, password)
     try:
-        for dom in _get_domain(conn, iterable=True):
-            vms.append(dom.name())
+        return await asyncio.get_event_loop().run_in_executor(
+            None, functools.partial(_get_names, conn))
     finally:
         conn.close()
-    return vms
 
 
 async def list_active(hub, connection=None, username=None, password=None):
@@ -70,14 +121,12 @@ async def list_active(hub, connection=None, username=None, password=None):
 
         salt '*' virt.list_active
     '''
-    vms = []
     conn = await hub.exec.virt.util.get_conn(connection, username, password)
     try:
-        for dom in _get_domain(conn, iterable=True, inactive=False):
-            vms.append(dom.name())
+        return await asyncio.get_event_loop().run_in_executor(
+            None, functools.partial(_get_names, conn, inactive=False))
     finally:
         conn.close()
-    return vms
 
 
 async def list_inactive(hub, connection=None, username=None, password=None):
@@ -94,14 +143,91 @@ async def list_inactive(hub, connection=None, username=None, password=None):
 
         salt '*' virt.list_inactive
     '''
-    vms = []
     conn = await hub.exec.virt.util.get_conn(connection, username, password)
     try:
-        for dom in _get_domain(conn, iterable=True, active=False):
-            vms.append(dom.name())
+        return await asyncio.get_event_loop().run_in_executor(
+            None, functools.partial(_get_names, conn, active=False))
+    finally:
+        conn.close()
+
+
+async def list_(hub, name=None, state=None, persistent=None, autostart=None, snapshot=None,
+                sort='name', reverse=False, limit=None, offset=0,
+                connection=None, username=None, password=None):
+    '''
+    Return the names of the domains matching the filters, sorted and paginated.
+
+    The filters are passed to libvirt as ``listAllDomains`` flags when possible.
+    If the hypervisor driver doesn't support them, the domains are filtered on
+    the client side, only checking the domains needed to fill the requested page.
+
+    :param name: shell-style pattern the domain names have to match, like ``web*``
+    :param state: one of ``active``, ``inactive``, ``running``, ``paused``, ``shutoff`` or ``other``
+    :param persistent: ``True`` for the persistent domains only, ``False`` for the transient ones only
+    :param autostart: ``True`` for the domains started with the host only, ``False`` for the other ones
+    :param snapshot: ``True`` for the domains with a snapshot only, ``False`` for the other ones
+    :param sort: ``name`` or ``id`` to sort the domains by name or by ID. When sorting by ID, the
+                 inactive domains, which have no ID, are listed last by name, even in descending order.
+    :param reverse: ``True`` to sort in descending order
+    :param limit: maximum number of names to return
+    :param offset: number of matching names to skip
+    :param connection: libvirt connection URI, overriding defaults
+    :param username: username to connect with, overriding defaults
+    :param password: password to connect with, overriding defaults
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' virt.domain.list name='web*' state=running limit=50 offset=100
+    '''
+    import libvirt  # pylint: disable=import-error
+
+    if state is not None and state not in LIST_STATE_FLAGS:
+        raise Exception('Unsupported domain state filter: {}'.format(state))
+    if sort not in ('name', 'id'):
+        raise Exception('Unsupported domain sort key: {}'.format(sort))
+
+    filters = {'state': state, 'persistent': persistent, 'autostart': autostart, 'snapshot': snapshot}
+    flags = 0
+    for key, value in filters.items():
+        if value is not None:
+            flags |= LIST_STATE_FLAGS[value] if key == 'state' else LIST_FLAGS[key][0 if value else 1]
+
+    def _list():
+        try:
+            domains = conn.listAllDomains(flags)
+            predicates = []
+        except libvirt.libvirtError:
+            # Older drivers don't support all the flags
+            domains = conn.listAllDomains(0)
+            predicates = [functools.partial(LIST_PREDICATES[key], value)
+                          for key, value in filters.items() if value is not None]
+
+        entries = [(dom.name(), dom) for dom in domains]
+        if name is not None:
+            entries = [(dom_name, dom) for dom_name, dom in entries if fnmatch.fnmatchcase(dom_name, name)]
+
+        if sort == 'id':
+            # Inactive domains have the -1 ID
+            ids = {dom_name: dom.ID() for dom_name, dom in entries}
+            active = sorted((entry for entry in entries if ids[entry[0]] >= 0),
+                            key=lambda entry: (ids[entry[0]], entry[0]), reverse=reverse)
+            inactive = sorted((entry for entry in entries if ids[entry[0]] < 0),
+                              key=lambda entry: entry[0], reverse=reverse)
+            entries = active + inactive
+        else:
+            entries.sort(key=lambda entry: entry[0], reverse=reverse)
+
+        matching = (dom_name for dom_name, dom in entries if all(predicate(dom) for predicate in predicates))
+        stop = offset + limit if limit is not None else None
+        return list(itertools.islice(matching, offset, stop))
+
+    conn = await hub.exec.virt.util.get_conn(connection, username, password)
+    try:
+        return await asyncio.get_event_loop().run_in_executor(None, _list)
     finally:
         conn.close()
-    return vms
 
 
 async def get_xml(hub, vm_, connection=None, username=None, password=None):
@@ -119,17 +245,23 @@ async def get_xml(hub, vm_, connection=None, username=None, password=None):
 
         salt '*' virt.domain.get_xml <domain>
     '''
-    conn = await hub.exec.virt.util.get_conn(connection, username, password)
-    try:
-        xml_desc = vm_.XMLDesc(0) if isinstance(
+    import libvirt  # pylint: disable=import-error
+
+    def _xml_desc():
+        return vm_.XMLDesc(0) if isinstance(
             vm_, libvirt.virDomain
         ) else _get_domain(conn, vm_).XMLDesc(0)
+
+    conn = await hub.exec.virt.util.get_conn(connection, username, password)
+    try:
+        xml_desc = await asyncio.get_event_loop().run_in_executor(None, _xml_desc)
     finally:
         conn.close()
     return xml_desc
 
 
-async def info(hub, vm_=None, connection=None, username=None, password=None):
+async def info(hub, vm_=None, connection=None, username=None, password=None, shards=None,
+               lean=False, spill=None):
     '''
     Return detailed information about the vms on this hyper in a
     list of dicts:
@@ -138,6 +270,15 @@ async def info(hub, vm_=None, connection=None, username=None, password=None):
     :param connection: libvirt connection URI, overriding defaults
     :param username: username to connect with, overriding defaults
     :param password: password to connect with, overriding defaults
+    :param shards: number of parallel connections used to query all the VMs,
+                   overriding the ``shards`` option. 0 adapts it to the observed latency.
+    :param lean: ``True`` to parse the XML description of each domain only once and incrementally,
+                 dropping the elements as soon as they are read.
+    :param spill: ``file`` or ``mmap`` to write the infos of each domain to a temporary NDJSON file
+                  as soon as they are computed. A read only mapping is returned: the infos of a domain
+                  are only loaded from the file, or its memory map, when they are accessed.
+                  Implies ``lean`` and doesn't shard the domains so that only one domain is held in
+                  memory at a time. Close the mapping to remove the file.
 
     .. code-block:: python
 
@@ -161,33 +302,43 @@ async def info(hub, vm_=None, connection=None, username=None, password=None):
 
         salt '*' virt.domain.info
     '''
-    def _info(dom):
-        '''
-        Compute the infos of a domain
-        '''
-        raw = dom.info()
-        return {'cpu': raw[3],
-                'cputime': int(raw[4]),
-                'disks': _get_disks(dom),
-                'graphics': _get_graphics(dom),
-                'nics': _get_nics(dom),
-                'uuid': _get_uuid(dom),
-                'on_crash': _get_on_crash(dom),
-                'on_reboot': _get_on_reboot(dom),
-                'on_poweroff': _get_on_poweroff(dom),
-                'maxMem': int(raw[1]),
-                'mem': int(raw[2]),
-                'state': VIRT_STATE_NAME_MAP.get(raw[0], 'unknown')}
-    info = {}
-    conn = await hub.exec.virt.util.get_conn(connection, username, password)
-    try:
+    if spill not in (None, 'file', 'mmap'):
+        raise ValueError('Invalid spill value: {}'.format(spill))
+    lean = lean or spill is not None
+    get_info = _get_info_lean if lean else _get_info
+    info = _SpilledInfo(spill == 'mmap') if spill else {}
+    sharded = not vm_ and not spill and \
+        hub.virt.shard.count(connection or hub.OPT['virt']['uri'], sys.maxsize, shards) > 1
+
+    def _collect():
         if vm_:
-            info[vm_] = _info(_get_domain(conn, vm_))
+            info[vm_] = get_info(_get_domain(conn, vm_))
+        elif sharded:
+            names = [domain.name() for domain in conn.listAllDomains(0)]
+            if not names:
+                # Same error as _get_domain for the unsharded queries
+                raise Exception('No virtual machines found.')
+            return names
         else:
             for domain in _get_domain(conn, iterable=True):
-                info[domain.name()] = _info(domain)
+                info[domain.name()] = get_info(domain)
+        return None
+
+    conn = await hub.exec.virt.util.get_conn(connection, username, password)
+    try:
+        names = await asyncio.get_event_loop().run_in_executor(None, _collect)
+    except Exception:
+        if spill:
+            info.close()
+        raise
     finally:
         conn.close()
+    if spill:
+        info.seal()
+    if names:
+        results = await hub.virt.shard.apply(functools.partial(_get_info_by_name, lean=lean), names, shards,
+                                             connection, username, password)
+        info = dict(zip(names, results))
     return info
 
 
@@ -217,17 +368,179 @@ async def state(hub, vm_=None, connection=None, username=None, password=None):
         raw = dom.info()
         state = VIRT_STATE_NAME_MAP.get(raw[0], 'unknown')
         return state
-    info = {}
+
+    def _states():
+        if vm_:
+            return {vm_: _info(_get_domain(conn, vm_))}
+        return {domain.name(): _info(domain) for domain in _get_domain(conn, iterable=True)}
+
     conn = await hub.exec.virt.util.get_conn(connection, username, password)
     try:
-        if vm_:
-            info[vm_] = _info(_get_domain(conn, vm_))
-        else:
-            for domain in _get_domain(conn, iterable=True):
-                info[domain.name()] = _info(domain)
+        return await asyncio.get_event_loop().run_in_executor(None, _states)
     finally:
         conn.close()
-    return info
+
+
+async def agent_info(hub, timeout=5, workers=16, connection=None, username=None, password=None):
+    '''
+    Return the guest agent reported network interfaces and file systems
+    of all the running domains.
+
+    The guest agents are queried concurrently and each domain has to answer
+    within ``timeout`` seconds. Domains with a stuck or slow agent are listed
+    in the ``timeout`` list, domains without a usable agent are listed in
+    the ``errors`` dictionary with the error message. The other errors are raised.
+
+    :param timeout: maximum number of seconds to wait for each domain
+    :param workers: maximum number of guest agents queried at the same time
+    :param connection: libvirt connection URI, overriding defaults
+    :param username: username to connect with, overriding defaults
+    :param password: password to connect with, overriding defaults
+
+    .. code-block:: python
+
+        {
+            'domains': {
+                'your-vm': {
+                    'interfaces': {
+                        'eth0': {
+                            'hwaddr': '52:54:00:a1:b2:c3',
+                            'addrs': [{'type': 'ipv4', 'addr': '192.168.122.10', 'prefix': 24}]
+                        }
+                    },
+                    'filesystems': [
+                        {'mountpoint': '/', 'name': 'vda1', 'fstype': 'xfs',
+                         'total-bytes': <int>, 'used-bytes': <int>}
+                    ]
+                },
+                ...
+            },
+            'timeout': ['stuck-vm'],
+            'errors': {'no-agent-vm': '<libvirt error message>'}
+        }
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' virt.domain.agent_info timeout=2
+    '''
+    import concurrent.futures
+    import libvirt  # pylint: disable=import-error
+
+    ret = {'domains': {}, 'timeout': [], 'errors': {}}
+    conn = await hub.exec.virt.util.get_conn(connection, username, password)
+    try:
+        loop = asyncio.get_event_loop()
+        domains = await loop.run_in_executor(None, _active_domains, conn)
+        semaphore = asyncio.Semaphore(workers)
+        # Up to one thread per domain: the threads still blocked on stuck agents
+        # don't make the next domains wait in the executor queue
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(domains)))
+
+        async def _query(dom):
+            name = dom.name()
+            async with semaphore:
+                # The slot is given back on timeout, even if the thread is still stuck
+                try:
+                    ret['domains'][name] = await asyncio.wait_for(
+                        loop.run_in_executor(executor, _get_agent_info, dom), timeout)
+                except asyncio.TimeoutError:
+                    ret['timeout'].append(name)
+                except libvirt.libvirtError as err:
+                    if err.get_error_code() not in AGENT_UNAVAILABLE_ERRORS:
+                        raise
+                    ret['errors'][name] = str(err)
+
+        try:
+            await asyncio.gather(*[_query(dom) for dom in domains])
+        finally:
+            # Don't wait for the threads still blocked on stuck agents
+            executor.shutdown(wait=False)
+    finally:
+        conn.close()
+    ret['timeout'].sort()
+    return ret
+
+
+async def provision(hub, template, domains, start=True, workers=8, verify=False,
+                    connection=None, username=None, password=None):
+    '''
+    Define and start many domains from a single XML template.
+
+    The template is compiled once: the ``{slot}`` fields in its texts and
+    attribute values are located and the rest of the document is serialized
+    only once. Each domain definition is then rendered by joining the
+    serialized chunks with its escaped slot values. The domains are defined
+    and started concurrently by at most ``workers`` threads.
+
+    :param template: domain XML definition with slots like ``{name}`` or ``{memory}``. Only the braces
+                     around an identifier are slots, the other braces are kept as is.
+    :param domains: dictionary of the slot values indexed by domain name. The ``name`` slot is set
+                    to the domain name.
+    :param start: ``True`` to start the domains once defined
+    :param workers: maximum number of domains defined and started at the same time
+    :param verify: ``True`` to add the :py:func:`info` of each provisioned domain to the result
+    :param connection: libvirt connection URI, overriding defaults
+    :param username: username to connect with, overriding defaults
+    :param password: password to connect with, overriding defaults
+
+    .. code-block:: python
+
+        {
+            'render': <seconds spent compiling and rendering the definitions>,
+            'domains': {
+                'web01': {
+                    'result': True,
+                    'time': {'define': <seconds>, 'start': <seconds>, 'total': <seconds>},
+                    'info': {<the domain.info values when verify=True>}
+                },
+                'web02': {
+                    'result': False,
+                    'error': '<libvirt error message>',
+                    'time': {'define': <seconds>, 'total': <seconds>}
+                },
+                'web03': {
+                    'result': False,
+                    'error': 'Missing template value: memory',
+                    'time': {'total': 0}
+                },
+                ...
+            }
+        }
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' virt.domain.provision template="$(cat web.xml)" domains="{web01: {mac: '52:54:00:00:00:01'}}"
+    '''
+    import concurrent.futures
+
+    begin = time.monotonic()
+    compiled = _Template(template)
+    definitions = {}
+    ret = {'domains': {}}
+    for name, values in domains.items():
+        try:
+            definitions[name] = compiled.render(dict(values or {}, name=name))
+        except KeyError as err:
+            ret['domains'][name] = {'result': False, 'error': 'Missing template value: {}'.format(err.args[0]),
+                                    'time': {'total': 0}}
+    ret['render'] = time.monotonic() - begin
+
+    conn = await hub.exec.virt.util.get_conn(connection, username, password)
+    loop = asyncio.get_event_loop()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, int(workers)))
+    try:
+        results = await asyncio.gather(*[
+            loop.run_in_executor(executor, _provision_domain, conn, xml, start, verify)
+            for xml in definitions.values()])
+        ret['domains'].update(zip(definitions.keys(), results))
+    finally:
+        executor.shutdown(wait=False)
+        conn.close()
+    return ret
 
 
 def _get_domain(conn, *vms, iterable=False, active=True, inactive=True):
@@ -270,6 +583,244 @@ def _get_domain(conn, *vms, iterable=False, active=True, inactive=True):
     return len(ret) == 1 and not iterable and ret[0] or ret
 
 
+def _get_names(conn, active=True, inactive=True):
+    '''
+    Return the names of the domains
+    '''
+    return [dom.name() for dom in _get_domain(conn, iterable=True, active=active, inactive=inactive)]
+
+
+def _state_matches(dom, value):
+    '''
+    Check if a domain matches a domain.list state filter, like the libvirt flags do
+    '''
+    if value in ('active', 'inactive'):
+        # Any domain with a running process is active, including the paused ones
+        return bool(dom.isActive()) == (value == 'active')
+    names = {VIR_DOMAIN_RUNNING: 'running', VIR_DOMAIN_PAUSED: 'paused', VIR_DOMAIN_SHUTOFF: 'shutoff'}
+    return names.get(dom.state()[0], 'other') == value
+
+
+def _get_info(dom):
+    '''
+    Compute the infos of a domain
+    '''
+    raw = dom.info()
+    return {'cpu': raw[3],
+            'cputime': int(raw[4]),
+            'disks': _get_disks(dom),
+            'graphics': _get_graphics(dom),
+            'nics': _get_nics(dom),
+            'uuid': _get_uuid(dom),
+            'on_crash': _get_on_crash(dom),
+            'on_reboot': _get_on_reboot(dom),
+            'on_poweroff': _get_on_poweroff(dom),
+            'maxMem': int(raw[1]),
+            'mem': int(raw[2]),
+            'state': VIRT_STATE_NAME_MAP.get(raw[0], 'unknown')}
+
+
+def _get_info_lean(dom):
+    '''
+    Compute the infos of a domain like ``_get_info``, with a single ``XMLDesc`` call
+    parsed incrementally: the elements are dropped as soon as they have been read.
+    '''
+    import io
+
+    raw = dom.info()
+    ret = {'cpu': raw[3],
+           'cputime': int(raw[4]),
+           'disks': {},
+           'graphics': {'autoport': 'None', 'keymap': 'None', 'listen': 'None', 'port': 'None', 'type': 'None'},
+           'nics': {},
+           'uuid': None,
+           'on_crash': '',
+           'on_reboot': '',
+           'on_poweroff': '',
+           'maxMem': int(raw[1]),
+           'mem': int(raw[2]),
+           'state': VIRT_STATE_NAME_MAP.get(raw[0], 'unknown')}
+    path = []
+    root = None
+    for event, elem in ElementTree.iterparse(io.StringIO(dom.XMLDesc(0)), events=('start', 'end')):
+        if event == 'start':
+            path.append(elem.tag)
+            if root is None:
+                root = elem
+            continue
+        path.pop()
+        parent = '/'.join(path[1:])
+        if parent == '':
+            if elem.tag in ('uuid', 'on_crash', 'on_reboot', 'on_poweroff'):
+                ret[elem.tag] = elem.text if elem.tag == 'uuid' else elem.text or ''
+        elif parent == 'devices':
+            if elem.tag == 'disk':
+                disk = _disk_from_node(elem)
+                if disk is not None:
+                    ret['disks'][disk[0]] = disk[1]
+            elif elem.tag == 'interface':
+                nic = _nic_from_node(elem)
+                if 'mac' in nic:
+                    ret['nics'][nic['mac']] = nic
+            elif elem.tag == 'graphics':
+                ret['graphics'].update(elem.attrib)
+        else:
+            continue
+        # The element is read: only keep an empty shell in its parent
+        elem.clear()
+    if root is not None:
+        root.clear()
+    return ret
+
+
+def _provision_domain(conn, xml, start, verify):
+    '''
+    Define and start a domain, timing each step. Run in an executor.
+    '''
+    ret = {'result': True, 'time': {}}
+    begin = time.monotonic()
+    step = 'define'
+    try:
+        dom = conn.defineXML(xml)
+        ret['time']['define'] = time.monotonic() - begin
+        if start:
+            step = 'start'
+            dom.create()
+            ret['time']['start'] = time.monotonic() - begin - ret['time']['define']
+        if verify:
+            ret['info'] = _get_info(dom)
+    except Exception as err:  # pylint: disable=broad-except
+        ret['result'] = False
+        ret['error'] = str(err)
+        ret['time'].setdefault(step, time.monotonic() - begin - sum(ret['time'].values()))
+    ret['time']['total'] = time.monotonic() - begin
+    return ret
+
+
+class _Template:
+    '''
+    Domain XML template compiled into serialized chunks and slots
+    '''
+    MARKER = 'virt-template-slot-{}-'
+    MARKER_RE = r'virt-template-slot-([0-9]+)-'
+    SLOT_RE = r'\{([A-Za-z_][A-Za-z0-9_]*)\}'
+
+    def __init__(self, xml):
+        import re
+
+        self._slot_re = re.compile(self.SLOT_RE)
+        root = ElementTree.fromstring(xml)
+        # The format strings of the slots and whether they are in an attribute
+        slots = []
+
+        def _mark(value, attribute):
+            if value is None or not self._slot_re.search(value):
+                return value
+            slots.append((value, attribute))
+            return self.MARKER.format(len(slots) - 1)
+
+        for node in root.iter():
+            node.text = _mark(node.text, False)
+            node.tail = _mark(node.tail, False)
+            for attr, value in node.attrib.items():
+                node.set(attr, _mark(value, True))
+
+        parts = re.split(self.MARKER_RE, ElementTree.tostring(root, encoding='unicode'))
+        # Even parts are the literal chunks, odd parts are the slots indexes
+        self.chunks = parts[::2]
+        self.slots = [slots[int(index)] for index in parts[1::2]]
+
+    def render(self, values):
+        '''
+        Return the XML definition with the escaped slot values, raise a KeyError for a missing value
+        '''
+        out = [self.chunks[0]]
+        for (fmt, attribute), chunk in zip(self.slots, self.chunks[1:]):
+            value = self._slot_re.sub(lambda match: str(values[match.group(1)]), fmt)
+            out.append(escape(value, {'"': '&quot;'}) if attribute else escape(value))
+            out.append(chunk)
+        return ''.join(out)
+
+
+class _SpilledInfo(collections.abc.Mapping):
+    '''
+    Read only mapping of the domain infos spilled to a temporary NDJSON file.
+
+    Each line of the file is a ``{"name": ..., "info": ...}`` JSON object. Only
+    the offsets of the lines are kept in memory and the infos are parsed when
+    they are accessed.
+    '''
+
+    def __init__(self, use_mmap=False):
+        import tempfile
+
+        self._file = tempfile.TemporaryFile()
+        self._index = {}
+        self._use_mmap = use_mmap
+        self._mmap = None
+
+    def __setitem__(self, name, info):
+        import json
+
+        line = json.dumps({'name': name, 'info': info}, default=str).encode() + b'\n'
+        self._index[name] = (self._file.tell(), len(line))
+        self._file.write(line)
+
+    def __getitem__(self, name):
+        import json
+
+        offset, length = self._index[name]
+        return json.loads(self._read(offset, length).decode())['info']
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+    def seal(self):
+        '''
+        Flush the file, no more info can be added
+        '''
+        self._file.flush()
+        if self._use_mmap and self._index:
+            import mmap
+
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def lines(self):
+        '''
+        Generate the NDJSON lines
+        '''
+        for offset, length in self._index.values():
+            yield self._read(offset, length)
+
+    def close(self):
+        '''
+        Close and remove the temporary file
+        '''
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        self._file.close()
+
+    def _read(self, offset, length):
+        if self._mmap is not None:
+            return self._mmap[offset:offset + length]
+        self._file.seek(offset)
+        data = self._file.read(length)
+        self._file.seek(0, 2)
+        return data
+
+
+def _get_info_by_name(conn, name, lean=False):
+    '''
+    Compute the infos of a domain from its name
+    '''
+    dom = conn.lookupByName(name)
+    return _get_info_lean(dom) if lean else _get_info(dom)
+
+
 def _get_uuid(dom):
     '''
     Return a uuid from the named vm
@@ -290,35 +841,43 @@ def _get_nics(dom):
     nics = {}
     doc = ElementTree.fromstring(dom.XMLDesc(0))
     for iface_node in doc.findall('devices/interface'):
-        nic = {}
-        nic['type'] = iface_node.get('type')
-        for v_node in iface_node:
-            if v_node.tag == 'mac':
-                nic['mac'] = v_node.get('address')
-            if v_node.tag == 'model':
-                nic['model'] = v_node.get('type')
-            if v_node.tag == 'target':
-                nic['target'] = v_node.get('dev')
-            # driver, source, and match can all have optional attributes
-            if re.match('(driver|source|address)', v_node.tag):
-                temp = {}
-                for key, value in v_node.attrib.items():
-                    temp[key] = value
-                nic[v_node.tag] = temp
-            # virtualport needs to be handled separately, to pick up the
-            # type attribute of the virtualport itself
-            if v_node.tag == 'virtualport':
-                temp = {}
-                temp['type'] = v_node.get('type')
-                for key, value in v_node.attrib.items():
-                    temp[key] = value
-                nic['virtualport'] = temp
+        nic = _nic_from_node(iface_node)
         if 'mac' not in nic:
             continue
         nics[nic['mac']] = nic
     return nics
 
 
+def _nic_from_node(iface_node):
+    '''
+    Get the network interface infos from its XML element
+    '''
+    nic = {}
+    nic['type'] = iface_node.get('type')
+    for v_node in iface_node:
+        if v_node.tag == 'mac':
+            nic['mac'] = v_node.get('address')
+        if v_node.tag == 'model':
+            nic['model'] = v_node.get('type')
+        if v_node.tag == 'target':
+            nic['target'] = v_node.get('dev')
+        # driver, source, and match can all have optional attributes
+        if v_node.tag in ('driver', 'source', 'address'):
+            temp = {}
+            for key, value in v_node.attrib.items():
+                temp[key] = value
+            nic[v_node.tag] = temp
+        # virtualport needs to be handled separately, to pick up the
+        # type attribute of the virtualport itself
+        if v_node.tag == 'virtualport':
+            temp = {}
+            temp['type'] = v_node.get('type')
+            for key, value in v_node.attrib.items():
+                temp[key] = value
+            nic['virtualport'] = temp
+    return nic
+
+
 def _get_graphics(dom):
     '''
     Get domain graphics from a libvirt domain object.
@@ -339,6 +898,9 @@ def _parse_qemu_img_info(info):
     '''
     Parse qemu-img info JSON output into disk infos dictionary
     '''
+    import datetime
+    import json
+
     raw_infos = json.loads(info)
     disks = []
     for disk_infos in raw_infos:
@@ -376,6 +938,19 @@ def _parse_qemu_img_info(info):
     return disks[0]
 
 
+def _qemu_img_info(path):
+    '''
+    Run qemu-img info on a disk image and return its JSON output
+    '''
+    import subprocess
+
+    stdout = subprocess.Popen(
+                ['qemu-img', 'info', '-U', '--output', 'json', '--backing-chain', path],
+                shell=False,
+                stdout=subprocess.PIPE).communicate()[0]
+    return stdout.decode()
+
+
 def _get_disks(dom):
     '''
     Get domain disks from a libvirt domain object.
@@ -383,41 +958,90 @@ def _get_disks(dom):
     disks = {}
     doc = ElementTree.fromstring(dom.XMLDesc(0))
     for elem in doc.findall('devices/disk'):
-        source = elem.find('source')
-        if source is None:
-            continue
-        target = elem.find('target')
-        if target is None:
-            continue
-        if 'dev' in target.attrib:
-            qemu_target = source.get('file', '')
-            if not qemu_target:
-                qemu_target = source.get('dev', '')
-            if not qemu_target and 'protocol' in source.attrib and 'name' in source.attrib:  # for rbd network
-                qemu_target = '{0}:{1}'.format(
-                        source.get('protocol'),
-                        source.get('name'))
-            if not qemu_target:
-                continue
-
-            disk = {'file': qemu_target, 'type': elem.get('device')}
-
-            driver = elem.find('driver')
-            if driver is not None and driver.get('type') == 'qcow2':
-                try:
-                    stdout = subprocess.Popen(
-                                ['qemu-img', 'info', '-U', '--output', 'json', '--backing-chain', disk['file']],
-                                shell=False,
-                                stdout=subprocess.PIPE).communicate()[0]
-                    output = _parse_qemu_img_info(stdout.decode())
-                    disk.update(output)
-                except TypeError:
-                    disk.update({'file': 'Does not exist'})
-
-            disks[target.get('dev')] = disk
+        disk = _disk_from_node(elem)
+        if disk is not None:
+            disks[disk[0]] = disk[1]
     return disks
 
 
+def _disk_from_node(elem):
+    '''
+    Get the (target, infos) of a disk from its XML element, None for the disks without source
+    '''
+    source = elem.find('source')
+    if source is None:
+        return None
+    target = elem.find('target')
+    if target is None or 'dev' not in target.attrib:
+        return None
+    qemu_target = source.get('file', '')
+    if not qemu_target:
+        qemu_target = source.get('dev', '')
+    if not qemu_target and 'protocol' in source.attrib and 'name' in source.attrib:  # for rbd network
+        qemu_target = '{0}:{1}'.format(
+                source.get('protocol'),
+                source.get('name'))
+    if not qemu_target:
+        return None
+
+    disk = {'file': qemu_target, 'type': elem.get('device')}
+
+    driver = elem.find('driver')
+    if driver is not None and driver.get('type') == 'qcow2':
+        try:
+            output = _parse_qemu_img_info(_qemu_img_info(disk['file']))
+            disk.update(output)
+        except TypeError:
+            disk.update({'file': 'Does not exist'})
+    return target.get('dev'), disk
+
+
+def _active_domains(conn):
+    '''
+    Return the running domains, skipping the ones stopped while listing them.
+
+    This function is blocking and is meant to be run in an executor.
+    '''
+    import libvirt  # pylint: disable=import-error
+
+    ret = []
+    for id_ in conn.listDomainsID():
+        try:
+            ret.append(conn.lookupByID(id_))
+        except libvirt.libvirtError as err:
+            if err.get_error_code() != VIR_ERR_NO_DOMAIN:
+                raise
+    return ret
+
+
+def _get_agent_info(dom):
+    '''
+    Query the guest agent of a running domain for its network interfaces and file systems.
+
+    This function is blocking and is meant to be run in an executor.
+    '''
+    import libvirt  # pylint: disable=import-error
+
+    interfaces = {}
+    raw_ifaces = dom.interfaceAddresses(libvirt.VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_AGENT) or {}
+    for if_name, iface in raw_ifaces.items():
+        interfaces[if_name] = {
+            'hwaddr': iface.get('hwaddr'),
+            'addrs': [{'type': 'ipv6' if addr['type'] == libvirt.VIR_IP_ADDR_TYPE_IPV6 else 'ipv4',
+                       'addr': addr['addr'],
+                       'prefix': addr['prefix']} for addr in iface.get('addrs') or []]
+        }
+
+    raw_infos = dom.guestInfo(libvirt.VIR_DOMAIN_GUEST_INFO_FILESYSTEM) or {}
+    filesystems = []
+    for index in range(int(raw_infos.get('fs.count', 0))):
+        prefix = 'fs.{}.'.format(index)
+        filesystems.append({key[len(prefix):]: value for key, value in raw_infos.items()
+                            if key.startswith(prefix) and key.count('.') == 2})
+
+    return {'interfaces': interfaces, 'filesystems': filesystems}
+
+
 def _get_on_poweroff(dom):
     '''
     Return `on_poweroff` setting from the named vm
@@ -0,0 +1,14 @@
+import virt.conf
+
+
+def __init__(hub):
+    # The idem runtime loads the exec and states modules without the virt command
+    # line: add the infrastructure they rely on, like the connections pool, without
+    # its command line handling and with the default options.
+    if not hasattr(hub, 'virt'):
+        hub.pop.sub.add('virt.virt', init=False, load_all=False)
+    if 'virt' not in hub.OPT:
+        opts = dict(hub.OPT)
+        defaults = dict(virt.conf.CONFIG, **virt.conf.CLI_CONFIG)
+        opts['virt'] = {key: value.get('default') for key, value in defaults.items()}
+        hub.OPT = hub.pop.data.imap(opts)
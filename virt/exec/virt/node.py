@@ -1,6 +1,21 @@
 # -*- coding: utf-8 -*-
 from xml.etree import ElementTree
+import asyncio
+import copy
 import sys
+import urllib.parse
+
+__contracts__ = ['coalesce']
+
+# virDomainState value of the stopped domains
+VIR_DOMAIN_SHUTOFF = 5
+
+
+def __init__(hub):
+    hub.virt.instrument.register('node', sys.modules[__name__], [
+        '_node_info', '_parse_pools_caps', '_parse_capabilities', '_parse_node_device',
+        '_domain_host_devices',
+    ])
 
 
 async def info(hub, connection=None, username=None, password=None):
@@ -19,7 +34,7 @@ async def info(hub, connection=None, username=None, password=None):
     '''
     conn = await hub.exec.virt.util.get_conn(connection, username, password)
     try:
-        info = _node_info(conn)
+        info = await asyncio.get_event_loop().run_in_executor(None, _node_info, conn)
     finally:
         conn.close()
     return info
@@ -70,7 +85,8 @@ async def pool_capabilities(hub, connection=None, username=None, password=None):
         conn = await hub.exec.virt.util.get_conn(connection, username, password)
         has_pool_capabilities = bool(getattr(conn, 'getStoragePoolCapabilities', None))
         if has_pool_capabilities:
-            caps = ElementTree.fromstring(conn.getStoragePoolCapabilities())
+            caps = ElementTree.fromstring(
+                await asyncio.get_event_loop().run_in_executor(None, conn.getStoragePoolCapabilities))
             pool_types = _parse_pools_caps(caps)
         else:
             # Compute reasonable values
@@ -137,7 +153,7 @@ async def pool_capabilities(hub, connection=None, username=None, password=None):
                 {'name': 'iscsi-direct', 'version': 4007000, 'hypervisors': ['kvm', 'xen']}
             ]
 
-            libvirt_version = conn.getLibVersion()
+            libvirt_version = await asyncio.get_event_loop().run_in_executor(None, conn.getLibVersion)
             hypervisor = await hub.exec.virt.node.get_hypervisor()
 
             def _get_backend_output(backend):
@@ -175,6 +191,222 @@ async def pool_capabilities(hub, connection=None, username=None, password=None):
     }
 
 
+async def capacity(hub, connection=None, username=None, password=None):
+    '''
+    Return the capacity and overcommit figures of one or more hosts.
+
+    The domains figures are collected with a single bulk statistics call per host
+    and the aggregates are computed with NumPy.
+
+    :param connection: libvirt connection URI, overriding defaults.
+                       Pass a list of URIs to compute the figures of several hosts at once.
+    :param username: username to connect with, overriding defaults
+    :param password: password to connect with, overriding defaults
+
+    .. code-block:: python
+
+        {
+            'qemu:///system': {
+                'cpus': <int>,
+                'phymemory': <int, MiB>,
+                'domains': {'active': <int>, 'inactive': <int>},
+                'vcpus': {'active': <int>, 'all': <int>},
+                'vcpu_ratio': <float, active vCPUs per physical CPU>,
+                'memory': {'committed': <int, KiB>, 'committed_all': <int, KiB>, 'current': <int, KiB>},
+                'memory_ratio': <float, committed memory of the active domains per physical memory>,
+                'numa': [{'cell': 0, 'total': <int, KiB>, 'free': <int, KiB>,
+                          'committed': <int, KiB>, 'pressure': <float>}, ...]
+            },
+            ...
+        }
+
+    When no connection or a single one is passed, the values for the host
+    are returned directly rather than indexed by URI.
+
+    The NUMA ``pressure`` is the memory committed to the active domains on the cell
+    per total memory of the cell. The memory of domains with a ``numatune`` nodeset is
+    split evenly on the cells of the nodeset, the memory of the other domains is
+    split evenly on all the cells. The bulk statistics don't report the NUMA placement:
+    the definition of a running domain is only read the first time it is seen after
+    being started, a placement changed on a running domain is only seen after a restart.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' virt.node.capacity
+        salt '*' virt.node.capacity connection='[qemu+ssh://host1/system, qemu+ssh://host2/system]'
+    '''
+    uris = list(connection) if isinstance(connection, (list, tuple)) else [connection]
+
+    async def _collect(uri):
+        conn = await hub.exec.virt.util.get_conn(uri, username, password)
+        try:
+            return await asyncio.get_event_loop().run_in_executor(
+                None, _capacity_raw, hub, uri or hub.OPT['virt']['uri'], conn)
+        finally:
+            conn.close()
+
+    raws = await asyncio.gather(*[_collect(uri) for uri in uris])
+    hosts = _capacity_compute(raws)
+    if not isinstance(connection, (list, tuple)):
+        return hosts[0]
+    return dict(zip(uris, hosts))
+
+
+async def capabilities(hub, connection=None, username=None, password=None):
+    '''
+    Return a compact view of the host and guests capabilities.
+
+    The capabilities XML documents are only fetched and parsed once per
+    connection URI, libvirt version and host boot.
+
+    :param connection: libvirt connection URI, overriding defaults
+    :param username: username to connect with, overriding defaults
+    :param password: password to connect with, overriding defaults
+
+    .. code-block:: python
+
+        {
+            'host': {
+                'arch': 'x86_64',
+                'model': 'Skylake-Client-IBRS',
+                'vendor': 'Intel',
+                'topology': {'sockets': 1, 'dies': 1, 'cores': 4, 'threads': 2},
+                'pages': [4, 2048, 1048576],
+            },
+            'guests': {
+                'x86_64': {
+                    'os_types': ['hvm'],
+                    'domain_types': ['qemu', 'kvm'],
+                    'machines': ['pc-i440fx-4.2', 'pc', 'pc-q35-4.2', 'q35', ...],
+                },
+            },
+            'domain': {
+                'path': '/usr/bin/qemu-system-x86_64',
+                'domain_type': 'kvm',
+                'machine': 'pc-i440fx-4.2',
+                'arch': 'x86_64',
+                'vcpu_max': 255,
+                'cpu_modes': ['host-passthrough', 'host-model', 'custom'],
+            },
+        }
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' virt.node.capabilities
+    '''
+    # Never hand out the cached value: a caller changing it would alter the later results
+    return copy.deepcopy((await _node_caps(hub, connection, username, password))['capabilities'])
+
+
+async def topology(hub, connection=None, username=None, password=None):
+    '''
+    Return the NUMA topology of the host: the cells with their memory, huge pages,
+    distances and CPUs with their siblings.
+
+    The capabilities XML document is only fetched and parsed once per connection URI,
+    libvirt version and host boot.
+
+    :param connection: libvirt connection URI, overriding defaults
+    :param username: username to connect with, overriding defaults
+    :param password: password to connect with, overriding defaults
+
+    .. code-block:: python
+
+        {
+            'cpus': 8,
+            'pages': {4: 2012345, 2048: 512},
+            'cells': [
+                {
+                    'id': 0,
+                    'memory': 16384000,
+                    'pages': {4: 2012345, 2048: 512, 1048576: 0},
+                    'distances': {0: 10, 1: 21},
+                    'cpus': [
+                        {'id': 0, 'socket': 0, 'die': 0, 'core': 0, 'siblings': [0, 4]},
+                        ...
+                    ],
+                },
+            ],
+        }
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' virt.node.topology
+    '''
+    return copy.deepcopy((await _node_caps(hub, connection, username, password))['topology'])
+
+
+async def devices(hub, connection=None, username=None, password=None):
+    '''
+    Return the PCI and mediated host devices with the domains they are assigned to,
+    and the free and assigned virtual functions of each SR-IOV physical function.
+
+    The node devices are listed with one bulk call. Their XML descriptions are
+    only fetched and parsed again when the list of devices, the libvirt version or
+    the host boot change, except for the PCI devices drivers: they change when a
+    device is detached for an assignment and are read again on every call. The domains definitions are parsed once to find both
+    their ``hostdev`` devices and their ``hostdev`` or ``direct`` interfaces. Several
+    domains can use the same device with ``direct`` interfaces: the domains are listed
+    for each device.
+
+    :param connection: libvirt connection URI, overriding defaults
+    :param username: username to connect with, overriding defaults
+    :param password: password to connect with, overriding defaults
+
+    .. code-block:: python
+
+        {
+            'devices': {
+                'pci_0000_3b_00_0': {
+                    'type': 'pci',
+                    'address': '0000:3b:00.0',
+                    'parent': 'pci_0000_3a_00_0',
+                    'driver': 'ixgbe',
+                    'vendor': 'Intel Corporation',
+                    'product': '82599ES 10-Gigabit SFI/SFP+ Network Connection',
+                    'interfaces': ['ens1f0'],
+                    'domains': [],
+                },
+                'pci_0000_3b_10_0': {'type': 'pci', 'address': '0000:3b:10.0', ..., 'domains': ['vm01']},
+                'mdev_4b20d080_1b54_4048_85b3_a6a62d165c01_0000_5e_00_0': {
+                    'type': 'mdev',
+                    'uuid': '4b20d080-1b54-4048-85b3-a6a62d165c01',
+                    'mdev_type': 'nvidia-63',
+                    'parent': 'pci_0000_5e_00_0',
+                    'interfaces': [],
+                    'domains': ['vm02'],
+                },
+                ...
+            },
+            'physical_functions': {
+                'pci_0000_3b_00_0': {
+                    'max': 64,
+                    'assigned': {'pci_0000_3b_10_0': ['vm01']},
+                    'free': ['pci_0000_3b_10_2', ...],
+                },
+            },
+        }
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' virt.node.devices
+    '''
+    uri = connection or hub.OPT['virt']['uri']
+    conn = await hub.exec.virt.util.get_conn(connection, username, password)
+    try:
+        return await asyncio.get_event_loop().run_in_executor(None, _devices, hub, uri, conn)
+    finally:
+        conn.close()
+
+
 def _node_info(conn):
     '''
     Internal variant of node_info taking a libvirt connection as parameter
@@ -191,6 +423,153 @@ def _node_info(conn):
     return info
 
 
+def _capacity_raw(hub, uri, conn):
+    '''
+    Collect the raw figures needed to compute the capacity of a host.
+
+    The NUMA placement of the running domains is cached by domain UUID and ID,
+    the ID changing each time a domain is started.
+
+    This function is blocking and is meant to be run in an executor.
+    '''
+    import libvirt  # pylint: disable=import-error
+
+    node = conn.getInfo()
+    cells = []
+    for cell in range(node[4]):
+        try:
+            cell_stats = conn.getMemoryStats(cell)
+        except Exception:  # pylint: disable=broad-except
+            break
+        cells.append((cell_stats.get('total', 0), cell_stats.get('free', 0)))
+
+    states = []
+    vcpus = []
+    max_mem = []
+    cur_mem = []
+    placement = []
+    stats = libvirt.VIR_DOMAIN_STATS_STATE | libvirt.VIR_DOMAIN_STATS_VCPU | libvirt.VIR_DOMAIN_STATS_BALLOON
+    for dom, dom_stats in conn.getAllDomainStats(stats):
+        state = dom_stats.get('state.state', 0)
+        states.append(state)
+        vcpus.append(dom_stats.get('vcpu.current', dom_stats.get('vcpu.maximum', 0)))
+        max_mem.append(dom_stats.get('balloon.maximum', 0))
+        cur_mem.append(dom_stats.get('balloon.current', 0))
+        if state == VIR_DOMAIN_SHUTOFF:
+            # Not using any memory
+            placement.append([0.0] * len(cells))
+            continue
+        key = (uri, dom.UUIDString(), dom.ID(), len(cells))
+        shares = hub.virt.cache.get('domain_numa_cells', key)
+        if shares is None:
+            shares = _domain_cells(ElementTree.fromstring(dom.XMLDesc(0)), len(cells))
+            hub.virt.cache.set('domain_numa_cells', key, shares, size=4096)
+        placement.append(shares)
+
+    return {
+        'cpus': node[2],
+        'phymemory': node[1],
+        'states': states,
+        'vcpus': vcpus,
+        'max_mem': max_mem,
+        'cur_mem': cur_mem,
+        'placement': placement,
+        'cells': cells,
+    }
+
+
+def _parse_nodeset(nodeset):
+    '''
+    Return the set of NUMA cells of a libvirt nodeset like ``0-3,^2``
+    '''
+    included = set()
+    excluded = set()
+    for part in nodeset.replace(' ', '').split(','):
+        target = included
+        if part.startswith('^'):
+            target = excluded
+            part = part[1:]
+        if not part:
+            continue
+        if '-' in part:
+            start, end = part.split('-', 1)
+            target.update(range(int(start), int(end) + 1))
+        else:
+            target.add(int(part))
+    return included - excluded
+
+
+def _domain_cells(doc, count):
+    '''
+    Return the share of the domain memory on each of the count host NUMA cells
+    '''
+    if not count:
+        return []
+    nodes = set()
+    for memory in doc.findall('numatune/memory') + doc.findall('numatune/memnode'):
+        if memory.get('nodeset'):
+            nodes.update(_parse_nodeset(memory.get('nodeset')))
+    nodes = [node for node in nodes if node < count] or range(count)
+    return [1.0 / len(nodes) if cell in nodes else 0.0 for cell in range(count)]
+
+
+def _capacity_compute(raws):
+    '''
+    Compute the capacity figures of hosts from their raw figures.
+
+    The domains of all the hosts are concatenated to compute the per host sums
+    in a few array operations.
+    '''
+    import numpy
+
+    count = len(raws)
+    host_index = numpy.repeat(numpy.arange(count), [len(raw['states']) for raw in raws])
+
+    def _concat(key):
+        return numpy.concatenate([numpy.asarray(raw[key], dtype=numpy.float64) for raw in raws])
+
+    active = _concat('states') != VIR_DOMAIN_SHUTOFF
+    vcpus = _concat('vcpus')
+    max_mem = _concat('max_mem')
+
+    def _sums(weights):
+        return numpy.bincount(host_index, weights=weights, minlength=count).tolist()
+
+    active_counts = _sums(active.astype(numpy.float64))
+    all_counts = numpy.bincount(host_index, minlength=count).tolist()
+    active_vcpus = _sums(vcpus * active)
+    all_vcpus = _sums(vcpus)
+    committed = _sums(max_mem * active)
+    committed_all = _sums(max_mem)
+    current = _sums(_concat('cur_mem') * active)
+    offsets = numpy.cumsum([len(raw['states']) for raw in raws])[:-1]
+    cells_committed = [
+        numpy.dot(host_mem, numpy.asarray(raw['placement'], dtype=numpy.float64).reshape(-1, len(raw['cells'])))
+        .tolist() for raw, host_mem in zip(raws, numpy.split(max_mem * active, offsets))
+    ]
+
+    hosts = []
+    for index, raw in enumerate(raws):
+        phymemory_kib = raw['phymemory'] * 1024
+        hosts.append({
+            'cpus': raw['cpus'],
+            'phymemory': raw['phymemory'],
+            'domains': {'active': int(active_counts[index]),
+                        'inactive': int(all_counts[index] - active_counts[index])},
+            'vcpus': {'active': int(active_vcpus[index]), 'all': int(all_vcpus[index])},
+            'vcpu_ratio': active_vcpus[index] / raw['cpus'] if raw['cpus'] else None,
+            'memory': {'committed': int(committed[index]),
+                       'committed_all': int(committed_all[index]),
+                       'current': int(current[index])},
+            'memory_ratio': committed[index] / phymemory_kib if phymemory_kib else None,
+            'numa': [{'cell': cell, 'total': total, 'free': free,
+                      'committed': int(round(cells_committed[index][cell])),
+                      'pressure': cells_committed[index][cell] / total if total else None}
+                     for cell, (total, free) in enumerate(raw['cells'])],
+        })
+    return hosts
+
+
 def _parse_pools_caps(doc):
     '''
     Parse libvirt pool capabilities XML
@@ -219,6 +598,270 @@ def _parse_pools_caps(doc):
     return [_parse_pool_caps(pool) for pool in doc.findall('pool')]
 
 
+async def _node_caps(hub, connection, username, password):
+    '''
+    Return the parsed capabilities and topology, cached per URI, libvirt version and host boot
+    '''
+    uri = connection or hub.OPT['virt']['uri']
+    conn = await hub.exec.virt.util.get_conn(connection, username, password)
+    try:
+        return await asyncio.get_event_loop().run_in_executor(None, _caps, hub, uri, conn)
+    finally:
+        conn.close()
+
+
+def _caps(hub, uri, conn):
+    '''
+    Blocking part of ``_node_caps``, run in an executor
+    '''
+    key = (uri, conn.getLibVersion(), _boot_id(uri))
+    ret = hub.virt.cache.get('node_capabilities', key)
+    if ret is None:
+        ret = _parse_capabilities(ElementTree.fromstring(conn.getCapabilities()))
+        try:
+            domain_caps = ElementTree.fromstring(conn.getDomainCapabilities(None, None, None, None, 0))
+            ret['capabilities']['domain'] = _parse_domain_capabilities(domain_caps)
+        except Exception:  # pylint: disable=broad-except
+            # Not all the drivers implement the domain capabilities
+            ret['capabilities']['domain'] = None
+        hub.virt.cache.set('node_capabilities', key, ret)
+    return ret
+
+
+def _boot_id(uri):
+    '''
+    Return the boot ID of the host for local URIs, ``None`` for the remote hosts
+    '''
+    if urllib.parse.urlparse(uri or '').hostname:
+        return None
+    try:
+        with open('/proc/sys/kernel/random/boot_id') as fp_:
+            return fp_.read().strip()
+    except (OSError, IOError):
+        return None
+
+
+def _parse_cpuset(value):
+    '''
+    Parse a libvirt CPU list like ``0-3,8,10-11`` into a list of integers
+    '''
+    cpus = []
+    for part in (value or '').split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            cpus.extend(range(int(first), int(last) + 1))
+        elif part.strip():
+            cpus.append(int(part))
+    return cpus
+
+
+def _parse_pages(node):
+    '''
+    Return the huge pages counts of a cell indexed by size in KiB
+    '''
+    return {int(pages.get('size')): int(pages.text or 0) for pages in node.findall('pages')}
+
+
+def _parse_capabilities(doc):
+    '''
+    Parse the libvirt capabilities XML into the capabilities and topology structures
+    '''
+    host_cpu = doc.find('host/cpu')
+    host = {'arch': None, 'model': None, 'vendor': None, 'topology': {}, 'pages': []}
+    if host_cpu is not None:
+        cpu_topology = host_cpu.find('topology')
+        host.update({
+            'arch': host_cpu.findtext('arch'),
+            'model': host_cpu.findtext('model'),
+            'vendor': host_cpu.findtext('vendor'),
+            'topology': {key: int(value) for key, value in cpu_topology.attrib.items()}
+                        if cpu_topology is not None else {},
+            'pages': sorted(int(pages.get('size')) for pages in host_cpu.findall('pages')),
+        })
+
+    guests = {}
+    for guest in doc.findall('guest'):
+        arch = guest.find('arch')
+        entry = guests.setdefault(arch.get('name'), {'os_types': [], 'domain_types': [], 'machines': []})
+        for values, found in ((entry['os_types'], [guest.findtext('os_type')]),
+                              (entry['domain_types'], [domain.get('type') for domain in arch.findall('domain')]),
+                              (entry['machines'], [machine.text for machine in arch.findall('machine')] +
+                               [machine.text for machine in arch.findall('domain/machine')])):
+            values.extend(value for value in found if value and value not in values)
+
+    cells = []
+    total_pages = {}
+    for cell in doc.findall('host/topology/cells/cell'):
+        pages = _parse_pages(cell)
+        for size, count in pages.items():
+            total_pages[size] = total_pages.get(size, 0) + count
+        cells.append({
+            'id': int(cell.get('id')),
+            'memory': int(cell.findtext('memory') or 0),
+            'pages': pages,
+            'distances': {int(sibling.get('id')): int(sibling.get('value'))
+                          for sibling in cell.findall('distances/sibling')},
+            'cpus': [{'id': int(cpu.get('id')),
+                      'socket': int(cpu.get('socket_id')) if cpu.get('socket_id') else None,
+                      'die': int(cpu.get('die_id')) if cpu.get('die_id') else None,
+                      'core': int(cpu.get('core_id')) if cpu.get('core_id') else None,
+                      'siblings': _parse_cpuset(cpu.get('siblings'))}
+                     for cpu in cell.findall('cpus/cpu')],
+        })
+
+    return {
+        'capabilities': {'host': host, 'guests': guests},
+        'topology': {
+            'cpus': sum(len(cell['cpus']) for cell in cells),
+            'pages': total_pages,
+            'cells': cells,
+        },
+    }
+
+
+def _parse_domain_capabilities(doc):
+    '''
+    Parse the libvirt domain capabilities XML
+    '''
+    vcpu = doc.find('vcpu')
+    return {
+        'path': doc.findtext('path'),
+        'domain_type': doc.findtext('domain'),
+        'machine': doc.findtext('machine'),
+        'arch': doc.findtext('arch'),
+        'vcpu_max': int(vcpu.get('max')) if vcpu is not None else None,
+        'cpu_modes': [mode.get('name') for mode in doc.findall('cpu/mode') if mode.get('supported') == 'yes'],
+    }
+
+
+def _devices(hub, uri, conn):
+    '''
+    Blocking computation of the node devices assignments, run in an executor
+    '''
+    # VIR_CONNECT_LIST_NODE_DEVICES_CAP_PCI_DEV | CAP_NET | CAP_MDEV
+    node_devices = conn.listAllDevices(2 | 16 | 16384)
+    names = sorted(device.name() for device in node_devices)
+    key = (uri, conn.getLibVersion(), _boot_id(uri), tuple(names))
+    # The drivers are not cached: binding a device to vfio-pci doesn't change the other values
+    pci_docs = {device.name(): ElementTree.fromstring(device.XMLDesc(0))
+                for device in node_devices if device.name().startswith('pci_')}
+    drivers = {name: doc.findtext('driver/name') for name, doc in pci_docs.items()}
+    parsed = hub.virt.cache.get('node_devices', key)
+    if parsed is None:
+        parsed = [_parse_node_device(pci_docs[device.name()] if device.name() in pci_docs
+                                     else ElementTree.fromstring(device.XMLDesc(0)))
+                  for device in node_devices]
+        hub.virt.cache.set('node_devices', key, parsed, size=16)
+
+    ret = {'devices': {}, 'physical_functions': {}}
+    by_address = {}
+    by_interface = {}
+    virt_functions = {}
+    for device in parsed:
+        if device['type'] == 'net':
+            by_interface[device['interface']] = device['parent']
+            continue
+        entry = {key: value for key, value in device.items() if key not in ('name', 'vfs', 'max_vfs')}
+        if device['type'] == 'pci':
+            entry['driver'] = drivers.get(device['name'])
+        entry.update({'interfaces': [], 'domains': []})
+        ret['devices'][device['name']] = entry
+        by_address[device.get('address') or device.get('uuid') or device['name']] = device['name']
+        if device.get('vfs') is not None:
+            virt_functions[device['name']] = (device['max_vfs'], device['vfs'])
+    for interface, parent in sorted(by_interface.items()):
+        if parent in ret['devices']:
+            ret['devices'][parent]['interfaces'].append(interface)
+
+    for dom in conn.listAllDomains(0):
+        for assigned in _domain_host_devices(ElementTree.fromstring(dom.XMLDesc(0))):
+            name = by_address.get(assigned) or by_interface.get(assigned)
+            if name in ret['devices'] and dom.name() not in ret['devices'][name]['domains']:
+                ret['devices'][name]['domains'].append(dom.name())
+    for entry in ret['devices'].values():
+        entry['domains'].sort()
+
+    for name, (max_vfs, vfs) in virt_functions.items():
+        pf_entry = {'max': max_vfs, 'assigned': {}, 'free': []}
+        for address in vfs:
+            vf_name = by_address.get(address)
+            if vf_name is None:
+                continue
+            domains = ret['devices'][vf_name]['domains']
+            if domains:
+                pf_entry['assigned'][vf_name] = domains
+            else:
+                pf_entry['free'].append(vf_name)
+        pf_entry['free'].sort()
+        ret['physical_functions'][name] = pf_entry
+    return ret
+
+
+def _pci_address(node):
+    '''
+    Format a libvirt PCI address element as ``dddd:bb:ss.f``
+    '''
+    return '{:04x}:{:02x}:{:02x}.{:x}'.format(*[int(node.get(attr), 0)
+                                                for attr in ('domain', 'bus', 'slot', 'function')])
+
+
+def _parse_node_device(doc):
+    '''
+    Parse a node device XML description into the values needed to compute the assignments.
+    The driver of the PCI devices is left out to be read on each query.
+    '''
+    device = {'name': doc.findtext('name'), 'parent': doc.findtext('parent')}
+    cap = doc.find('capability')
+    cap_type = cap.get('type') if cap is not None else None
+    if cap_type == 'net':
+        device.update({'type': 'net', 'interface': cap.findtext('interface')})
+    elif cap_type == 'pci':
+        address = '{:04x}:{:02x}:{:02x}.{:x}'.format(*[int(cap.findtext(tag) or 0)
+                                                       for tag in ('domain', 'bus', 'slot', 'function')])
+        device.update({
+            'type': 'pci',
+            'address': address,
+            'vendor': cap.findtext('vendor'),
+            'product': cap.findtext('product'),
+        })
+        vfs = cap.find("capability[@type='virt_functions']")
+        if vfs is not None:
+            device['max_vfs'] = int(vfs.get('maxCount', 0))
+            device['vfs'] = [_pci_address(address) for address in vfs.findall('address')]
+    else:
+        device.update({'type': cap_type})
+        if cap_type == 'mdev':
+            device['mdev_type'] = cap.find('type').get('id') if cap.find('type') is not None else None
+            # The name is mdev_<uuid> or mdev_<uuid>_<parent address> and the uuid capability
+            # is missing on older libvirt versions
+            mdev_uuid = cap.findtext('uuid') or device['name'][len('mdev_'):len('mdev_') + 36].replace('_', '-')
+            device['uuid'] = mdev_uuid.lower()
+    return device
+
+
+def _domain_host_devices(doc):
+    '''
+    Return the PCI addresses, mediated devices UUIDs and host interfaces used by a domain
+    '''
+    ret = []
+    for hostdev in doc.iterfind('devices/hostdev'):
+        address = hostdev.find('source/address')
+        if address is None:
+            continue
+        if hostdev.get('type') == 'pci':
+            ret.append(_pci_address(address))
+        elif hostdev.get('type') == 'mdev':
+            ret.append(address.get('uuid', '').lower())
+    for interface in doc.iterfind('devices/interface'):
+        if interface.get('type') == 'hostdev':
+            address = interface.find('source/address')
+            if address is not None:
+                ret.append(_pci_address(address))
+        elif interface.get('type') == 'direct' and interface.find('source') is not None:
+            ret.append(interface.find('source').get('dev'))
+    return ret
+
+
 async def _is_kvm_hyper(hub):
     '''
     Returns a bool whether or not this node is a KVM hypervisor
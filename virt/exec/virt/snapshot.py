@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+# The heavier modules, like libvirt, are imported where needed to keep the CLI startup fast
+import asyncio
+import sys
+import time
+from xml.etree import ElementTree
+
+__contracts__ = ['coalesce']
+
+
+def __init__(hub):
+    hub.virt.instrument.register('snapshot', sys.modules[__name__], ['_domain_snapshots', '_parse_snapshot'])
+
+
+async def tree(hub, vm_=None, workers=16, connection=None, username=None, password=None):
+    '''
+    Return the snapshots of the domains as a tree per domain.
+
+    Both the internal and external snapshots are reported. The snapshots of
+    the domains are fetched concurrently by at most ``workers`` threads.
+
+    :param vm_: name of the domain, all domains if omitted
+    :param workers: maximum number of domains queried at the same time
+    :param connection: libvirt connection URI, overriding defaults
+    :param username: username to connect with, overriding defaults
+    :param password: password to connect with, overriding defaults
+
+    .. code-block:: python
+
+        {
+            'your-vm': [
+                {
+                    'name': 'base',
+                    'description': 'Fresh install',
+                    'state': 'shutoff',
+                    'creation_time': 1588001234,
+                    'current': False,
+                    'external': False,
+                    'memory': 'no',
+                    'disks': {'vda': {'snapshot': 'internal', 'source': None}},
+                    'children': [
+                        {'name': 'before-upgrade', 'current': True, ..., 'children': []}
+                    ]
+                }
+            ],
+            ...
+        }
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' virt.snapshot.tree
+    '''
+    snapshots = await _gather(hub, _domain_snapshots, vm_, workers, connection, username, password)
+    return {name: _build_tree(domain_snapshots) for name, domain_snapshots in snapshots.items()}
+
+
+async def summary(hub, vm_=None, older_than=None, workers=16, connection=None, username=None, password=None):
+    '''
+    Return the number of snapshots of each domain and the age of the oldest and newest ones.
+
+    Only the snapshots list is fetched from libvirt for each domain: the creation
+    times are cached by domain UUID and snapshot name. A snapshot deleted and created
+    again with the same name keeps the time of the old one in the cache, which can
+    only make it look older: the creation time of the snapshots found older than
+    ``older_than`` is read again before listing them in ``expired``.
+
+    :param vm_: name of the domain, all domains if omitted
+    :param older_than: number of seconds, list the snapshots older than that in ``expired``
+    :param workers: maximum number of domains queried at the same time
+    :param connection: libvirt connection URI, overriding defaults
+    :param username: username to connect with, overriding defaults
+    :param password: password to connect with, overriding defaults
+
+    .. code-block:: python
+
+        {
+            'count': 12,
+            'domains': {
+                'your-vm': {'count': 3, 'oldest': <seconds>, 'newest': <seconds>},
+                'other-vm': {'count': 0, 'oldest': None, 'newest': None},
+                ...
+            },
+            'expired': {'your-vm': ['base']}
+        }
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' virt.snapshot.summary older_than=604800
+    '''
+    uri = connection or hub.OPT['virt']['uri']
+
+    now = time.time()
+
+    def _creation_times(dom):
+        return _snapshot_times(hub, uri, dom, None if older_than is None else now - older_than)
+
+    times = await _gather(hub, _creation_times, vm_, workers, connection, username, password)
+    ret = {'count': 0, 'domains': {}}
+    if older_than is not None:
+        ret['expired'] = {}
+    for name, snapshot_times in sorted(times.items()):
+        ages = [now - created for created in snapshot_times.values()]
+        ret['count'] += len(ages)
+        ret['domains'][name] = {
+            'count': len(ages),
+            'oldest': max(ages) if ages else None,
+            'newest': min(ages) if ages else None,
+        }
+        if older_than is not None:
+            expired = sorted(snap for snap, created in snapshot_times.items() if now - created > older_than)
+            if expired:
+                ret['expired'][name] = expired
+    return ret
+
+
+async def _gather(hub, func, vm_, workers, connection, username, password):
+    '''
+    Run the blocking func on each domain concurrently and return the results by domain name
+    '''
+    import concurrent.futures
+
+    conn = await hub.exec.virt.util.get_conn(connection, username, password)
+    loop = asyncio.get_event_loop()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, int(workers)))
+    try:
+        def _domains():
+            return [conn.lookupByName(vm_)] if vm_ else conn.listAllDomains(0)
+
+        domains = await loop.run_in_executor(None, _domains)
+        names = [dom.name() for dom in domains]
+        results = await asyncio.gather(*[loop.run_in_executor(executor, func, dom) for dom in domains])
+    finally:
+        executor.shutdown(wait=False)
+        conn.close()
+    return dict(zip(names, results))
+
+
+def _domain_snapshots(dom):
+    '''
+    Return the parsed metadata of all the snapshots of a domain
+    '''
+    ret = []
+    for snap in dom.listAllSnapshots(0):
+        metadata = _parse_snapshot(snap.getXMLDesc(0))
+        metadata['current'] = bool(snap.isCurrent(0))
+        ret.append(metadata)
+    return ret
+
+
+def _snapshot_times(hub, uri, dom, confirm_before=None):
+    '''
+    Return the creation time of the snapshots of a domain, by snapshot name
+
+    :param confirm_before: timestamp, the cached creation times before it are read again
+    '''
+    domain_uuid = dom.UUIDString()
+    ret = {}
+    for snap in dom.listAllSnapshots(0):
+        name = snap.getName()
+        key = (uri, domain_uuid, name)
+        created = hub.virt.cache.get('snapshot_times', key)
+        if created is None or confirm_before is not None and created < confirm_before:
+            created = _parse_snapshot(snap.getXMLDesc(0))['creation_time']
+            hub.virt.cache.set('snapshot_times', key, created, size=65536)
+        ret[name] = created
+    return ret
+
+
+def _parse_snapshot(xml):
+    '''
+    Extract the interesting values of a snapshot XML description
+    '''
+    root = ElementTree.fromstring(xml)
+    memory = root.find('memory')
+    disks = {}
+    for disk in root.findall('disks/disk'):
+        source = disk.find('source')
+        disks[disk.get('name')] = {
+            'snapshot': disk.get('snapshot'),
+            'source': source.get('file') if source is not None else None,
+        }
+    memory_snapshot = memory.get('snapshot') if memory is not None else None
+    return {
+        'name': root.findtext('name'),
+        'description': root.findtext('description'),
+        'state': root.findtext('state'),
+        'creation_time': int(root.findtext('creationTime') or 0),
+        'parent': root.findtext('parent/name'),
+        'memory': memory_snapshot,
+        'external': memory_snapshot == 'external' or
+                    any(disk['snapshot'] == 'external' for disk in disks.values()),
+        'disks': disks,
+    }
+
+
+def _build_tree(snapshots):
+    '''
+    Nest the snapshots under their parent, sorted by creation time
+    '''
+    nodes = {snap['name']: dict(snap, children=[]) for snap in snapshots}
+    roots = []
+    for node in sorted(nodes.values(), key=lambda node: (node['creation_time'], node['name'])):
+        parent = nodes.get(node.pop('parent'))
+        (parent['children'] if parent else roots).append(node)
+    return roots
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+'''
+Statistics computed from the background sampler values.
+
+The sampler needs to be started with :py:func:`start`, or by setting the
+``sampler_interval`` option when running ``virt --serve``. The query functions
+then don't make any libvirt call.
+
+The domain metrics are ``cpu.time``, ``cpu.user``, ``cpu.system``, ``balloon.current``,
+``balloon.rss``, ``net.rx.bytes``, ``net.tx.bytes``, ``block.rd.bytes``, ``block.wr.bytes``,
+``block.rd.reqs`` and ``block.wr.reqs``, the network and block values being summed
+for all the devices of the domain. The node metrics are ``node.cpu.kernel``,
+``node.cpu.user``, ``node.cpu.idle`` and ``node.cpu.iowait``.
+'''
+
+
+async def start(hub, interval=None, size=None, connection=None, username=None, password=None):
+    '''
+    Start collecting the domains and node statistics in the background.
+
+    Each domain and metric keeps ``size`` values in a preallocated buffer,
+    the oldest values being dropped.
+
+    :param interval: seconds between two samples, defaults to the ``sampler_interval`` option or 10
+    :param size: number of samples to keep, defaults to the ``sampler_size`` option or 360
+    :param connection: libvirt connection URI, overriding defaults
+    :param username: username to connect with, overriding defaults
+    :param password: password to connect with, overriding defaults
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' virt.stats.start interval=5
+    '''
+    return hub.virt.sampler.start(interval, size, connection, username, password)
+
+
+async def stop(hub):
+    '''
+    Stop the background statistics collection and drop the collected values
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' virt.stats.stop
+    '''
+    return hub.virt.sampler.stop()
+
+
+async def status(hub):
+    '''
+    Return the sampler status: the interval, the number of samples and of failed samples
+    and the number of sampled domains.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' virt.stats.status
+    '''
+    sampler = hub.virt.SAMPLER
+    if sampler is None:
+        return {'running': False}
+    return {
+        'running': True,
+        'interval': sampler['interval'],
+        'size': sampler['size'],
+        'samples': sampler['samples'],
+        'errors': sampler['errors'],
+        'domains': len(sampler['domains']),
+    }
+
+
+async def average(hub, metric, vm_=None, window=60):
+    '''
+    Return the average value of a metric over the last seconds.
+
+    :param metric: the name of the metric, like ``balloon.rss``
+    :param vm_: name of the domain, all the domains if omitted
+    :param window: number of seconds to average
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' virt.stats.average balloon.rss window=300
+    '''
+    return {name: hub.virt.sampler.average(ring.window(window))
+            for name, ring in hub.virt.sampler.series(metric, vm_).items()}
+
+
+async def rate(hub, metric, vm_=None, window=60):
+    '''
+    Return the per second increase of a counter metric over the last seconds.
+
+    :param metric: the name of the metric, like ``cpu.time`` or ``net.rx.bytes``
+    :param vm_: name of the domain, all the domains if omitted
+    :param window: number of seconds to compute the rate on
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' virt.stats.rate cpu.time
+    '''
+    return {name: hub.virt.sampler.rate(ring.window(window))
+            for name, ring in hub.virt.sampler.series(metric, vm_).items()}
+
+
+async def percentiles(hub, metric, vm_=None, window=300, rate=False, percents=(95, 99)):
+    '''
+    Return percentiles of a metric over the last seconds.
+
+    :param metric: the name of the metric
+    :param vm_: name of the domain, all the domains if omitted
+    :param window: number of seconds to compute the percentiles on
+    :param rate: compute the percentiles of the per second increase between samples
+                 rather than the raw values. Use it for counter metrics like ``cpu.time``.
+    :param percents: the percentiles to compute
+
+    .. code-block:: python
+
+        {
+            'your-vm': {'p95': <float>, 'p99': <float>},
+            ...
+        }
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' virt.stats.percentiles cpu.time rate=True
+    '''
+    ret = {}
+    for name, ring in hub.virt.sampler.series(metric, vm_).items():
+        points = ring.window(window)
+        if rate:
+            points = hub.virt.sampler.rates(points)
+        ret[name] = {'p{}'.format(percent): hub.virt.sampler.percentile(points, percent) for percent in percents}
+    return ret
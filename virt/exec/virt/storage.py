@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+# The heavier modules, like libvirt, are imported where needed to keep the CLI startup fast
+import asyncio
+import threading
+import time
+import uuid
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+WARM_PREFIX = 'warm-'
+
+# virErrorNumber of a missing storage volume
+VIR_ERR_NO_STORAGE_VOL = 50
+
+
+def __init__(hub):
+    # Volume creation slots per (URI, pool), warm overlays and number of warm overlays
+    # being created per (URI, pool, base path, capacity, full)
+    hub.virt.STORAGE_SLOTS = {}
+    hub.virt.STORAGE_WARM = {}
+    hub.virt.STORAGE_WARM_PENDING = {}
+    hub.virt.STORAGE_LOCK = threading.Lock()
+
+
+async def overlays(hub, pool, base, names, capacity=None, full=False, warm=False,
+                   connection=None, username=None, password=None):
+    '''
+    Create qcow2 overlay volumes on top of a base image in parallel.
+
+    The volumes are created with the libvirt storage API, at most ``storage_pool_workers``
+    of them at the same time in a pool, even across concurrent calls. The base image is
+    only copied if ``full`` is ``True``.
+
+    With ``warm=True`` the overlays prepared by :py:func:`warm` for the same pool, base,
+    capacity and ``full`` value are used first: since libvirt can't rename volumes, those keep their ``warm-`` name
+    and the caller needs to use the returned volume name and path.
+
+    :param pool: name of the storage pool to create the volumes in
+    :param base: name of the base volume in the pool or absolute path of the base image
+    :param names: list of the names of the volumes to create
+    :param capacity: size of the volumes in bytes, defaults to the base image capacity
+    :param full: ``True`` to create full copies of the base image rather than overlays
+    :param warm: ``True`` to use the warm overlays first
+    :param connection: libvirt connection URI, overriding defaults
+    :param username: username to connect with, overriding defaults
+    :param password: password to connect with, overriding defaults
+
+    .. code-block:: python
+
+        {
+            'web01': {'result': True, 'name': 'web01', 'path': '/srv/images/web01', 'warm': False,
+                      'time': <seconds>},
+            'web02': {'result': True, 'name': 'warm-base.qcow2-1b2c3d4e', 'path': '/srv/images/warm-...',
+                      'warm': True, 'time': 0},
+            'web03': {'result': False, 'error': '<libvirt error message>', 'time': <seconds>},
+        }
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' virt.storage.overlays default base.qcow2 "[web01, web02]"
+    '''
+    import concurrent.futures
+
+    conn_str = connection or hub.OPT['virt']['uri']
+    conn = await hub.exec.virt.util.get_conn(connection, username, password)
+    loop = asyncio.get_event_loop()
+    try:
+        pool_obj, base_vol, base_path = await loop.run_in_executor(None, _lookup, conn, pool, base)
+        ret = {}
+        to_create = list(names)
+        if warm:
+            with hub.virt.STORAGE_LOCK:
+                available = hub.virt.STORAGE_WARM.get(_warm_key(conn_str, pool, base_path, capacity, full), [])
+                while to_create and available:
+                    vol_name, path = available.pop(0)
+                    ret[to_create.pop(0)] = {'result': True, 'name': vol_name, 'path': path, 'warm': True, 'time': 0}
+
+        slots = _slots(hub, conn_str, pool)
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(len(to_create), slots.size)))
+        try:
+            template = await loop.run_in_executor(None, _volume_template, base_vol, capacity, full)
+            results = await asyncio.gather(*[
+                loop.run_in_executor(executor, _create_volume, slots, pool_obj, base_vol, template, name, full)
+                for name in to_create])
+        finally:
+            executor.shutdown(wait=False)
+        ret.update(zip(to_create, results))
+    finally:
+        conn.close()
+    return ret
+
+
+async def warm(hub, pool, base, count, capacity=None, full=False,
+               connection=None, username=None, password=None):
+    '''
+    Keep a number of overlays of a base image ready to be used by :py:func:`overlays`.
+
+    The missing warm overlays are created in parallel and the extra ones are deleted.
+    The overlays being created by concurrent calls for the same pool, base, capacity and
+    ``full`` value are counted as available. The warm overlays are only known by the
+    process that created them: this is meant to be used with a long running ``virt --serve``.
+
+    :param pool: name of the storage pool to create the volumes in
+    :param base: name of the base volume in the pool or absolute path of the base image
+    :param count: number of warm overlays to keep
+    :param capacity: size of the volumes in bytes, defaults to the base image capacity
+    :param full: ``True`` to prepare full copies of the base image rather than overlays
+    :param connection: libvirt connection URI, overriding defaults
+    :param username: username to connect with, overriding defaults
+    :param password: password to connect with, overriding defaults
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' virt.storage.warm default base.qcow2 20
+    '''
+    conn_str = connection or hub.OPT['virt']['uri']
+    conn = await hub.exec.virt.util.get_conn(connection, username, password)
+    loop = asyncio.get_event_loop()
+    try:
+        pool_obj, base_vol, base_path = await loop.run_in_executor(None, _lookup, conn, pool, base)
+        key = _warm_key(conn_str, pool, base_path, capacity, full)
+        with hub.virt.STORAGE_LOCK:
+            available = hub.virt.STORAGE_WARM.setdefault(key, [])
+            extra = available[count:]
+            del available[count:]
+            # Reserve the overlays to create so that concurrent calls don't create them too
+            pending = hub.virt.STORAGE_WARM_PENDING.get(key, 0)
+            missing = max(0, count - len(available) - pending)
+            hub.virt.STORAGE_WARM_PENDING[key] = pending + missing
+
+        created = {}
+        try:
+            deleted, errors = await loop.run_in_executor(None, _delete_volumes, pool_obj,
+                                                         [name for name, _ in extra])
+            names = ['{}{}-{}'.format(WARM_PREFIX, base_vol.name(), uuid.uuid4().hex[:8]) for _ in range(missing)]
+            created = await overlays(hub, pool, base, names, capacity=capacity, full=full,
+                                     connection=connection, username=username, password=password)
+        finally:
+            with hub.virt.STORAGE_LOCK:
+                available = hub.virt.STORAGE_WARM.setdefault(key, [])
+                available.extend((name, result['path']) for name, result in created.items() if result['result'])
+                pending = hub.virt.STORAGE_WARM_PENDING.pop(key) - missing
+                if pending:
+                    hub.virt.STORAGE_WARM_PENDING[key] = pending
+                ret = {'available': len(available)}
+    finally:
+        conn.close()
+
+    ret['created'] = sorted(name for name, result in created.items() if result['result'])
+    ret['deleted'] = deleted
+    errors.update((name, result['error']) for name, result in created.items() if not result['result'])
+    ret['errors'] = errors
+    return ret
+
+
+def _warm_key(conn_str, pool, base_path, capacity, full):
+    '''
+    Return the key of the warm overlays: only the overlays created with the same values can be used
+    '''
+    return (conn_str, pool, base_path, None if capacity is None else int(capacity), bool(full))
+
+
+def _slots(hub, conn_str, pool):
+    '''
+    Return the semaphore limiting the concurrent volume creations in a pool
+    '''
+    with hub.virt.STORAGE_LOCK:
+        slots = hub.virt.STORAGE_SLOTS.get((conn_str, pool))
+        if slots is None:
+            slots = _Slots(hub.OPT['virt'].get('storage_pool_workers') or 4)
+            hub.virt.STORAGE_SLOTS[(conn_str, pool)] = slots
+    return slots
+
+
+def _lookup(conn, pool, base):
+    '''
+    Return the storage pool and base volume objects and the base volume path
+    '''
+    pool_obj = conn.storagePoolLookupByName(pool)
+    if base.startswith('/'):
+        base_vol = conn.storageVolLookupByPath(base)
+    else:
+        base_vol = pool_obj.storageVolLookupByName(base)
+    return pool_obj, base_vol, base_vol.path()
+
+
+def _volume_template(base_vol, capacity, full):
+    '''
+    Return the volume XML definition with a ``{name}`` slot
+    '''
+    base_format = ElementTree.fromstring(base_vol.XMLDesc(0)).find('target/format')
+    base_format = base_format.get('type') if base_format is not None else 'raw'
+    if capacity is None:
+        # virStorageVolGetInfo returns (type, capacity, allocation)
+        capacity = base_vol.info()[1]
+    backing = '' if full else '''
+  <backingStore>
+    <path>{}</path>
+    <format type='{}'/>
+  </backingStore>'''.format(escape(base_vol.path()), base_format)
+    return '''<volume>
+  <name>{{name}}</name>
+  <capacity unit='bytes'>{}</capacity>
+  <target>
+    <format type='qcow2'/>
+  </target>{}
+</volume>'''.format(int(capacity), backing.replace('{', '{{').replace('}', '}}'))
+
+
+def _create_volume(slots, pool_obj, base_vol, template, name, full):
+    '''
+    Create a volume once a slot is free in the pool. Run in an executor.
+    '''
+    start = time.monotonic()
+    with slots:
+        try:
+            xml = template.format(name=escape(name))
+            vol = pool_obj.createXMLFrom(xml, base_vol, 0) if full else pool_obj.createXML(xml, 0)
+            return {'result': True, 'name': name, 'path': vol.path(), 'warm': False,
+                    'time': time.monotonic() - start}
+        except Exception as err:  # pylint: disable=broad-except
+            return {'result': False, 'error': str(err), 'time': time.monotonic() - start}
+
+
+def _delete_volumes(pool_obj, names):
+    '''
+    Delete the volumes, ignoring the already deleted ones.
+
+    Return the names of the deleted volumes and the other errors by volume name.
+    '''
+    import libvirt  # pylint: disable=import-error
+
+    deleted = []
+    errors = {}
+    for name in names:
+        try:
+            pool_obj.storageVolLookupByName(name).delete(0)
+            deleted.append(name)
+        except libvirt.libvirtError as err:
+            if err.get_error_code() != VIR_ERR_NO_STORAGE_VOL:
+                errors[name] = str(err)
+    return deleted, errors
+
+
+class _Slots:
+    '''
+    Semaphore with a known size
+    '''
+
+    def __init__(self, size):
+        self.size = size
+        self._semaphore = threading.BoundedSemaphore(size)
+
+    def __enter__(self):
+        self._semaphore.acquire()
+
+    def __exit__(self, *args):
+        self._semaphore.release()
@@ -1,4 +1,5 @@
-import libvirt
+# libvirt is imported where needed to keep the CLI startup fast
+import asyncio
 import logging
 
 log = logging.getLogger(__name__)
@@ -24,6 +25,8 @@ def __get_request_auth(hub, username, password):
 
         The user_data argument is currently not set in the openAuth call.
         '''
+        import libvirt  # pylint: disable=import-error
+
         for credential in credentials:
             if credential[0] == libvirt.VIR_CRED_AUTHNAME:
                 credential[4] = username if username else hub.OPT['virt'].get('username', credential[3])
@@ -34,7 +37,7 @@ def __get_request_auth(hub, username, password):
         return 0
 
 
-async def get_conn(hub, connection=None, username=None, password=None):
+async def get_conn(hub, connection=None, username=None, password=None, shard=0):
     '''
     Detects what type of dom this node is and attempts to connect to the
     correct hypervisor via libvirt.
@@ -42,19 +45,117 @@ async def get_conn(hub, connection=None, username=None, password=None):
     :param connection: libvirt connection URI, overriding defaults
     :param username: username to connect with, overriding defaults
     :param password: password to connect with, overriding defaults
+    :param shard: index of the parallel connection to the same URI, see ``hub.virt.shard``
 
+    When the connections pool is enabled, like in ``virt --serve``, an alive pooled
+    connection is returned if any and closing it is a no-op.
     '''
+    import libvirt  # pylint: disable=import-error
+
     conn_str = connection or hub.OPT['virt']['uri']
 
+    pool_key = (conn_str, username, password) + ((shard,) if shard else ())
+    conn = hub.virt.pool.get(pool_key)
+    if conn is None:
+        try:
+            auth_types = [libvirt.VIR_CRED_AUTHNAME,
+                          libvirt.VIR_CRED_NOECHOPROMPT,
+                          libvirt.VIR_CRED_ECHOPROMPT,
+                          libvirt.VIR_CRED_PASSPHRASE,
+                          libvirt.VIR_CRED_EXTERNAL]
+            conn = await asyncio.get_event_loop().run_in_executor(
+                None, libvirt.openAuth, conn_str, [auth_types, __get_request_auth(hub, username, password), None], 0)
+        except Exception:  # pylint: disable=broad-except
+            raise Exception(
+                'Sorry, failed to open a connection to the hypervisor software at {0}'.format(conn_str)
+            )
+        conn = hub.virt.pool.put(pool_key, conn)
+    conn = hub.virt.instrument.wrap_conn(conn)
+    return hub.virt.governor.wrap(conn, conn_str)
+
+
+async def governor_stats(hub):
+    '''
+    Return the libvirt calls governor counters per connection URI.
+
+    For each of the ``lifecycle`` and ``inventory`` priorities, the number of calls,
+    the number of calls that had to be queued and the time spent in the queue are
+    reported.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' virt.util.governor_stats
+    '''
+    return hub.virt.governor.stats()
+
+
+async def instrument_stats(hub, reset=False):
+    '''
+    Return the count and latency histogram of the recorded libvirt calls and internal helpers.
+
+    The values are only recorded when the ``instrument`` option is set.
+
+    :param reset: clear the recorded values after reading them
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' virt.util.instrument_stats
+    '''
+    return hub.virt.instrument.stats(reset)
+
+
+async def coalesce_stats(hub):
+    '''
+    Return the number of executions of the coalesced exec functions, the number of calls
+    that waited for an identical call in progress and the number of calls that reused a
+    recorded result.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' virt.util.coalesce_stats
+    '''
+    return hub.virt.coalesce.stats()
+
+
+async def profile(hub, ref, *args, **kwargs):
+    '''
+    Run an exec function and report the count and latency of the libvirt calls
+    and internal helpers it used.
+
+    Calls made concurrently by other executions on the same hub are recorded too.
+
+    :param ref: the reference of the function to run relative to ``exec``, like ``virt.domain.info``
+    :param args: the positional arguments to pass to the function
+    :param kwargs: the keyword arguments to pass to the function
+
+    .. code-block:: python
+
+        {
+            'return': <the function return value>,
+            'profile': {
+                'domain._get_disks': {'count': <int>, 'total': <float>, 'mean': <float>,
+                                      'min': <float>, 'max': <float>, 'histogram': {...}},
+                'libvirt.virDomain.XMLDesc': {...},
+                ...
+            }
+        }
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' virt.util.profile virt.domain.info
+    '''
+    func = getattr(hub, 'exec.{}'.format(ref))
+    profile = hub.virt.instrument.start_profile()
     try:
-        auth_types = [libvirt.VIR_CRED_AUTHNAME,
-                      libvirt.VIR_CRED_NOECHOPROMPT,
-                      libvirt.VIR_CRED_ECHOPROMPT,
-                      libvirt.VIR_CRED_PASSPHRASE,
-                      libvirt.VIR_CRED_EXTERNAL]
-        conn = libvirt.openAuth(conn_str, [auth_types, __get_request_auth(hub, username, password), None], 0)
-    except Exception:  # pylint: disable=broad-except
-        raise Exception(
-            'Sorry, failed to open a connection to the hypervisor software at {0}'.format(conn_str)
-        )
-    return conn
+        ret = await func(*args, **kwargs)
+    finally:
+        report = hub.virt.instrument.stop_profile(profile)
+    return {'return': ret, 'profile': report}
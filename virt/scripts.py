@@ -1,6 +1,69 @@
 #!/usr/bin/env python3
-import pop.hub
+import json
+import os
+import socket
+import sys
+import tempfile
+
 
 def start():
+    if _client(sys.argv[1:]):
+        return
+    # Only pay for the hub when no virt --serve server answered
+    import pop.hub
     hub = pop.hub.Hub()
     hub.pop.sub.add('virt.virt')
+    hub.virt.init.cli()
+
+
+def default_socket():
+    '''
+    Return the default path of the ``virt --serve`` socket.
+
+    The ``VIRT_SOCKET`` environment variable overrides it for the command line client.
+    '''
+    if os.environ.get('VIRT_SOCKET'):
+        return os.environ['VIRT_SOCKET']
+    if os.geteuid() == 0:
+        return '/run/virt.sock'
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+    return os.path.join(runtime_dir, 'virt-{}.sock'.format(os.geteuid()))
+
+
+def _client(argv):
+    '''
+    Forward the exec call to a running ``virt --serve`` server and print its result.
+
+    Returns ``False`` if the call needs to be run locally: when options are passed
+    or when no server is listening.
+    '''
+    if not argv or [arg for arg in argv if arg.startswith('-')]:
+        return False
+    path = default_socket()
+    if not os.path.exists(path):
+        return False
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return False
+    try:
+        sock.sendall(json.dumps({'id': 0, 'ref': argv[0], 'args': argv[1:]}).encode() + b'\n')
+        data = b''
+        while not data.endswith(b'\n'):
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    finally:
+        sock.close()
+    if not data:
+        sys.stderr.write('The virt server at {} closed the connection\n'.format(path))
+        sys.exit(1)
+    ret = json.loads(data.decode())
+    if 'error' in ret:
+        sys.stderr.write('{}\n'.format(ret['error']))
+        sys.exit(1)
+    print(json.dumps(ret['return'], indent=2, default=str))
+    return True
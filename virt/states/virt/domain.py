@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+'''
+Management of the libvirt domains
+=================================
+
+.. code-block:: yaml
+
+    vm01:
+      virt.domain.running:
+        - xml: |
+            <domain type='kvm'>
+              ...
+            </domain>
+
+    old_vm:
+      virt.domain.absent
+
+The libvirt definition of a domain never matches the desired XML literally:
+libvirt adds the UUID, the MAC and PCI addresses and many default values. When
+defining a domain, the fingerprint of the canonical desired XML and the one of
+the resulting libvirt definition are stored in the domain metadata. A domain is
+then unchanged when both fingerprints still match, which only costs fetching its
+XML definition. The fingerprints are cached by the raw XML text to avoid parsing
+the same definitions over and over.
+'''
+# The heavier modules, like libvirt, are imported where needed to keep the CLI startup fast
+import asyncio
+import hashlib
+from xml.etree import ElementTree
+
+METADATA_NS = 'https://github.com/cbosdo/idem_provider_libvirt/fingerprint'
+METADATA_PREFIX = 'virt'
+METADATA_TAG = '{{{}}}fingerprint'.format(METADATA_NS)
+# Libvirt constants, kept here to avoid importing libvirt for them
+VIR_DOMAIN_XML_INACTIVE = 2
+VIR_DOMAIN_METADATA_ELEMENT = 2
+VIR_DOMAIN_AFFECT_CONFIG = 2
+VIR_ERR_NO_DOMAIN = 42
+VIR_DOMAIN_RUNNING = 1
+VIR_DOMAIN_PAUSED = 3
+VIR_DOMAIN_UNDEFINE_MANAGED_SAVE = 1
+VIR_DOMAIN_UNDEFINE_SNAPSHOTS_METADATA = 2
+VIR_DOMAIN_UNDEFINE_NVRAM = 4
+VIR_DOMAIN_UNDEFINE_CHECKPOINTS_METADATA = 16
+# Drop everything libvirt keeps along with the definition, undefine() fails when any of it exists
+VIR_DOMAIN_UNDEFINE_FLAGS = (VIR_DOMAIN_UNDEFINE_MANAGED_SAVE | VIR_DOMAIN_UNDEFINE_SNAPSHOTS_METADATA |
+                             VIR_DOMAIN_UNDEFINE_NVRAM | VIR_DOMAIN_UNDEFINE_CHECKPOINTS_METADATA)
+
+
+async def present(hub, ctx, name, xml, connection=None, username=None, password=None):
+    '''
+    Ensure a domain is defined with the given XML definition.
+
+    The domain is not started or stopped: changes to a running domain are only
+    applied on its next start.
+
+    :param name: name of the domain, overriding the one in the XML definition
+    :param xml: libvirt XML definition of the domain
+    :param connection: libvirt connection URI, overriding defaults
+    :param username: username to connect with, overriding defaults
+    :param password: password to connect with, overriding defaults
+    '''
+    conn = await hub.exec.virt.util.get_conn(connection, username, password)
+    try:
+        return await _run(hub, _present, conn, name, xml, ctx.get('test', False))
+    finally:
+        conn.close()
+
+
+async def running(hub, ctx, name, xml=None, connection=None, username=None, password=None):
+    '''
+    Ensure a domain is running, defining it first if an XML definition is provided.
+    A paused domain is resumed.
+
+    :param name: name of the domain
+    :param xml: libvirt XML definition of the domain. If omitted the domain needs to be defined already.
+    :param connection: libvirt connection URI, overriding defaults
+    :param username: username to connect with, overriding defaults
+    :param password: password to connect with, overriding defaults
+    '''
+    conn = await hub.exec.virt.util.get_conn(connection, username, password)
+    try:
+        return await _run(hub, _running, conn, name, xml, ctx.get('test', False))
+    finally:
+        conn.close()
+
+
+async def absent(hub, ctx, name, connection=None, username=None, password=None):
+    '''
+    Ensure a domain is stopped and undefined.
+
+    The storage volumes of the domain are left untouched, but its managed save image,
+    snapshots and checkpoints metadata and NVRAM file are removed with it.
+
+    :param name: name of the domain
+    :param connection: libvirt connection URI, overriding defaults
+    :param username: username to connect with, overriding defaults
+    :param password: password to connect with, overriding defaults
+    '''
+    conn = await hub.exec.virt.util.get_conn(connection, username, password)
+    try:
+        return await _run(hub, _absent, conn, name, None, ctx.get('test', False))
+    finally:
+        conn.close()
+
+
+async def batch_present(hub, ctx, name, domains, start=False, workers=8,
+                        connection=None, username=None, password=None):
+    '''
+    Ensure a batch of domains is defined, enforcing them concurrently.
+
+    .. code-block:: yaml
+
+        web-farm:
+          virt.domain.batch_present:
+            - start: True
+            - domains:
+                web01: <domain type='kvm'>...</domain>
+                web02: <domain type='kvm'>...</domain>
+
+    :param name: name of the batch, only used to report the result
+    :param domains: dictionary of the XML definitions indexed by domain name
+    :param start: ``True`` to also ensure the domains are running
+    :param workers: maximum number of domains enforced at the same time
+    :param connection: libvirt connection URI, overriding defaults
+    :param username: username to connect with, overriding defaults
+    :param password: password to connect with, overriding defaults
+    '''
+    conn = await hub.exec.virt.util.get_conn(connection, username, password)
+    semaphore = asyncio.Semaphore(max(1, int(workers)))
+    func = _running if start else _present
+
+    async def _enforce(domain_name, xml):
+        async with semaphore:
+            return await _run(hub, func, conn, domain_name, xml, ctx.get('test', False))
+
+    try:
+        results = await asyncio.gather(*[_enforce(domain_name, xml) for domain_name, xml in domains.items()])
+    finally:
+        conn.close()
+
+    ret = {'name': name, 'changes': {}, 'result': True, 'comment': ''}
+    failed = []
+    for result in results:
+        if result['changes']:
+            ret['changes'][result['name']] = result['changes']
+        if result['result'] is False:
+            ret['result'] = False
+            failed.append('{}: {}'.format(result['name'], result['comment']))
+        elif result['result'] is None and ret['result'] is True:
+            ret['result'] = None
+    if failed:
+        ret['comment'] = '\n'.join(failed)
+    elif ret['changes']:
+        ret['comment'] = '{} of {} domains {}'.format(
+            len(ret['changes']), len(domains), 'would be changed' if ret['result'] is None else 'changed')
+    else:
+        ret['comment'] = 'All {} domains are in the correct state'.format(len(domains))
+    return ret
+
+
+def _fingerprints(hub, xml):
+    '''
+    Return the fingerprint of the canonical XML definition, ignoring the fingerprint
+    metadata, and the desired and live fingerprints stored in the metadata, if any.
+    '''
+    key = hashlib.sha1(xml.encode()).digest()
+    cached = hub.virt.cache.get('domain_fingerprints', key)
+    if cached is None:
+        cached = _fingerprint(ElementTree.fromstring(xml))
+        hub.virt.cache.set('domain_fingerprints', key, cached)
+    return cached
+
+
+async def _run(hub, func, conn, name, xml, test):
+    '''
+    Run the blocking state function in the lifecycle executor, turning errors into a failed state
+    '''
+    ret = {'name': name, 'changes': {}, 'result': True, 'comment': ''}
+    try:
+        await hub.virt.governor.run_lifecycle(func, hub, conn, name, xml, test, ret)
+    except Exception as err:  # pylint: disable=broad-except
+        ret['result'] = False
+        ret['comment'] = str(err)
+    if ret['changes'] and not test:
+        # The shared exec results don't reflect the change anymore
+        hub.virt.coalesce.clear()
+    return ret
+
+
+def _present(hub, conn, name, xml, test, ret):
+    desired = ElementTree.fromstring(xml)
+    name_node = desired.find('name')
+    if name_node is None:
+        name_node = ElementTree.SubElement(desired, 'name')
+    name_node.text = name
+    _strip_metadata(desired)
+    desired_xml = ElementTree.tostring(desired, encoding='unicode')
+    desired_fp = _fingerprints(hub, desired_xml)[0]
+
+    dom = _lookup(conn, name)
+    old = None
+    if dom is not None:
+        live_fp, stored_desired, stored_live = _fingerprints(hub, dom.XMLDesc(VIR_DOMAIN_XML_INACTIVE))
+        if stored_desired == desired_fp and stored_live == live_fp:
+            ret['comment'] = 'Domain {} is already defined'.format(name)
+            return
+        old = live_fp
+
+    ret['changes'] = {'definition': {'old': old, 'new': desired_fp}}
+    if test:
+        ret['result'] = None
+        ret['comment'] = 'Domain {} would be {}'.format(name, 'updated' if dom else 'defined')
+        return
+
+    if dom is not None and desired.find('uuid') is None:
+        # Without its UUID libvirt would see the definition as a new domain with an existing name
+        ElementTree.SubElement(desired, 'uuid').text = dom.UUIDString()
+        desired_xml = ElementTree.tostring(desired, encoding='unicode')
+    dom = conn.defineXML(desired_xml)
+    live_fp = _fingerprints(hub, dom.XMLDesc(VIR_DOMAIN_XML_INACTIVE))[0]
+    dom.setMetadata(VIR_DOMAIN_METADATA_ELEMENT,
+                    '<fingerprint desired="{}" live="{}"/>'.format(desired_fp, live_fp),
+                    METADATA_PREFIX, METADATA_NS, VIR_DOMAIN_AFFECT_CONFIG)
+    ret['comment'] = 'Domain {} {}'.format(name, 'updated' if old else 'defined')
+
+
+def _running(hub, conn, name, xml, test, ret):
+    if xml is not None:
+        _present(hub, conn, name, xml, test, ret)
+
+    dom = _lookup(conn, name)
+    if dom is None:
+        if test and ret['changes']:
+            ret['changes']['state'] = {'old': None, 'new': 'running'}
+            return
+        raise Exception('Domain {} is not defined'.format(name))
+    state = dom.state()[0]
+    if state == VIR_DOMAIN_RUNNING:
+        if not ret['comment']:
+            ret['comment'] = 'Domain {} is already running'.format(name)
+        return
+    paused = state == VIR_DOMAIN_PAUSED
+    action = 'resumed' if paused else 'started'
+    ret['changes']['state'] = {'old': 'paused' if paused else 'shutdown', 'new': 'running'}
+    if test:
+        ret['result'] = None
+        ret['comment'] = ' '.join([ret['comment'], 'Domain {} would be {}'.format(name, action)]).strip()
+        return
+    if paused:
+        dom.resume()
+    else:
+        dom.create()
+    ret['comment'] = ' '.join([ret['comment'], 'Domain {} {}'.format(name, action)]).strip()
+
+
+def _absent(hub, conn, name, xml, test, ret):
+    dom = _lookup(conn, name)
+    if dom is None:
+        ret['comment'] = 'Domain {} is already absent'.format(name)
+        return
+    ret['changes'] = {'definition': {'old': name, 'new': None}}
+    if test:
+        ret['result'] = None
+        ret['comment'] = 'Domain {} would be removed'.format(name)
+        return
+    if dom.isActive():
+        dom.destroy()
+    dom.undefineFlags(VIR_DOMAIN_UNDEFINE_FLAGS)
+    ret['comment'] = 'Domain {} removed'.format(name)
+
+
+def _lookup(conn, name):
+    '''
+    Return the domain or ``None`` if not defined
+    '''
+    import libvirt  # pylint: disable=import-error
+
+    try:
+        return conn.lookupByName(name)
+    except libvirt.libvirtError as err:
+        if err.get_error_code() == VIR_ERR_NO_DOMAIN:
+            return None
+        raise
+
+
+def _strip_metadata(root):
+    '''
+    Remove the fingerprint metadata and return its attributes
+    '''
+    attrs = {}
+    metadata = root.find('metadata')
+    if metadata is not None:
+        for node in metadata.findall(METADATA_TAG):
+            attrs = dict(node.attrib)
+            metadata.remove(node)
+        if not len(metadata):  # pylint: disable=len-as-condition
+            root.remove(metadata)
+    return attrs
+
+
+def _fingerprint(root):
+    '''
+    Compute the fingerprints of a parsed domain definition
+    '''
+    stored = _strip_metadata(root)
+    digest = hashlib.sha256()
+    _canonicalize(root, digest)
+    return digest.hexdigest(), stored.get('desired'), stored.get('live')
+
+
+def _canonicalize(node, digest):
+    '''
+    Feed a canonical form of the node to the digest: sorted attributes, stripped texts
+    '''
+    digest.update(node.tag.encode())
+    for attr, value in sorted(node.attrib.items()):
+        digest.update('\x00{}={}'.format(attr, value).encode())
+    text = (node.text or '').strip()
+    if text:
+        digest.update('\x01{}'.format(text).encode())
+    digest.update(b'\x02')
+    for child in node:
+        _canonicalize(child, digest)
+    digest.update(b'\x03')
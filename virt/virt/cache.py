@@ -0,0 +1,58 @@
+'''
+Named in-memory LRU caches shared by the exec and states modules.
+'''
+import collections
+import threading
+
+DEFAULT_SIZE = 1024
+
+
+def __init__(hub):
+    hub.virt.CACHES = {}
+    hub.virt.CACHES_LOCK = threading.Lock()
+
+
+def get(hub, name, key, default=None):
+    '''
+    Return the cached value for the key or the default
+
+    :param name: name of the cache
+    :param key: hashable key of the value
+    :param default: value to return if the key is not cached
+    '''
+    with hub.virt.CACHES_LOCK:
+        cache = hub.virt.CACHES.get(name)
+        if cache is None or key not in cache:
+            return default
+        cache.move_to_end(key)
+        return cache[key]
+
+
+def set(hub, name, key, value, size=DEFAULT_SIZE):
+    '''
+    Cache a value, evicting the least recently used ones beyond ``size`` entries
+
+    :param name: name of the cache
+    :param key: hashable key of the value
+    :param value: the value to cache
+    :param size: maximum number of entries of the cache
+    '''
+    with hub.virt.CACHES_LOCK:
+        cache = hub.virt.CACHES.setdefault(name, collections.OrderedDict())
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > size:
+            cache.popitem(last=False)
+
+
+def clear(hub, name=None):
+    '''
+    Empty one or all the caches
+
+    :param name: name of the cache to empty, all of them if omitted
+    '''
+    with hub.virt.CACHES_LOCK:
+        if name is None:
+            hub.virt.CACHES.clear()
+        else:
+            hub.virt.CACHES.pop(name, None)
@@ -0,0 +1,84 @@
+'''
+Coalescing of identical exec calls.
+
+The exec modules listing the ``coalesce`` contract in ``__contracts__`` share
+the execution of identical calls: a call made while the same function is
+already running with the same arguments waits for that execution and gets its
+result. With ``coalesce_ttl`` set, the results are also reused for that many
+seconds by the following identical calls.
+
+The functions matching one of the ``coalesce_exclude`` patterns, like
+``virt.domain.state`` or ``virt.node.*``, are always executed. The contract
+also opts out the functions changing the domains and the recorded results are
+dropped once a change is made.
+
+Each caller gets its own copy of the result. The calls returning objects owning
+resources, like ``domain.info`` with ``spill``, are opted out by the contract.
+'''
+import asyncio
+import copy
+import fnmatch
+import json
+import time
+
+# Maximum number of recorded results
+SIZE = 256
+
+
+def __init__(hub):
+    hub.virt.COALESCE_INFLIGHT = {}
+    hub.virt.COALESCE_STATS = {'executions': 0, 'shared': 0, 'reused': 0}
+
+
+async def run(hub, ref, arguments, func):
+    '''
+    Return the result of ``func()``, sharing it with the identical calls
+
+    :param ref: reference of the exec function, like ``virt.domain.info``
+    :param arguments: the call arguments by name, identifying identical calls
+    :param func: coroutine function to call to execute the exec function
+    '''
+    opts = hub.OPT['virt']
+    if any(fnmatch.fnmatch(ref, pattern) for pattern in opts.get('coalesce_exclude') or []):
+        return await func()
+
+    key = (ref, json.dumps(arguments, sort_keys=True, default=repr))
+    recorded = hub.virt.cache.get('coalesce', key)
+    if recorded is not None and recorded[0] > time.monotonic():
+        hub.virt.COALESCE_STATS['reused'] += 1
+        return copy.deepcopy(recorded[1])
+
+    future = hub.virt.COALESCE_INFLIGHT.get(key)
+    if future is not None:
+        hub.virt.COALESCE_STATS['shared'] += 1
+        return copy.deepcopy(await asyncio.shield(future))
+
+    ttl = opts.get('coalesce_ttl') or 0
+
+    def _done(done):
+        if hub.virt.COALESCE_INFLIGHT.get(key) is done:
+            del hub.virt.COALESCE_INFLIGHT[key]
+        if ttl > 0 and not done.cancelled() and done.exception() is None:
+            hub.virt.cache.set('coalesce', key, (time.monotonic() + ttl, done.result()), size=SIZE)
+
+    future = asyncio.ensure_future(func())
+    future.add_done_callback(_done)
+    hub.virt.COALESCE_INFLIGHT[key] = future
+    hub.virt.COALESCE_STATS['executions'] += 1
+    # A cancelled caller doesn't cancel the execution shared with the other ones
+    return copy.deepcopy(await asyncio.shield(future))
+
+
+def clear(hub):
+    '''
+    Drop the recorded results, the next calls are executed
+    '''
+    hub.virt.cache.clear('coalesce')
+
+
+def stats(hub):
+    '''
+    Return the number of executions, of calls sharing an execution in progress
+    and of calls reusing a recorded result
+    '''
+    return dict(hub.virt.COALESCE_STATS)
@@ -0,0 +1,262 @@
+'''
+OpenMetrics exporter of the domains and node metrics.
+
+``virt --serve --exporter-port 9177`` serves the metrics on
+``http://127.0.0.1:9177/metrics`` for Prometheus. A scrape only costs a few bulk
+libvirt calls: ``getAllDomainStats``, ``getInfo``, ``getCPUStats`` and
+``getMemoryStats``. The label sets of the domains and devices are encoded once
+and reused by the next scrapes and the response is streamed one metric family
+at a time.
+
+When the collection takes longer than the scrape time budget, the last
+collected values are served instead and the collection keeps running in the
+background to refresh them for the next scrape. The
+``libvirt_exporter_stale_seconds`` gauge tells how old the served values are.
+'''
+import asyncio
+import functools
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+# Seconds kept from the Prometheus scrape timeout to send the response
+MARGIN = 0.5
+
+# getAllDomainStats key: (family, type, help, scale)
+DOMAIN_METRICS = {
+    'state.state': ('libvirt_domain_state', 'gauge', 'Domain state, see virDomainState', 1),
+    'cpu.time': ('libvirt_domain_cpu_time_seconds', 'counter', 'CPU time used by the domain', 1e-9),
+    'cpu.user': ('libvirt_domain_cpu_user_seconds', 'counter', 'User CPU time used by the domain', 1e-9),
+    'cpu.system': ('libvirt_domain_cpu_system_seconds', 'counter', 'System CPU time used by the domain', 1e-9),
+    'balloon.current': ('libvirt_domain_memory_bytes', 'gauge', 'Memory currently assigned to the domain', 1024),
+    'balloon.rss': ('libvirt_domain_memory_rss_bytes', 'gauge', 'Resident memory of the domain process', 1024),
+    'vcpu.current': ('libvirt_domain_vcpus', 'gauge', 'Number of virtual CPUs of the domain', 1),
+}
+# Per device getAllDomainStats key suffix: (family, type, help)
+DEVICE_METRICS = {
+    'net': {
+        'rx.bytes': ('libvirt_domain_interface_receive_bytes', 'counter', 'Bytes received by the interface'),
+        'tx.bytes': ('libvirt_domain_interface_transmit_bytes', 'counter', 'Bytes sent by the interface'),
+        'rx.pkts': ('libvirt_domain_interface_receive_packets', 'counter', 'Packets received by the interface'),
+        'tx.pkts': ('libvirt_domain_interface_transmit_packets', 'counter', 'Packets sent by the interface'),
+    },
+    'block': {
+        'rd.bytes': ('libvirt_domain_block_read_bytes', 'counter', 'Bytes read from the disk'),
+        'wr.bytes': ('libvirt_domain_block_write_bytes', 'counter', 'Bytes written to the disk'),
+        'rd.reqs': ('libvirt_domain_block_read_requests', 'counter', 'Read requests on the disk'),
+        'wr.reqs': ('libvirt_domain_block_write_requests', 'counter', 'Write requests on the disk'),
+    },
+}
+
+
+def __init__(hub):
+    hub.virt.EXPORTER = None
+
+
+async def start(hub, address=None, port=None, connection=None, username=None, password=None):
+    '''
+    Start serving the metrics over HTTP
+
+    :param address: address to listen on, defaults to the ``exporter_address`` option
+    :param port: port to listen on, defaults to the ``exporter_port`` option
+    :param connection: libvirt connection URI, overriding defaults
+    :param username: username to connect with, overriding defaults
+    :param password: password to connect with, overriding defaults
+    '''
+    await stop(hub)
+    opts = hub.OPT['virt']
+    exporter = {
+        'connection': (connection, username, password),
+        'budget': opts.get('exporter_budget') or 5.0,
+        'data': None,
+        'task': None,
+        'scrapes': 0,
+    }
+    exporter['server'] = await asyncio.start_server(
+        functools.partial(_handle, hub, exporter),
+        host=address or opts.get('exporter_address') or '127.0.0.1',
+        port=port or opts.get('exporter_port'))
+    hub.virt.EXPORTER = exporter
+    log.info('Serving the OpenMetrics on port %s', port or opts.get('exporter_port'))
+    return True
+
+
+async def stop(hub):
+    '''
+    Stop serving the metrics
+    '''
+    exporter = hub.virt.EXPORTER
+    if exporter is None:
+        return False
+    hub.virt.EXPORTER = None
+    exporter['server'].close()
+    await exporter['server'].wait_closed()
+    if exporter['task'] is not None:
+        exporter['task'].cancel()
+    return True
+
+
+async def scrape(hub, exporter, budget):
+    '''
+    Return the collected data, or the previous one if not collected within the budget
+    '''
+    if exporter['task'] is None or exporter['task'].done():
+        exporter['task'] = asyncio.ensure_future(_collect(hub, exporter))
+    try:
+        await asyncio.wait_for(asyncio.shield(exporter['task']), budget)
+    except asyncio.TimeoutError:
+        log.warning('The libvirt statistics collection exceeded the %s seconds scrape budget', budget)
+    except Exception as err:  # pylint: disable=broad-except
+        log.warning('Failed to collect the libvirt statistics: %s', err)
+    return exporter['data']
+
+
+def render(data, now):
+    '''
+    Generate the OpenMetrics text, one metric family at a time
+    '''
+    if data is not None:
+        labels = data['labels']
+        for key, (family, kind, help_, scale) in DOMAIN_METRICS.items():
+            lines = []
+            sample = family + '_total' if kind == 'counter' else family
+            for uuid, domain_stats in data['domains']:
+                value = domain_stats.get(key)
+                if value is not None:
+                    lines.append('{}{} {}\n'.format(sample, labels[uuid], _number(value * scale)))
+            yield _family(family, kind, help_, lines)
+
+        for device, metrics in DEVICE_METRICS.items():
+            for suffix, (family, kind, help_) in metrics.items():
+                lines = []
+                for uuid, domain_stats in data['domains']:
+                    for index in range(domain_stats.get('{}.count'.format(device), 0)):
+                        value = domain_stats.get('{}.{}.{}'.format(device, index, suffix))
+                        if value is not None:
+                            lines.append('{}_total{} {}\n'.format(
+                                family, labels[(uuid, device, index)], _number(value)))
+                yield _family(family, kind, help_, lines)
+
+        node = data['node']
+        yield _family('libvirt_node_cpus', 'gauge', 'Number of CPUs of the host',
+                      ['libvirt_node_cpus {}\n'.format(node['info'][2])])
+        yield _family('libvirt_node_cpu_time_seconds', 'counter', 'CPU time of the host by mode',
+                      ['libvirt_node_cpu_time_seconds_total{{mode="{}"}} {}\n'.format(mode, _number(value * 1e-9))
+                       for mode, value in sorted(node['cpu'].items())])
+        yield _family('libvirt_node_memory_bytes', 'gauge', 'Memory of the host by state',
+                      ['libvirt_node_memory_bytes{{state="{}"}} {}\n'.format(state, value * 1024)
+                       for state, value in sorted(node['memory'].items())])
+        yield _family('libvirt_exporter_collect_duration_seconds', 'gauge',
+                      'Duration of the last libvirt statistics collection',
+                      ['libvirt_exporter_collect_duration_seconds {}\n'.format(_number(data['duration']))])
+    yield _family('libvirt_exporter_up', 'gauge', 'Whether libvirt statistics could be collected',
+                  ['libvirt_exporter_up {}\n'.format(0 if data is None else 1)])
+    if data is not None:
+        yield _family('libvirt_exporter_stale_seconds', 'gauge', 'Age of the served libvirt statistics',
+                      ['libvirt_exporter_stale_seconds {}\n'.format(_number(now - data['time']))])
+    yield '# EOF\n'
+
+
+async def _collect(hub, exporter):
+    loop = asyncio.get_event_loop()
+    start = time.monotonic()
+    conn = await hub.exec.virt.util.get_conn(*exporter['connection'])
+    try:
+        domains, node = await loop.run_in_executor(None, _collect_raw, conn)
+    finally:
+        conn.close()
+    previous = exporter['data']['labels'] if exporter['data'] else {}
+    exporter['data'] = {
+        'labels': _labels(previous, domains),
+        'time': time.time(),
+        'duration': time.monotonic() - start,
+        'domains': [(uuid, domain_stats) for _, uuid, domain_stats in domains],
+        'node': node,
+    }
+    return exporter['data']
+
+
+def _collect_raw(conn):
+    '''
+    Blocking collection of the bulk statistics, run in an executor
+    '''
+    # -1 is VIR_NODE_CPU_STATS_ALL_CPUS and VIR_NODE_MEMORY_STATS_ALL_CELLS
+    domains = [(dom.name(), dom.UUIDString(), domain_stats) for dom, domain_stats in conn.getAllDomainStats()]
+    node = {'info': conn.getInfo(), 'cpu': conn.getCPUStats(-1), 'memory': conn.getMemoryStats(-1)}
+    return domains, node
+
+
+def _labels(previous, domains):
+    '''
+    Return the encoded label sets of the domains and their devices, reusing the previous ones
+    '''
+    labels = {}
+    for name, uuid, domain_stats in domains:
+        domain_labels = previous.get(uuid)
+        if domain_labels is None or previous.get((uuid, 'name')) != name:
+            domain_labels = '{{domain="{}",uuid="{}"}}'.format(_escape(name), uuid)
+        labels[uuid] = domain_labels
+        labels[(uuid, 'name')] = name
+        for device in DEVICE_METRICS:
+            for index in range(domain_stats.get('{}.count'.format(device), 0)):
+                key = (uuid, device, index)
+                device_name = domain_stats.get('{}.{}.name'.format(device, index), str(index))
+                encoded = previous.get(key)
+                if encoded is None or previous.get(key + ('name',)) != device_name:
+                    encoded = '{}",device="{}"}}'.format(domain_labels[:-2], _escape(device_name))
+                labels[key] = encoded
+                labels[key + ('name',)] = device_name
+    return labels
+
+
+def _family(family, kind, help_, lines):
+    return '# TYPE {0} {1}\n# HELP {0} {2}\n{3}'.format(family, kind, help_, ''.join(lines))
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+async def _handle(hub, exporter, reader, writer):
+    try:
+        request = await reader.readline()
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if not line or line in (b'\r\n', b'\n'):
+                break
+            key, _, value = line.decode('latin-1').partition(':')
+            headers[key.strip().lower()] = value.strip()
+
+        parts = request.decode('latin-1').split()
+        if len(parts) < 2 or parts[0] != 'GET' or parts[1].split('?')[0] != '/metrics':
+            writer.write(b'HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+            return
+
+        budget = exporter['budget']
+        if 'x-prometheus-scrape-timeout-seconds' in headers:
+            try:
+                budget = min(budget, float(headers['x-prometheus-scrape-timeout-seconds']) - MARGIN)
+            except ValueError:
+                pass
+        data = await scrape(hub, exporter, max(budget, 0.1))
+        exporter['scrapes'] += 1
+
+        writer.write('HTTP/1.1 200 OK\r\nContent-Type: {}\r\nTransfer-Encoding: chunked\r\n'
+                     'Connection: close\r\n\r\n'.format(CONTENT_TYPE).encode())
+        for chunk in render(data, time.time()):
+            chunk = chunk.encode()
+            writer.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+            await writer.drain()
+        writer.write(b'0\r\n\r\n')
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
@@ -0,0 +1,253 @@
+'''
+Rate governor for the libvirt calls.
+
+All the calls made on the connections returned by ``hub.exec.virt.util.get_conn``
+and on the libvirt objects they return go through a per-URI governor: a token
+bucket limits the calls rate and a counter limits the number of calls in flight.
+When the limits are reached the calls are queued and lifecycle operations are
+served before inventory reads.
+
+A queued call blocks its thread: the exec functions make the libvirt calls in
+executor threads so that the event loop keeps running the other requests while
+they wait for the governor. The functions making lifecycle operations run their
+blocking part with ``hub.virt.governor.run_lifecycle``: it uses a dedicated
+executor, so they are not stuck behind the queued inventory calls holding the
+default executor threads, and all the calls they make are served with the
+lifecycle priority.
+'''
+import asyncio
+import concurrent.futures
+import heapq
+import itertools
+import threading
+import time
+
+# Priorities, lower is served first
+LIFECYCLE = 0
+INVENTORY = 1
+PRIORITY_NAMES = {LIFECYCLE: 'lifecycle', INVENTORY: 'inventory'}
+
+LIFECYCLE_CALLS = frozenset([
+    'create', 'createWithFlags', 'createXML', 'createXMLWithFiles', 'defineXML', 'defineXMLFlags',
+    'undefine', 'undefineFlags', 'shutdown', 'shutdownFlags', 'destroy', 'destroyFlags',
+    'reboot', 'reset', 'suspend', 'resume', 'managedSave', 'restore', 'setAutostart',
+    'migrate', 'migrate2', 'migrate3', 'migrateToURI', 'migrateToURI2', 'migrateToURI3',
+    'attachDevice', 'attachDeviceFlags', 'detachDevice', 'detachDeviceFlags', 'updateDeviceFlags',
+])
+
+# Calls answered locally by the bindings without any RPC
+LOCAL_CALLS = frozenset(['close', 'name', 'ID', 'UUID', 'UUIDString', 'connect'])
+
+# Number of threads of the lifecycle executor
+LIFECYCLE_WORKERS = 4
+
+# Marks the threads running a function for run_lifecycle
+_CURRENT = threading.local()
+
+
+def __init__(hub):
+    hub.virt.GOVERNORS = {}
+    hub.virt.GOVERNORS_LOCK = threading.Lock()
+    # The threads are only started when needed
+    hub.virt.LIFECYCLE_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=LIFECYCLE_WORKERS)
+
+
+def wrap(hub, conn, uri):
+    '''
+    Return the connection wrapped to go through the governor of the URI.
+
+    The connection is returned as is when the governor is disabled.
+
+    :param conn: the libvirt connection object
+    :param uri: the connection URI, used to share the governor
+    '''
+    governor = _get_governor(hub, uri)
+    if governor is None:
+        return conn
+    return _GovernedObject(conn, governor)
+
+
+async def run_lifecycle(hub, func, *args):
+    '''
+    Run a blocking function making lifecycle operations in the lifecycle executor.
+
+    All the governed calls made by the function, including the lookups and reads,
+    are served with the lifecycle priority.
+
+    :param func: the function to run
+    :param args: the positional arguments to pass to the function
+    '''
+    return await asyncio.get_event_loop().run_in_executor(hub.virt.LIFECYCLE_EXECUTOR, _as_lifecycle, func, *args)
+
+
+def _as_lifecycle(func, *args):
+    _CURRENT.lifecycle = True
+    try:
+        return func(*args)
+    finally:
+        _CURRENT.lifecycle = False
+
+
+def stats(hub):
+    '''
+    Return the governor counters per URI
+    '''
+    return {uri: governor.stats() for uri, governor in hub.virt.GOVERNORS.items()}
+
+
+def _get_governor(hub, uri):
+    '''
+    Get or create the governor for a URI, ``None`` if disabled by the configuration
+    '''
+    opts = hub.OPT['virt']
+    rate = opts.get('governor_rate') or 0
+    max_inflight = opts.get('governor_max_inflight') or 0
+    if rate <= 0 and max_inflight <= 0:
+        return None
+    key = uri or 'default'
+    with hub.virt.GOVERNORS_LOCK:
+        if key not in hub.virt.GOVERNORS:
+            hub.virt.GOVERNORS[key] = _Governor(rate, opts.get('governor_burst') or 1, max_inflight)
+        return hub.virt.GOVERNORS[key]
+
+
+class _Governor:
+    '''
+    Token bucket and in-flight limiter serving the waiters by priority
+    '''
+
+    def __init__(self, rate, burst, max_inflight):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.max_inflight = max_inflight
+        self._cond = threading.Condition()
+        self._waiters = []
+        self._seq = itertools.count()
+        self._tokens = float(self.burst)
+        self._last = time.monotonic()
+        self._inflight = 0
+        self._calls = {name: 0 for name in PRIORITY_NAMES.values()}
+        self._queued = {name: 0 for name in PRIORITY_NAMES.values()}
+        self._queued_seconds = {name: 0.0 for name in PRIORITY_NAMES.values()}
+        self._max_queued_seconds = {name: 0.0 for name in PRIORITY_NAMES.values()}
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def acquire(self, priority):
+        '''
+        Block until the call can be made
+        '''
+        start = time.monotonic()
+        with self._cond:
+            ticket = (priority, next(self._seq))
+            heapq.heappush(self._waiters, ticket)
+            queued = False
+            try:
+                while True:
+                    if self._waiters[0] == ticket and \
+                            (self.max_inflight <= 0 or self._inflight < self.max_inflight):
+                        if self.rate <= 0:
+                            break
+                        self._refill()
+                        if self._tokens >= 1:
+                            self._tokens -= 1
+                            break
+                        queued = True
+                        self._cond.wait((1 - self._tokens) / self.rate)
+                    else:
+                        queued = True
+                        self._cond.wait()
+            except BaseException:
+                self._waiters.remove(ticket)
+                heapq.heapify(self._waiters)
+                self._cond.notify_all()
+                raise
+            heapq.heappop(self._waiters)
+            self._inflight += 1
+
+            waited = time.monotonic() - start
+            name = PRIORITY_NAMES[priority]
+            self._calls[name] += 1
+            if queued:
+                self._queued[name] += 1
+            self._queued_seconds[name] += waited
+            self._max_queued_seconds[name] = max(self._max_queued_seconds[name], waited)
+            # Let the next waiter check if it can go too
+            self._cond.notify_all()
+
+    def release(self):
+        '''
+        Mark a call as finished
+        '''
+        with self._cond:
+            self._inflight -= 1
+            self._cond.notify_all()
+
+    def stats(self):
+        '''
+        Return a snapshot of the counters
+        '''
+        with self._cond:
+            return {
+                'calls': dict(self._calls),
+                'queued_calls': dict(self._queued),
+                'queued_seconds': dict(self._queued_seconds),
+                'max_queued_seconds': dict(self._max_queued_seconds),
+                'inflight': self._inflight,
+                'waiting': len(self._waiters),
+            }
+
+
+def _unwrap(value):
+    while getattr(type(value), '_libvirt_proxy', False):
+        value = value._obj
+    return value
+
+
+def _wrap_result(value, governor):
+    '''
+    Wrap the libvirt objects returned by a call so that their calls are governed too
+    '''
+    if _is_libvirt_object(value):
+        return _GovernedObject(value, governor)
+    # Like the (domain, stats) tuples of getAllDomainStats
+    if isinstance(value, tuple):
+        return tuple(_wrap_result(item, governor) for item in value)
+    if isinstance(value, list) and value and (_is_libvirt_object(value[0]) or isinstance(value[0], tuple)):
+        return [_wrap_result(item, governor) for item in value]
+    return value
+
+
+def _is_libvirt_object(value):
+    return type(value).__module__ == 'libvirt' or getattr(type(value), '_libvirt_proxy', False)
+
+
+class _GovernedObject:
+    '''
+    Proxy to a libvirt object running all its calls through a governor
+    '''
+    _libvirt_proxy = True
+
+    def __init__(self, obj, governor):
+        self._obj = obj
+        self._governor = governor
+
+    def __getattr__(self, name):
+        attr = getattr(self._obj, name)
+        if not callable(attr) or name in LOCAL_CALLS:
+            return attr
+        governor = self._governor
+        lifecycle = name in LIFECYCLE_CALLS
+
+        def _governed(*args, **kwargs):
+            governor.acquire(LIFECYCLE if lifecycle or getattr(_CURRENT, 'lifecycle', False) else INVENTORY)
+            try:
+                ret = attr(*[_unwrap(arg) for arg in args],
+                           **{key: _unwrap(value) for key, value in kwargs.items()})
+            finally:
+                governor.release()
+            return _wrap_result(ret, governor)
+        return _governed
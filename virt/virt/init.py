@@ -1,4 +1,137 @@
+import collections.abc
+import json
+import sys
+
+import yaml
+
+
 def __init__(hub):
     hub.pop.conf.integrate('virt', loader='yaml', cli='virt', roots=True)
     hub.pop.sub.add(dyne_name='exec')
     hub.pop.sub.load_subdirs(hub.exec)
+
+
+def cli(hub):
+    '''
+    Run the exec function passed on the command line and print its JSON result,
+    or serve the exec calls on a unix socket with ``--serve``
+    '''
+    if hub.OPT['virt'].get('serve'):
+        hub.pop.loop.start(hub.virt.server.serve())
+        return
+    if not hub.OPT['virt'].get('ref'):
+        return
+    ret = hub.pop.loop.start(hub.virt.init.run(hub.OPT['virt']['ref'], hub.OPT['virt'].get('args') or []))[0]
+    try:
+        for chunk in hub.virt.init.iterencode(ret, indent=2):
+            sys.stdout.write(chunk)
+        sys.stdout.write('\n')
+    finally:
+        hub.virt.init.release(ret)
+
+
+def json_default(hub, value):
+    '''
+    Serialize the values JSON doesn't know, like the lazy mappings returned by some exec functions
+    '''
+    if isinstance(value, collections.abc.Mapping):
+        return dict(value)
+    return str(value)
+
+
+# Depth of the containers encoded item by item by iterencode, the deeper ones are encoded at once
+STREAM_DEPTH = 3
+
+
+def iterencode(hub, value, indent=None):
+    '''
+    Generate the JSON text of an exec result in chunks.
+
+    The lazy mappings returned by some exec functions, like the spilled domain infos,
+    are encoded one entry at a time rather than being loaded in memory at once.
+
+    :param value: the value to encode
+    :param indent: same as the ``json.dumps`` parameter
+    '''
+    return _iterencode(hub, value, indent, 0)
+
+
+def release(hub, value):
+    '''
+    Close the lazy mappings of an exec result owning resources, like a temporary file
+    '''
+    for item in _lazy_mappings(value, 0):
+        close = getattr(item, 'close', None)
+        if close is not None:
+            close()
+
+
+def _lazy_mappings(value, level):
+    if isinstance(value, collections.abc.Mapping) and not isinstance(value, dict):
+        yield value
+    elif level < STREAM_DEPTH and isinstance(value, dict):
+        for item in value.values():
+            yield from _lazy_mappings(item, level + 1)
+    elif level < STREAM_DEPTH and isinstance(value, (list, tuple)):
+        for item in value:
+            yield from _lazy_mappings(item, level + 1)
+
+
+def _iterencode(hub, value, indent, level):
+    lazy = isinstance(value, collections.abc.Mapping) and not isinstance(value, dict)
+    if not lazy and (level >= STREAM_DEPTH or not isinstance(value, (dict, list, tuple))):
+        text = json.dumps(value, indent=indent, default=hub.virt.init.json_default)
+        # The new lines are escaped in the JSON strings
+        yield text if indent is None else text.replace('\n', '\n' + ' ' * (indent * level))
+        return
+    if isinstance(value, collections.abc.Mapping):
+        items = ((_encode_key(key), item) for key, item in value.items())
+        start, end = '{', '}'
+    else:
+        items = ((None, item) for item in value)
+        start, end = '[', ']'
+    if indent is None:
+        newline, closing, separator = '', '', ', '
+    else:
+        newline = '\n' + ' ' * (indent * (level + 1))
+        closing = '\n' + ' ' * (indent * level)
+        separator = ','
+    yield start
+    empty = True
+    for key, item in items:
+        yield ('' if empty else separator) + newline + ('' if key is None else key + ': ')
+        empty = False
+        yield from _iterencode(hub, item, indent, level + 1)
+    yield end if empty else closing + end
+
+
+def _encode_key(key):
+    '''
+    Encode a mapping key like json.dumps does
+    '''
+    if isinstance(key, bool) or key is None:
+        key = json.dumps(key)
+    elif not isinstance(key, str):
+        key = str(key)
+    return json.dumps(key)
+
+
+async def run(hub, ref, args):
+    '''
+    Run an exec function from its reference relative to ``exec`` and ``key=value`` arguments
+
+    The arguments values are parsed as YAML, like ``timeout=2`` or ``vm_=myvm``.
+    '''
+    try:
+        func = getattr(hub, 'exec.{}'.format(ref))
+    except AttributeError:
+        raise Exception('Unknown exec function: {}'.format(ref))
+    kwargs = {}
+    pos_args = []
+    for arg in args:
+        if '=' in arg:
+            key, value = arg.split('=', 1)
+            kwargs[key] = yaml.safe_load(value)
+        else:
+            pos_args.append(yaml.safe_load(arg))
+    return await func(*pos_args, **kwargs)
@@ -0,0 +1,211 @@
+'''
+Instrumentation of the libvirt calls and of the internal helpers.
+
+When the ``instrument`` option is set or while a profile is running, the
+connections returned by ``hub.exec.virt.util.get_conn`` and the helpers
+registered by the exec modules record their calls count and latency
+histogram. Otherwise the connections and helpers are left untouched.
+'''
+import bisect
+import threading
+import time
+
+# Upper bounds of the latency histogram buckets in seconds
+BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+
+def __init__(hub):
+    hub.virt.METRICS = {}
+    hub.virt.PROFILES = []
+    hub.virt.INSTRUMENTED = []
+    hub.virt.INSTRUMENT_LOCK = threading.Lock()
+
+
+def register(hub, prefix, module, names):
+    '''
+    Register module helpers to instrument.
+
+    The helpers are replaced by timing wrappers in the module only while the
+    instrumentation is active, so they need to be called through the module globals.
+
+    :param prefix: prefix of the recorded operation names
+    :param module: the module defining the helpers
+    :param names: the names of the helper functions to instrument
+    '''
+    originals = {name: getattr(module, name) for name in names}
+    hub.virt.INSTRUMENTED.append((prefix, module, originals))
+    if _active(hub):
+        _patch(hub, prefix, module, originals, True)
+
+
+def wrap_conn(hub, conn):
+    '''
+    Return the libvirt connection wrapped to record its calls if the instrumentation is active.
+    '''
+    if not _active(hub):
+        return conn
+    return _InstrumentedObject(conn, hub)
+
+
+def start_profile(hub):
+    '''
+    Start recording all the instrumented calls in a new profile and return it.
+
+    Note that all the calls made while the profile is running are recorded,
+    including the ones from concurrent executions.
+    '''
+    profile = {}
+    with hub.virt.INSTRUMENT_LOCK:
+        hub.virt.PROFILES.append(profile)
+    _update(hub)
+    return profile
+
+
+def stop_profile(hub, profile):
+    '''
+    Stop a profile and return its report
+    '''
+    with hub.virt.INSTRUMENT_LOCK:
+        hub.virt.PROFILES.remove(profile)
+    _update(hub)
+    return _report(profile)
+
+
+def stats(hub, reset=False):
+    '''
+    Return the recorded operations counts and latencies.
+
+    :param reset: clear the recorded values after reading them
+    '''
+    with hub.virt.INSTRUMENT_LOCK:
+        ret = _report(hub.virt.METRICS)
+        if reset:
+            hub.virt.METRICS.clear()
+    return ret
+
+
+def _active(hub):
+    return bool(hub.OPT['virt'].get('instrument') or hub.virt.PROFILES)
+
+
+def _update(hub):
+    '''
+    Install or remove the helpers wrappers depending on the instrumentation state
+    '''
+    active = _active(hub)
+    for prefix, module, originals in hub.virt.INSTRUMENTED:
+        _patch(hub, prefix, module, originals, active)
+
+
+def _patch(hub, prefix, module, originals, active):
+    for name, func in originals.items():
+        setattr(module, name, _timed(hub, '{}.{}'.format(prefix, name), func) if active else func)
+
+
+def _timed(hub, name, func):
+    def _wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _record(hub, name, time.perf_counter() - start)
+    _wrapper.__wrapped__ = func
+    return _wrapper
+
+
+def _record(hub, name, duration):
+    with hub.virt.INSTRUMENT_LOCK:
+        targets = list(hub.virt.PROFILES)
+        if hub.OPT['virt'].get('instrument'):
+            targets.append(hub.virt.METRICS)
+        for target in targets:
+            if name not in target:
+                target[name] = _Histogram()
+            target[name].record(duration)
+
+
+def _report(metrics):
+    return {name: histogram.report() for name, histogram in sorted(metrics.items())}
+
+
+class _Histogram:
+    '''
+    Calls count and latency histogram of an operation
+    '''
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def record(self, duration):
+        self.count += 1
+        self.total += duration
+        self.min = duration if self.min is None else min(self.min, duration)
+        self.max = max(self.max, duration)
+        self.buckets[bisect.bisect_left(BUCKETS, duration)] += 1
+
+    def report(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count if self.count else 0.0,
+            'min': self.min or 0.0,
+            'max': self.max,
+            'histogram': dict(zip([str(bound) for bound in BUCKETS] + ['+Inf'], self.buckets)),
+        }
+
+
+def _unwrap(value):
+    while getattr(type(value), '_libvirt_proxy', False):
+        value = value._obj
+    return value
+
+
+def _wrap_result(value, hub):
+    '''
+    Wrap the libvirt objects returned by a call so that their calls are recorded too
+    '''
+    if _is_libvirt_object(value):
+        return _InstrumentedObject(value, hub)
+    # Like the (domain, stats) tuples of getAllDomainStats
+    if isinstance(value, tuple):
+        return tuple(_wrap_result(item, hub) for item in value)
+    if isinstance(value, list) and value and (_is_libvirt_object(value[0]) or isinstance(value[0], tuple)):
+        return [_wrap_result(item, hub) for item in value]
+    return value
+
+
+def _is_libvirt_object(value):
+    return type(value).__module__ == 'libvirt' or getattr(type(value), '_libvirt_proxy', False)
+
+
+class _InstrumentedObject:
+    '''
+    Proxy to a libvirt object recording the duration of all its calls
+    '''
+    _libvirt_proxy = True
+
+    def __init__(self, obj, hub):
+        self._obj = obj
+        self._hub = hub
+        self._kind = type(_unwrap(obj)).__name__
+
+    def __getattr__(self, name):
+        attr = getattr(self._obj, name)
+        if not callable(attr):
+            return attr
+        hub = self._hub
+        op_name = 'libvirt.{}.{}'.format(self._kind, name)
+
+        def _recorded(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                ret = attr(*[_unwrap(arg) for arg in args],
+                           **{key: _unwrap(value) for key, value in kwargs.items()})
+            finally:
+                _record(hub, op_name, time.perf_counter() - start)
+            return _wrap_result(ret, hub)
+        return _recorded
@@ -0,0 +1,91 @@
+'''
+Pool of the libvirt connections.
+
+Long running processes, like ``virt --serve``, enable the pool to reuse the
+libvirt connections between the exec calls instead of paying a new handshake
+each time. The pooled connections are shared: closing them is a no-op.
+'''
+import threading
+
+
+def __init__(hub):
+    hub.virt.POOL = {}
+    hub.virt.POOL_LOCK = threading.Lock()
+    hub.virt.POOLING = False
+
+
+def enable(hub):
+    '''
+    Start pooling the connections
+    '''
+    hub.virt.POOLING = True
+
+
+def get(hub, key):
+    '''
+    Return the alive pooled connection for the key or ``None``
+
+    :param key: the hashable connection parameters
+    '''
+    if not hub.virt.POOLING:
+        return None
+    with hub.virt.POOL_LOCK:
+        conn = hub.virt.POOL.get(key)
+        if conn is None:
+            return None
+        try:
+            if conn._obj.isAlive():
+                return conn
+        except Exception:  # pylint: disable=broad-except
+            pass
+        del hub.virt.POOL[key]
+    return None
+
+
+def put(hub, key, conn):
+    '''
+    Add a new connection to the pool and return the connection to use.
+
+    The connection is returned as is when the pool is disabled.
+
+    :param key: the hashable connection parameters
+    :param conn: the libvirt connection
+    '''
+    if not hub.virt.POOLING:
+        return conn
+    pooled = _PooledConnection(conn)
+    with hub.virt.POOL_LOCK:
+        # A concurrent call may have pooled another connection in the meantime:
+        # it may still be in use, let it be released when no longer referenced.
+        hub.virt.POOL[key] = pooled
+    return pooled
+
+
+def clear(hub):
+    '''
+    Close all the pooled connections
+    '''
+    with hub.virt.POOL_LOCK:
+        pooled = list(hub.virt.POOL.values())
+        hub.virt.POOL.clear()
+    for conn in pooled:
+        try:
+            conn._obj.close()
+        except Exception:  # pylint: disable=broad-except
+            pass
+
+
+class _PooledConnection:
+    '''
+    Proxy to a pooled libvirt connection, ignoring the close() calls
+    '''
+    _libvirt_proxy = True
+
+    def __init__(self, obj):
+        self._obj = obj
+
+    def __getattr__(self, name):
+        return getattr(self._obj, name)
+
+    def close(self):
+        return 0
@@ -0,0 +1,213 @@
+'''
+Background sampler of the domains and node statistics.
+
+The sampler collects the bulk domains statistics (``getAllDomainStats``) and
+the node CPU statistics (``getCPUStats``) at a fixed interval and keeps them in
+preallocated ring buffers, one per domain and metric, so the memory footprint
+doesn't grow over time. The ``hub.exec.virt.stats`` functions compute averages,
+rates and percentiles from these buffers without any libvirt call.
+'''
+import array
+import asyncio
+import logging
+import math
+import re
+import time
+
+log = logging.getLogger(__name__)
+
+# Domain statistics to keep. The per device values are summed, like net.*.rx.bytes into net.rx.bytes
+DOMAIN_METRICS = (
+    'cpu.time', 'cpu.user', 'cpu.system', 'balloon.current', 'balloon.rss',
+    'net.rx.bytes', 'net.tx.bytes', 'block.rd.bytes', 'block.wr.bytes', 'block.rd.reqs', 'block.wr.reqs',
+)
+DEVICE_METRIC_RE = re.compile(r'^(net|block)\.[0-9]+\.(.+)$')
+
+
+def __init__(hub):
+    hub.virt.SAMPLER = None
+
+
+def start(hub, interval=None, size=None, connection=None, username=None, password=None):
+    '''
+    Start sampling in the background, restarting the sampler if already running
+
+    :param interval: seconds between two samples, defaults to the ``sampler_interval`` option
+    :param size: number of samples kept per domain and metric, defaults to the ``sampler_size`` option
+    :param connection: libvirt connection URI, overriding defaults
+    :param username: username to connect with, overriding defaults
+    :param password: password to connect with, overriding defaults
+    '''
+    stop(hub)
+    opts = hub.OPT['virt']
+    sampler = {
+        'interval': float(interval or opts.get('sampler_interval') or 10),
+        'size': int(size or opts.get('sampler_size') or 360),
+        'domains': {},
+        'node': {},
+        'samples': 0,
+        'errors': 0,
+    }
+    sampler['task'] = asyncio.ensure_future(
+        _run(hub, sampler, connection, username, password))
+    hub.virt.SAMPLER = sampler
+    return True
+
+
+def stop(hub):
+    '''
+    Stop the background sampler and drop the collected values
+    '''
+    if hub.virt.SAMPLER is None:
+        return False
+    hub.virt.SAMPLER['task'].cancel()
+    hub.virt.SAMPLER = None
+    return True
+
+
+def series(hub, metric, vm_=None):
+    '''
+    Return the ring buffers for a metric as a dictionary indexed by domain name.
+
+    The node metrics, starting with ``node.``, are indexed by ``node``.
+    '''
+    sampler = hub.virt.SAMPLER
+    if sampler is None:
+        raise Exception('The statistics sampler is not running')
+    if metric.startswith('node.'):
+        ring = sampler['node'].get(metric)
+        return {'node': ring} if ring else {}
+    return {name: rings[metric] for name, rings in sampler['domains'].items()
+            if metric in rings and (vm_ is None or name == vm_)}
+
+
+async def _run(hub, sampler, connection, username, password):
+    loop = asyncio.get_event_loop()
+    while True:
+        start = time.monotonic()
+        try:
+            conn = await hub.exec.virt.util.get_conn(connection, username, password)
+            try:
+                domains, cpu = await loop.run_in_executor(None, _collect, conn)
+            finally:
+                conn.close()
+            _store(sampler, time.time(), domains, cpu)
+            sampler['samples'] += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:  # pylint: disable=broad-except
+            sampler['errors'] += 1
+            log.warning('Failed to sample the libvirt statistics: %s', err)
+        await asyncio.sleep(max(0, sampler['interval'] - (time.monotonic() - start)))
+
+
+def _collect(conn):
+    '''
+    Blocking collection of the raw statistics, run in an executor
+    '''
+    # -1 is VIR_NODE_CPU_STATS_ALL_CPUS
+    return [(dom.name(), stats) for dom, stats in conn.getAllDomainStats()], conn.getCPUStats(-1)
+
+
+def _store(sampler, now, domains, cpu):
+    size = sampler['size']
+    seen = set()
+    for name, raw_stats in domains:
+        seen.add(name)
+        rings = sampler['domains'].setdefault(name, {})
+        for metric, value in _domain_values(raw_stats).items():
+            if metric not in rings:
+                rings[metric] = _Ring(size)
+            rings[metric].append(now, value)
+    # Forget the domains that are gone
+    for name in set(sampler['domains']) - seen:
+        del sampler['domains'][name]
+
+    for key, value in cpu.items():
+        metric = 'node.cpu.{}'.format(key)
+        if metric not in sampler['node']:
+            sampler['node'][metric] = _Ring(size)
+        sampler['node'][metric].append(now, value)
+
+
+def _domain_values(raw_stats):
+    '''
+    Extract the kept metrics from a getAllDomainStats record, summing the per device values
+    '''
+    values = {}
+    for key, value in raw_stats.items():
+        match = DEVICE_METRIC_RE.match(key)
+        if match:
+            key = '{}.{}'.format(match.group(1), match.group(2))
+            if key in DOMAIN_METRICS:
+                values[key] = values.get(key, 0) + value
+        elif key in DOMAIN_METRICS:
+            values[key] = value
+    return values
+
+
+class _Ring:
+    '''
+    Fixed size buffer of timestamped values
+    '''
+
+    def __init__(self, size):
+        self.size = size
+        self.times = array.array('d', [0.0]) * size
+        self.values = array.array('d', [0.0]) * size
+        self.count = 0
+        self.pos = 0
+
+    def append(self, timestamp, value):
+        self.times[self.pos] = timestamp
+        self.values[self.pos] = value
+        self.pos = (self.pos + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def window(self, seconds, now=None):
+        '''
+        Return the (timestamp, value) pairs of the last seconds, oldest first
+        '''
+        since = (now or time.time()) - seconds
+        ret = []
+        for index in range(self.count):
+            pos = (self.pos - 1 - index) % self.size
+            if self.times[pos] < since:
+                break
+            ret.append((self.times[pos], self.values[pos]))
+        ret.reverse()
+        return ret
+
+
+def average(hub, points):
+    '''
+    Average of the points values
+    '''
+    return sum(value for _, value in points) / len(points) if points else None
+
+
+def rate(hub, points):
+    '''
+    Per second increase of a counter over the points
+    '''
+    if len(points) < 2 or points[-1][0] == points[0][0]:
+        return None
+    return (points[-1][1] - points[0][1]) / (points[-1][0] - points[0][0])
+
+
+def rates(hub, points):
+    '''
+    Per second increase of a counter between each consecutive points
+    '''
+    return [(second[0], (second[1] - first[1]) / (second[0] - first[0]))
+            for first, second in zip(points, points[1:]) if second[0] != first[0]]
+
+
+def percentile(hub, points, percent):
+    '''
+    Nearest rank percentile of the points values
+    '''
+    if not points:
+        return None
+    values = sorted(value for _, value in points)
+    return values[max(0, int(math.ceil(percent / 100.0 * len(values))) - 1)]
@@ -0,0 +1,113 @@
+'''
+Local unix socket server answering exec calls.
+
+``virt --serve`` keeps the hub, the pooled libvirt connections and the caches
+warm and runs the exec calls sent by the ``virt`` command line.
+
+The protocol is line based: each request is a JSON object like
+``{"id": 1, "ref": "virt.domain.list_all", "args": ["connection=qemu:///system"]}``
+and each response is a JSON object with the same ``id`` and either a ``return``
+or an ``error`` value. Requests are run concurrently and the responses are sent
+as soon as they are ready, possibly out of order: the exec functions make their
+blocking libvirt calls in executor threads, so a slow request doesn't stall the
+other clients.
+
+The socket is only accessible to the user running the server.
+'''
+import asyncio
+import functools
+import json
+import logging
+import os
+
+import virt.scripts
+
+log = logging.getLogger(__name__)
+
+# Size of the pending response data beyond which the writing waits for the client
+WRITE_BUFFER_SIZE = 65536
+
+
+def __init__(hub):
+    hub.virt.SERVER = None
+
+
+async def serve(hub, path=None):
+    '''
+    Serve the exec calls on a unix socket until stopped
+
+    :param path: the path of the socket, defaults to the ``socket`` option
+    '''
+    path = path or hub.OPT['virt'].get('socket') or virt.scripts.default_socket()
+    hub.virt.pool.enable()
+    if os.path.exists(path):
+        os.unlink(path)
+    # Only the user running the server may connect: no window with the default umask permissions
+    umask = os.umask(0o177)
+    try:
+        hub.virt.SERVER = await asyncio.start_unix_server(functools.partial(_handle, hub), path=path)
+    finally:
+        os.umask(umask)
+    log.info('Serving virt exec calls on %s', path)
+    if hub.OPT['virt'].get('sampler_interval'):
+        hub.virt.sampler.start()
+    if hub.OPT['virt'].get('exporter_port'):
+        await hub.virt.exporter.start()
+    try:
+        await hub.virt.SERVER.wait_closed()
+    finally:
+        await hub.virt.exporter.stop()
+        hub.virt.sampler.stop()
+        hub.virt.SERVER = None
+        hub.virt.pool.clear()
+        if os.path.exists(path):
+            os.unlink(path)
+
+
+def stop(hub):
+    '''
+    Stop the running server
+    '''
+    if hub.virt.SERVER is not None:
+        hub.virt.SERVER.close()
+
+
+async def _handle(hub, reader, writer):
+    '''
+    Run the requests of a client connection concurrently
+    '''
+    lock = asyncio.Lock()
+    tasks = []
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            tasks.append(asyncio.ensure_future(_answer(hub, line, writer, lock)))
+            tasks = [task for task in tasks if not task.done()]
+        if tasks:
+            await asyncio.wait(tasks)
+    finally:
+        writer.close()
+
+
+async def _answer(hub, line, writer, lock):
+    ret = {'id': None}
+    try:
+        request = json.loads(line.decode())
+        ret['id'] = request.get('id')
+        ret['return'] = await hub.virt.init.run(request['ref'], request.get('args') or [])
+    except Exception as err:  # pylint: disable=broad-except
+        log.debug('Failed to run request %s', line, exc_info=True)
+        ret['error'] = str(err)
+    try:
+        async with lock:
+            # The lazy results, like the spilled domain infos, are streamed rather than loaded in memory
+            for chunk in hub.virt.init.iterencode(ret):
+                writer.write(chunk.encode())
+                if writer.transport.get_write_buffer_size() > WRITE_BUFFER_SIZE:
+                    await writer.drain()
+            writer.write(b'\n')
+            await writer.drain()
+    finally:
+        hub.virt.init.release(ret)
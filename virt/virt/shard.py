@@ -0,0 +1,117 @@
+'''
+Sharding of per domain libvirt calls across parallel connections.
+
+The calls made on one libvirt connection are serialized: a batch of per domain
+calls, like the ``XMLDesc`` and ``info`` calls of ``domain.info``, is limited by
+the round trip time of that connection. The batch functions can split the
+domains across several connections to the same URI, each one used by its own
+thread, and merge the results back in the order of the domains.
+
+The number of connections is set by the ``shards`` option. With ``shards`` set
+to 0, it is computed for each batch from the per domain latency observed on the
+previous batches so that a batch takes about ``TARGET`` seconds, without
+exceeding ``shards_max`` connections.
+'''
+import asyncio
+import math
+import threading
+import time
+
+# Seconds a batch should take when adapting the number of connections
+TARGET = 0.5
+# Weight of the last batch in the average latency
+SMOOTHING = 0.3
+
+
+def __init__(hub):
+    hub.virt.SHARD_LATENCY = {}
+    hub.virt.SHARD_LOCK = threading.Lock()
+
+
+def count(hub, uri, items, shards=None):
+    '''
+    Return the number of connections to use for a batch
+
+    :param uri: the libvirt connection URI
+    :param items: the number of items in the batch
+    :param shards: number of connections overriding the ``shards`` option, 0 to adapt it
+    '''
+    opts = hub.OPT['virt']
+    if shards is None:
+        shards = opts.get('shards', 1)
+    if shards > 0:
+        return max(1, min(shards, items))
+    maximum = opts.get('shards_max') or 8
+    with hub.virt.SHARD_LOCK:
+        latency = hub.virt.SHARD_LATENCY.get(uri)
+    if latency is None:
+        wanted = maximum // 2
+    else:
+        wanted = math.ceil(items * latency / TARGET)
+    return max(1, min(maximum, wanted, items))
+
+
+async def apply(hub, func, items, shards=None, connection=None, username=None, password=None):
+    '''
+    Call ``func(conn, item)`` for all the items, spread over parallel connections.
+
+    The results are returned in the order of the items. The first error raised by
+    ``func`` is raised once all the connections are done.
+
+    :param func: blocking function to call with a libvirt connection and an item
+    :param items: list of the items
+    :param shards: number of connections overriding the ``shards`` option, 0 to adapt it
+    :param connection: libvirt connection URI, overriding defaults
+    :param username: username to connect with, overriding defaults
+    :param password: password to connect with, overriding defaults
+    '''
+    import concurrent.futures
+
+    uri = connection or hub.OPT['virt']['uri']
+    shards = count(hub, uri, len(items), shards)
+    conns = await asyncio.gather(*[
+        hub.exec.virt.util.get_conn(connection, username, password, shard=index) for index in range(shards)])
+
+    def _run(conn, index):
+        start = time.monotonic()
+        results = [func(conn, item) for item in items[index::shards]]
+        return results, time.monotonic() - start
+
+    loop = asyncio.get_event_loop()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=shards)
+    try:
+        done = await asyncio.gather(*[
+            loop.run_in_executor(executor, _run, conn, index) for index, conn in enumerate(conns)])
+    finally:
+        executor.shutdown(wait=False)
+        for conn in conns:
+            conn.close()
+
+    _record(hub, uri, [(elapsed, len(results)) for results, elapsed in done])
+    ret = [None] * len(items)
+    for index, (results, _) in enumerate(done):
+        ret[index::shards] = results
+    return ret
+
+
+def stats(hub):
+    '''
+    Return the observed per item latency in seconds by URI
+    '''
+    with hub.virt.SHARD_LOCK:
+        return dict(hub.virt.SHARD_LATENCY)
+
+
+def _record(hub, uri, timings):
+    '''
+    Update the average per item latency with the (elapsed, items) timings of a batch
+    '''
+    items = sum(done for _, done in timings)
+    if not items:
+        return
+    latency = sum(elapsed for elapsed, _ in timings) / items
+    with hub.virt.SHARD_LOCK:
+        previous = hub.virt.SHARD_LATENCY.get(uri)
+        if previous is not None:
+            latency = SMOOTHING * latency + (1 - SMOOTHING) * previous
+        hub.virt.SHARD_LATENCY[uri] = latency